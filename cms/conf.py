@@ -61,8 +61,17 @@ class Config(object):
         self.database_debug = False
         self.twophase_commit = False
 
+        # EvaluationService.
+        self.fair_queuing = True
+        self.prefetch_files = True
+        self.bulk_longest_first = True
+        self.full_evaluation = False
+
         # Worker.
+        self.worker_slots = 1
+        self.worker_slot_cpus = []
         self.keep_sandbox = True
+        self.sandbox_pool_size = 2
         self.use_cgroups = True
         self.sandbox_implementation = 'isolate'
 
@@ -85,6 +94,7 @@ class Config(object):
         self.max_input_length = 5000000
         self.stl_path = "/usr/share/doc/stl-manual/html/"
         self.allow_questions = True
+        self.max_user_test_wait = None
         # Prefix of 'iso-codes'[1] installation. It can be found out
         # using `pkg-config --variable=prefix iso-codes`, but it's
         # almost universally the same (i.e. '/usr') so it's hardly
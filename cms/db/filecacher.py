@@ -27,10 +27,12 @@
 from __future__ import absolute_import
 from __future__ import unicode_literals
 
+import fcntl
 import hashlib
 import io
 import logging
 import os
+import stat
 import tempfile
 
 import gevent
@@ -45,6 +47,11 @@ from cms.io.GeventUtils import copyfileobj, move, rmtree
 logger = logging.getLogger(__name__)
 
 
+# The ioctl request making a file a copy-on-write clone of another
+# one (FICLONE, see ioctl_ficlone(2)).
+FICLONE = 0x40049409
+
+
 class FileCacherBackend(object):
 
     def get_file(self, digest):
@@ -425,6 +432,16 @@ class FileCacher(object):
             logger.error("Cannot create necessary directories.")
             raise RuntimeError("Cannot create necessary directories.")
 
+        # Whether get_file_to_link and get_file_to_clone can be used
+        # (they are not anymore after they fail, e.g., because the
+        # file-system does not support them).
+        self.can_link = True
+        self.can_clone = True
+
+        # Where to create the sandboxes, so that the files of the
+        # cache can be linked in them (see check_links).
+        self.sandbox_dir = config.temp_dir
+
     def load(self, digest):
         """Load the file with the given digest into the cache.
 
@@ -454,6 +471,17 @@ class FileCacher(object):
         # by POSIX requirement)
         os.rename(temp_file_path, cache_file_path)
 
+    def is_cached(self, digest):
+        """Return whether the file with the given digest is in the
+        cache.
+
+        digest (unicode): the digest of the file.
+
+        return (bool): True if it is in the cache.
+
+        """
+        return os.path.exists(os.path.join(self.file_dir, digest))
+
     def get_file(self, digest):
         """Retrieve a file from the storage.
 
@@ -536,6 +564,119 @@ class FileCacher(object):
             with io.open(dst_path, 'wb') as dst:
                 copyfileobj(src, dst, self.CHUNK_SIZE)
 
+    def get_file_to_link(self, digest, dst_path, executable=False):
+        """Retrieve a file from the storage.
+
+        See `get_file'. This method makes dst_path a hard link to the
+        copy of the file in the cache, without copying its contents,
+        hence dst_path must be on the same file-system as the cache
+        (see check_links). The file is made readable (and executable)
+        by everybody, but it must not be written, since that would
+        change the cache.
+
+        digest (unicode): the digest of the file to get.
+        dst_path (string): where to create the link.
+        executable (bool): whether to make the file executable.
+
+        raise (KeyError): if the file cannot be found.
+        raise (OSError): if the link cannot be created.
+
+        """
+        cache_file_path = os.path.join(self.file_dir, digest)
+
+        if not os.path.exists(cache_file_path):
+            self.load(digest)
+
+        try:
+            os.link(cache_file_path, dst_path)
+        except OSError:
+            self.can_link = False
+            raise
+
+        # The mode is shared with the copy in the cache, and with the
+        # other links to it: add permissions, never remove them.
+        mode = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+        if executable:
+            mode |= stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+        os.chmod(dst_path, os.stat(dst_path).st_mode | mode)
+
+    def check_links(self):
+        """Choose where the sandboxes have to be created to link the
+        files of the cache in them (see get_file_to_link and
+        sandbox_dir): in config.temp_dir if it is on the same
+        file-system as the cache, otherwise in the cache itself. Log
+        how the files will get in the sandboxes.
+
+        return (bool): whether files can be linked (see can_link).
+
+        """
+        for directory in [config.temp_dir, self.temp_dir]:
+            if self._can_link_to(directory):
+                if directory != config.temp_dir:
+                    logger.info("Creating the sandboxes in %s, to hard "
+                                "link files from the cache." % directory)
+                self.sandbox_dir = directory
+                self.can_link = True
+                return True
+
+        logger.warning("Cannot hard link files from the cache in %s: "
+                       "they will be copied in the sandboxes." %
+                       self.file_dir)
+        self.can_link = False
+        return False
+
+    def _can_link_to(self, directory):
+        """Return whether files of the cache can be linked in the
+        given directory.
+
+        directory (string): where to create the links.
+
+        return (bool): True if a link can be created.
+
+        """
+        link_dir = None
+        fd, path = tempfile.mkstemp(dir=self.temp_dir)
+        os.close(fd)
+        try:
+            link_dir = tempfile.mkdtemp(dir=directory)
+            os.link(path, os.path.join(link_dir, "link"))
+            return True
+        except OSError:
+            return False
+        finally:
+            os.unlink(path)
+            if link_dir is not None:
+                rmtree(link_dir)
+
+    def get_file_to_clone(self, digest, dst):
+        """Retrieve a file from the storage.
+
+        See `get_file'. This method makes the empty file dst a
+        copy-on-write clone (a "reflink") of the copy of the file in
+        the cache, without copying its contents: the two share their
+        blocks until either is written. Hence dst must be on the same
+        file-system as the cache, and the file-system must support
+        it, e.g., Btrfs or XFS (see can_clone).
+
+        digest (unicode): the digest of the file to get.
+        dst (fileobj): the empty file, opened for writing.
+
+        raise (KeyError): if the file cannot be found.
+        raise (IOError): if the clone cannot be created.
+
+        """
+        cache_file_path = os.path.join(self.file_dir, digest)
+
+        if not os.path.exists(cache_file_path):
+            self.load(digest)
+
+        with io.open(cache_file_path, 'rb') as src:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except IOError:
+                self.can_clone = False
+                raise
+
     def save(self, digest, desc=""):
         """Save the file with the given digest into the backend.
 
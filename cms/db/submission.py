@@ -29,7 +29,8 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 from sqlalchemy.schema import Column, ForeignKey, ForeignKeyConstraint, \
-    UniqueConstraint
+    UniqueConstraint, Index
+from sqlalchemy.sql import text
 from sqlalchemy.types import Integer, Float, String, Unicode, DateTime
 from sqlalchemy.orm import relationship, backref
 
@@ -206,6 +207,14 @@ class SubmissionResult(Base):
     __tablename__ = 'submission_results'
     __table_args__ = (
         UniqueConstraint('submission_id', 'dataset_id'),
+        # Partial indexes on the results that still have to be
+        # compiled or evaluated, used by EvaluationService to find
+        # its pending jobs without scanning the whole table.
+        Index('ix_submission_results_compilation_pending', 'submission_id',
+              postgresql_where=text("compilation_outcome IS NULL")),
+        Index('ix_submission_results_evaluation_pending', 'submission_id',
+              postgresql_where=text("compilation_outcome = 'ok' AND "
+                                    "evaluation_outcome IS NULL")),
     )
 
     # Primary key is (submission_id, dataset_id).
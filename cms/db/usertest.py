@@ -26,7 +26,8 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 
 from sqlalchemy.schema import Column, ForeignKey, ForeignKeyConstraint, \
-    UniqueConstraint
+    UniqueConstraint, Index
+from sqlalchemy.sql import text
 from sqlalchemy.types import Integer, Float, String, Unicode, DateTime
 from sqlalchemy.orm import relationship, backref
 
@@ -199,6 +200,14 @@ class UserTestResult(Base):
     __tablename__ = 'user_test_results'
     __table_args__ = (
         UniqueConstraint('user_test_id', 'dataset_id'),
+        # Partial indexes on the results that still have to be
+        # compiled or evaluated, used by EvaluationService to find
+        # its pending jobs without scanning the whole table.
+        Index('ix_user_test_results_compilation_pending', 'user_test_id',
+              postgresql_where=text("compilation_outcome IS NULL")),
+        Index('ix_user_test_results_evaluation_pending', 'user_test_id',
+              postgresql_where=text("compilation_outcome = 'ok' AND "
+                                    "evaluation_outcome IS NULL")),
     )
 
     # Primary key is (user_test_id, dataset_id).
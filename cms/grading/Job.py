@@ -36,11 +36,16 @@ certain testcase".
 """
 
 import json
+import logging
 from copy import deepcopy
 
+from cms import config
 from cms.db import File, Manager, Executable, UserTestExecutable, Evaluation
 
 
+logger = logging.getLogger(__name__)
+
+
 class Job(object):
     """Base class for all jobs.
 
@@ -160,6 +165,17 @@ class CompilationJob(Job):
         self.text = text
         self.plus = plus
 
+    def get_digests(self):
+        """Return the digests of the files from FS the job needs.
+
+        return (set): the digests.
+
+        """
+        digests = set()
+        for files in (self.files, self.managers, self.executables):
+            digests.update(file_.digest for file_ in files.itervalues())
+        return digests
+
     def export_to_dict(self):
         res = Job.export_to_dict(self)
         res.update({
@@ -264,6 +280,19 @@ class EvaluationJob(Job):
         self.only_execution = only_execution
         self.get_output = get_output
 
+    def get_digests(self):
+        """Return the digests of the files from FS the job needs.
+
+        return (set): the digests.
+
+        """
+        digests = set()
+        for files in (self.files, self.managers, self.executables):
+            digests.update(file_.digest for file_ in files.itervalues())
+        digests.update(digest for digest in (self.input, self.output)
+                       if digest is not None)
+        return digests
+
     def export_to_dict(self):
         res = Job.export_to_dict(self)
         res.update({
@@ -307,11 +336,16 @@ class JobGroup(object):
 
     """
 
-    def __init__(self, jobs=None, success=None):
+    def __init__(self, jobs=None, success=None, plan=None):
         """Initialization.
 
         jobs ({string: Job}): the jobs composing the group.
         success (bool): whether all jobs succeded.
+        plan ([[string]]): lists of keys of evaluation jobs, such
+            that, once one of them gets outcome 0.0, the following ones
+            in the same list need not be done, and the worker removes
+            them from the group (see ScoreType.get_evaluation_plan);
+            None to do all jobs.
 
         """
         if jobs is None:
@@ -319,12 +353,14 @@ class JobGroup(object):
 
         self.jobs = jobs
         self.success = success
+        self.plan = plan
 
     def export_to_dict(self):
         res = {
             'jobs': dict((k, v.export_to_dict())
                          for k, v in self.jobs.iteritems()),
             'success': self.success,
+            'plan': self.plan,
             }
         return res
 
@@ -335,6 +371,65 @@ class JobGroup(object):
             for k, v in data['jobs'].iteritems())
         return cls(**data)
 
+    def get_ordered_keys(self):
+        """Return the keys of the jobs in the order they should be
+        done: first those in the plan, in its order, then the others.
+
+        return ([string]): the keys of all the jobs.
+
+        """
+        keys = []
+        for plan_keys in self.plan or []:
+            keys += [k for k in plan_keys
+                     if k in self.jobs and k not in keys]
+        keys += [k for k in sorted(self.jobs.iterkeys())
+                 if k not in keys]
+        return keys
+
+    def split(self, n):
+        """Split the group in at most n smaller groups.
+
+        The jobs are sorted by their key and divided in contiguous
+        chunks of (almost) the same size, so that they can be given
+        to different workers and then put together again with merge.
+
+        n (int): the maximum number of groups to return.
+
+        return ([JobGroup]): the groups, at least one and at most n,
+                             none of them empty (unless self is).
+
+        """
+        keys = sorted(self.jobs.iterkeys())
+        n = max(1, min(n, len(keys)))
+        job_groups = []
+        for i in xrange(n):
+            jobs = dict((k, self.jobs[k])
+                        for k in keys[i * len(keys) // n:
+                                      (i + 1) * len(keys) // n])
+            plan = None
+            if self.plan is not None:
+                plan = [[k for k in plan_keys if k in jobs]
+                        for plan_keys in self.plan]
+                plan = [plan_keys for plan_keys in plan if plan_keys]
+            job_groups.append(JobGroup(jobs, self.success, plan))
+        return job_groups
+
+    @staticmethod
+    def merge(job_groups):
+        """Put together groups obtained by splitting a single one.
+
+        job_groups ([JobGroup]): the groups to merge.
+
+        return (JobGroup): a group with the jobs of all the given
+                           ones, successful if all of them were.
+
+        """
+        jobs = {}
+        for job_group in job_groups:
+            jobs.update(job_group.jobs)
+        return JobGroup(jobs, all(job_group.success
+                                  for job_group in job_groups))
+
     # Compilation
 
     @staticmethod
@@ -443,7 +538,20 @@ class JobGroup(object):
     # Evaluation
 
     @staticmethod
-    def from_submission_evaluation(submission, dataset):
+    def from_submission_evaluation(submission, dataset, skip=None):
+        """Build the group of the evaluations of a submission.
+
+        submission (Submission): the submission to evaluate.
+        dataset (Dataset): the dataset to use.
+        skip (set): the codenames of the testcases to leave out (e.g.,
+            because their outcome is already known).
+
+        return (JobGroup): the group, with a job for each testcase.
+
+        """
+        if skip is None:
+            skip = set()
+
         job = EvaluationJob()
 
         # Job
@@ -467,6 +575,8 @@ class JobGroup(object):
         jobs = dict()
 
         for k, testcase in dataset.testcases.iteritems():
+            if k in skip:
+                continue
             job2 = deepcopy(job)
 
             job2.input = testcase.input
@@ -476,7 +586,23 @@ class JobGroup(object):
 
             jobs[k] = job2
 
-        return JobGroup(jobs)
+        # Unless asked otherwise, let the worker leave out the
+        # testcases whose outcome cannot change the score; the score
+        # type must be imported here to avoid circular dependencies.
+        plan = None
+        if not config.full_evaluation:
+            from cms.grading.scoretypes import get_score_type
+            try:
+                plan = get_score_type(dataset=dataset).get_evaluation_plan()
+            except Exception as error:
+                logger.warning("Cannot get the evaluation plan of dataset "
+                               "%d, evaluating all testcases: %r." %
+                               (dataset.id, error))
+            if plan is not None:
+                plan = [[k for k in plan_keys if k in jobs]
+                        for plan_keys in plan]
+
+        return JobGroup(jobs, plan=plan)
 
     def to_submission_evaluation(self, sr):
         # This should actually be useless.
@@ -26,11 +26,13 @@ import os
 import re
 import resource
 import select
+import shutil
 import stat
 import tempfile
 from functools import wraps, partial
 
 import gevent
+import gevent.pool
 from gevent import subprocess
 #import gevent_subprocess as subprocess
 
@@ -77,6 +79,22 @@ def pretty_print_cmdline(cmdline):
     return " ".join(["'%s'" % (x.replace("'", "'\"'\"'")) for x in cmdline])
 
 
+def empty_directory(path):
+    """Delete all the files and directories in a directory. This
+    blocks (it does not yield to other greenlets), so that it can run
+    in a thread.
+
+    path (string): the directory.
+
+    """
+    for name in os.listdir(path):
+        subpath = os.path.join(path, name)
+        if os.path.isdir(subpath) and not os.path.islink(subpath):
+            shutil.rmtree(subpath)
+        else:
+            os.unlink(subpath)
+
+
 def wait_without_std(procs):
     """Wait for the conclusion of the processes in the list, avoiding
     starving for input and output.
@@ -204,6 +222,12 @@ class SandboxBase(object):
     EXIT_SYSCALL = 'syscall'
     EXIT_NONZERO_RETURN = 'nonzero return'
 
+    # Whether the files from FS can be hard links to the copies in
+    # the cache of the file cacher: only if the sandboxed programs
+    # cannot write them, nor change their permissions (since they
+    # would change the cache, shared by all the sandboxes).
+    CAN_LINK_FILES = False
+
     def __init__(self, file_cacher=None):
         """Initialization.
 
@@ -213,6 +237,17 @@ class SandboxBase(object):
         """
         self.file_cacher = file_cacher
 
+    @staticmethod
+    def get_boxes_per_slot():
+        """Return how many boxes each slot of a worker uses (see
+        IsolateSandbox.box_index); sandboxes without boxes have just
+        one, shared by all.
+
+        return (int): the number of boxes of each slot.
+
+        """
+        return 1
+
     def get_stats(self):
         """Return a human-readable string representing execution time
         and memory usage.
@@ -276,6 +311,23 @@ class SandboxBase(object):
         """
         return os.path.join(self.get_root_path(), path)
 
+    def clear(self):
+        """Delete all the files in the sandbox, so that it can be
+        reset and used again (see SandboxPool).
+
+        """
+        empty_directory(self.get_root_path())
+
+    def reset(self):
+        """Make an empty sandbox (see clear) ready to be used again,
+        as if it was just created but without doing it again.
+
+        raise (NotImplementedError): if the subclass does not
+            implement this method.
+
+        """
+        raise NotImplementedError("Subclasses must implement reset.")
+
     def create_file(self, path, executable=False):
         """Create an empty file in the sandbox and open it in write
         binary mode.
@@ -290,6 +342,10 @@ class SandboxBase(object):
         else:
             logger.debug("Creating plain file %s in sandbox." % path)
         real_path = self.relative_path(path)
+        # The file may be a link to the cache (see
+        # create_file_from_storage), which must not be truncated.
+        if os.path.lexists(real_path):
+            os.remove(real_path)
         file_ = io.open(real_path, "wb")
         mod = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | stat.S_IWUSR
         if executable:
@@ -298,16 +354,46 @@ class SandboxBase(object):
         return file_
 
     def create_file_from_storage(self, path, digest, executable=False):
-        """Write a file taken from FS in the sandbox.
+        """Write a file taken from FS in the sandbox, as a link to
+        or a clone of the copy in the cache where possible (see
+        FileCacher.get_file_to_link and get_file_to_clone).
 
         path (string): relative path of the file inside the sandbox.
         digest (string): digest of the file in FS.
         executable (bool): to set permissions.
 
         """
+        if self.CAN_LINK_FILES and self.file_cacher.can_link:
+            real_path = self.relative_path(path)
+            if os.path.lexists(real_path):
+                os.remove(real_path)
+            try:
+                self.file_cacher.get_file_to_link(digest, real_path,
+                                                  executable)
+                return
+            except OSError as error:
+                # Probably the sandbox is not on the file-system of
+                # the cache: the file cacher will not try again.
+                logger.warning("Cannot link file %s in sandbox, "
+                               "not linking files from now on: %r." %
+                               (path, error))
         file_ = self.create_file(path, executable)
-        self.file_cacher.get_file_to_fobj(digest, file_)
-        file_.close()
+        try:
+            # A clone costs the same whatever the size of the file,
+            # and is safe since writing it does not change the cache.
+            if self.file_cacher.can_clone:
+                try:
+                    self.file_cacher.get_file_to_clone(digest, file_)
+                    return
+                except IOError as error:
+                    # Probably the file-system does not support it:
+                    # the file cacher will not try again.
+                    logger.warning("Cannot clone file %s in sandbox, "
+                                   "copying files from now on: %r." %
+                                   (path, error))
+            self.file_cacher.get_file_to_fobj(digest, file_)
+        finally:
+            file_.close()
 
     def create_file_from_string(self, path, content, executable=False):
         """Write some data to a file in the sandbox.
@@ -440,14 +526,22 @@ class StupidSandbox(SandboxBase):
         self.path = tempfile.mkdtemp(dir=temp_dir)
 
         self.cmd_file = "commands.log"
+
+        logger.debug("Sandbox in `%s' created, using stupid box." %
+                     (self.path))
+
+        self.set_default_parameters()
+
+    def set_default_parameters(self):
+        """Set the parameters of the box to their default values, and
+        forget the previous executions.
+
+        """
         self.exec_num = -1
         self.popen = None
         self.popen_time = None
         self.exec_time = None
 
-        logger.debug("Sandbox in `%s' created, using stupid box." %
-                     (self.path))
-
         # Box parameters
         self.chdir = self.path
         self.stdin_file = None
@@ -475,6 +569,18 @@ class StupidSandbox(SandboxBase):
         # packages.
         self.set_env["HOME"] = "./"
 
+    def get_root_path(self):
+        """Return the toplevel path of the sandbox.
+
+        return (string): the root path.
+
+        """
+        return self.path
+
+    def reset(self):
+        """See SandboxBase.reset."""
+        self.set_default_parameters()
+
     # TODO - It returns wall clock time, because I have no way to
     # check CPU time (libev doesn't have wait4() support)
     def get_execution_time(self):
@@ -747,23 +853,43 @@ class IsolateSandbox(SandboxBase):
        command number N.
 
     """
-    def __init__(self, file_cacher=None, temp_dir=None):
+    # The files are in our directory, bound in the box (see
+    # inner_temp_dir): isolate does not give them to the user running
+    # the sandboxed programs, which hence can neither write them nor
+    # change their permissions.
+    CAN_LINK_FILES = True
+
+    # The name of the executable (see detect_box_executable).
+    exec_name = 'isolate'
+
+    def __init__(self, file_cacher=None, temp_dir=None, box_index=0):
         """Initialization.
 
         For arguments documentation, see SandboxBase.__init__.
 
+        box_index (int): which of the boxes of the slot to use; the
+            boxes other than the first belong to a single sandbox,
+            hence they are not initialized again when it is reset
+            (see SandboxPool).
+
         """
         SandboxBase.__init__(self, file_cacher)
 
-        # Get our shard number, to use as a unique identifier for the
-        # sandbox on this machine. FIXME This is the only use of
+        # Get our shard number (and slot, for workers executing many
+        # jobs at the same time), to use as a unique identifier for
+        # the sandbox on this machine. FIXME This is the only use of
         # FileCacher.service, and it's an improper use! Avoid it!
+        cpus = None
         if file_cacher is not None and file_cacher.service is not None:
-            # We add 1 to avoid conflicting with console users of the
-            # sandbox who use the default box id of 0.
-            box_id = file_cacher.service.shard + 1
+            slot = getattr(file_cacher.service, "slot", 0)
+            box_id = IsolateSandbox.get_box_id(file_cacher.service.shard,
+                                               slot, box_index)
+            if slot < len(config.worker_slot_cpus):
+                cpus = config.worker_slot_cpus[slot]
         else:
+            # The console box is shared.
             box_id = 0
+            box_index = 0
 
         # We create a directory "tmp" inside the outer temporary directory,
         # because the sandbox will bind-mount the inner one. The sandbox also
@@ -773,7 +899,12 @@ class IsolateSandbox(SandboxBase):
         # permissions.
         self.inner_temp_dir = "/tmp"
         if temp_dir is None:
-            temp_dir = config.temp_dir
+            # Where files can be linked from the cache (see
+            # FileCacher.check_links).
+            if file_cacher is not None:
+                temp_dir = file_cacher.sandbox_dir
+            else:
+                temp_dir = config.temp_dir
         self.outer_temp_dir = tempfile.mkdtemp(dir=temp_dir)
         # Don't use os.path.join here, because the absoluteness of /tmp will
         # bite you.
@@ -781,18 +912,107 @@ class IsolateSandbox(SandboxBase):
         os.mkdir(self.path)
         os.chmod(self.path, 0777)
 
-        self.exec_name = 'isolate'
         self.box_exec = self.detect_box_executable()
         self.info_basename = "run.log"   # Used for -M
         self.cmd_file = "commands.log"
-        self.log = None
-        self.exec_num = -1
         logger.debug("Sandbox in `%s' created, using box `%s'." %
                      (self.path, self.box_exec))
 
-        # Default parameters for isolate
         self.box_id = box_id           # -b
+        self.box_index = box_index
+        self.box_path = None
+        self.cpus = cpus               # taskset -c
         self.cgroup = config.use_cgroups  # --cg
+        self.set_default_parameters()
+        self.init_box()
+
+    @staticmethod
+    def get_boxes_per_slot():
+        """See SandboxBase.get_boxes_per_slot. The first box of each
+        slot is shared by the sandboxes that do not have their own,
+        the others go to the sandboxes kept by SandboxPool, at most
+        config.sandbox_pool_size of them.
+
+        """
+        return 1 + max(config.sandbox_pool_size, 0)
+
+    @staticmethod
+    def get_box_id(shard, slot, box_index):
+        """Return the box id of isolate used by a worker.
+
+        shard (int): the shard of the worker.
+        slot (int): the slot of the worker.
+        box_index (int): which of the boxes of the slot.
+
+        return (int): the box id.
+
+        """
+        # We add 1 to avoid conflicting with console users of the
+        # sandbox who use the default box id of 0.
+        return (shard * config.worker_slots + slot) \
+            * IsolateSandbox.get_boxes_per_slot() + box_index + 1
+
+    @classmethod
+    def get_num_boxes(cls):
+        """Return how many boxes isolate has (they are set when
+        building it, see CONFIG_ISOLATE_NUM_BOXES in
+        isolate/autoconf.h).
+
+        return (int): the number of boxes.
+
+        raise (SandboxInterfaceException): if isolate cannot tell.
+
+        """
+        box_cmd = [cls.detect_box_executable(), "--version"]
+        try:
+            popen = subprocess.Popen(box_cmd, stdout=subprocess.PIPE)
+            output = popen.communicate()[0]
+        except OSError as error:
+            raise SandboxInterfaceException(
+                "Failed to run %s: %r." %
+                (pretty_print_cmdline(box_cmd), error))
+        # Each box has its own uid.
+        match = re.search(r"uid=(\d+)-(\d+)", output)
+        if popen.returncode != 0 or match is None:
+            raise SandboxInterfaceException(
+                "Failed to get the number of boxes with command: %s "
+                "(error %d)" % (pretty_print_cmdline(box_cmd),
+                                popen.returncode))
+        return int(match.group(2)) - int(match.group(1)) + 1
+
+    @staticmethod
+    def check_box_ids(shard):
+        """Check that isolate has the boxes used by all the slots of
+        a worker.
+
+        shard (int): the shard of the worker.
+
+        raise (SandboxInterfaceException): if isolate does not have
+            enough boxes.
+
+        """
+        max_box_id = IsolateSandbox.get_box_id(
+            shard, config.worker_slots - 1,
+            IsolateSandbox.get_boxes_per_slot() - 1)
+        num_boxes = IsolateSandbox.get_num_boxes()
+        if max_box_id >= num_boxes:
+            raise SandboxInterfaceException(
+                "Worker %d needs the box ids up to %d, but isolate has "
+                "only %d boxes: lower worker_slots or sandbox_pool_size, "
+                "or rebuild isolate with more boxes (see \"Running "
+                "CMS\" in the documentation)." %
+                (shard, max_box_id, num_boxes))
+
+    def set_default_parameters(self):
+        """Set the parameters for isolate that can be changed by
+        the users of the sandbox to their default values, and forget
+        the previous executions.
+
+        """
+        self.log = None
+        self.exec_num = -1
+
+        # Default parameters for isolate
         self.chdir = self.inner_temp_dir  # -c
         self.dirs = []                 # -d
         self.dirs += [(self.inner_temp_dir, self.path, "rw")]
@@ -815,14 +1035,45 @@ class IsolateSandbox(SandboxBase):
         # packages.
         self.set_env["HOME"] = "./"
 
-        # Tell isolate to get the sandbox ready.
+    def init_box(self):
+        """Tell isolate to get the sandbox ready (creating an empty
+        box and a new control group).
+
+        raise (SandboxInterfaceException): if isolate fails.
+
+        """
         box_cmd = [self.box_exec] + (["--cg"] if self.cgroup else []) \
             + ["--box-id=%d" % self.box_id] + ["--init"]
-        ret = subprocess.call(box_cmd)
-        if ret != 0:
+        popen = subprocess.Popen(box_cmd, stdout=subprocess.PIPE)
+        output = popen.communicate()[0]
+        if popen.returncode != 0:
             raise SandboxInterfaceException(
                 "Failed to initialize sandbox with command: %s "
-                "(error %d)" % (pretty_print_cmdline(box_cmd), ret))
+                "(error %d)" % (pretty_print_cmdline(box_cmd),
+                                popen.returncode))
+        # Isolate prints the directory of the box.
+        self.box_path = os.path.join(output.strip(), "box")
+
+    def clear(self):
+        """See SandboxBase.clear. The box of isolate, where the
+        sandboxed programs may write too, is emptied as well if it
+        belongs to this sandbox.
+
+        """
+        SandboxBase.clear(self)
+        if self.box_index > 0:
+            empty_directory(self.box_path)
+
+    def reset(self):
+        """See SandboxBase.reset."""
+        self.set_default_parameters()
+        # The first box of the slot is shared with the other
+        # sandboxes, which may have used it meanwhile: we initialize
+        # it again. The others are ours and have been emptied by
+        # clear (isolate resets the statistics of the control group
+        # at each execution).
+        if self.box_index == 0:
+            self.init_box()
 
     def get_root_path(self):
         """Return the toplevel path of the sandbox.
@@ -832,7 +1083,8 @@ class IsolateSandbox(SandboxBase):
         """
         return self.path
 
-    def detect_box_executable(self):
+    @classmethod
+    def detect_box_executable(cls):
         """Try to find an isolate executable. It first looks in
         ./isolate/, then the local directory, then in a relative path
         from the file that contains the Sandbox module, then in the
@@ -841,13 +1093,13 @@ class IsolateSandbox(SandboxBase):
         return (string): the path to a valid (hopefully) isolate.
 
         """
-        paths = [os.path.join('.', 'isolate', self.exec_name),
-                 os.path.join('.', self.exec_name)]
+        paths = [os.path.join('.', 'isolate', cls.exec_name),
+                 os.path.join('.', cls.exec_name)]
         if '__file__' in globals():
             paths += [os.path.abspath(os.path.join(
                       os.path.dirname(__file__),
-                      '..', '..', 'isolate', self.exec_name))]
-        paths += [self.exec_name]
+                      '..', '..', 'isolate', cls.exec_name))]
+        paths += [cls.exec_name]
         for path in paths:
             # Consider only non-directory, executable files.
             if os.path.exists(path) \
@@ -855,7 +1107,7 @@ class IsolateSandbox(SandboxBase):
                     and os.access(path, os.X_OK):
                 return path
 
-        # As default, return self.exec_name alone, that means that
+        # As default, return cls.exec_name alone, that means that
         # system path is used.
         return paths[-1]
 
@@ -912,6 +1164,22 @@ class IsolateSandbox(SandboxBase):
         res += ["--run"]
         return res
 
+    def build_box_command(self, command):
+        """Build the command line to execute a command in the sandbox,
+        pinned to the CPUs of the sandbox, if any.
+
+        command ([string]): executable filename and arguments of the
+            command.
+
+        return ([string]): the command line.
+
+        """
+        res = list()
+        if self.cpus is not None:
+            res += ["taskset", "-c", self.cpus]
+        return res + [self.box_exec] + self.build_box_options() \
+            + ["--"] + command
+
     def get_log(self):
         """Read the content of the log file of the sandbox (usually
         run.log.N for some integer N), and set self.log as a dict
@@ -1121,7 +1389,7 @@ class IsolateSandbox(SandboxBase):
         """
         self.exec_num += 1
         self.log = None
-        args = [self.box_exec] + self.build_box_options() + ["--"] + command
+        args = self.build_box_command(command)
         logger.debug("Executing program in sandbox with command: %s" %
                      pretty_print_cmdline(args))
         with io.open(self.relative_path(self.cmd_file), 'at') as commands:
@@ -1147,7 +1415,7 @@ class IsolateSandbox(SandboxBase):
         """
         self.exec_num += 1
         self.log = None
-        args = [self.box_exec] + self.build_box_options() + ["--"] + command
+        args = self.build_box_command(command)
         logger.debug("Executing program in sandbox with command: %s" %
                      pretty_print_cmdline(args))
         with io.open(self.relative_path(self.cmd_file), 'at') as commands:
@@ -1228,6 +1496,210 @@ class IsolateSandbox(SandboxBase):
         rmtree(self.outer_temp_dir)
 
 
+class SandboxPool(object):
+    """The sandboxes no longer needed, kept to be used again instead
+    of creating new ones.
+
+    Creating a sandbox means making its directories and (for isolate)
+    initializing the box, and deleting it means cleaning up the box
+    and deleting all its files: with the pool, a released sandbox has
+    its files deleted in a thread of the threadpool of gevent (hence
+    while the worker goes on with the next executions), and then it
+    is just reset when acquired.
+    For isolate, the sandboxes created by the pool get a box of their
+    own (see IsolateSandbox.box_index) while there are any left, so
+    that they do not need to initialize it again.
+
+    Sandboxes are reused only with the same file cacher and in the
+    same slot of the worker.
+
+    """
+
+    def __init__(self, size=0):
+        """size (int): how many unused sandboxes to keep for each file
+            cacher and slot; 0 disables the pool.
+
+        """
+        self.size = size
+        self._free = {}
+        self._clearing = {}
+        self._clearers = gevent.pool.Group()
+        # The box indexes used by the sandboxes of each key.
+        self._box_indexes = {}
+
+        # Statistics for the status RPC method.
+        self.created = 0
+        self.creation_time = 0.0
+        self.reused = 0
+        self.reuse_time = 0.0
+        self.deleted = 0
+        self.deletion_time = 0.0
+
+    @staticmethod
+    def _key(file_cacher):
+        """Return the key of the sandboxes that can be used with the
+        given file cacher, in the slot of the current greenlet.
+
+        file_cacher (FileCacher): the file cacher of the sandbox.
+
+        return (tuple): the key.
+
+        """
+        return (file_cacher,
+                getattr(getattr(file_cacher, "service", None), "slot", 0))
+
+    def acquire(self, file_cacher):
+        """Return a sandbox ready to be used, reusing a free one if
+        possible.
+
+        file_cacher (FileCacher): the file cacher of the sandbox.
+
+        return (Sandbox): a sandbox.
+
+        raise (OSError, IOError, SandboxInterfaceException): if the
+            sandbox cannot be created.
+
+        """
+        start = monotonic_time()
+        key = SandboxPool._key(file_cacher)
+        free = self._free.get(key, [])
+        while len(free) > 0:
+            sandbox = free.pop()
+            try:
+                sandbox.reset()
+            except (OSError, IOError, SandboxInterfaceException):
+                logger.warning("Couldn't reset sandbox in %s." %
+                               sandbox.path, exc_info=True)
+                try:
+                    self._delete(sandbox)
+                except (OSError, IOError):
+                    pass
+                continue
+            self.reused += 1
+            self.reuse_time += monotonic_time() - start
+            return sandbox
+
+        # Only sandboxes that can come back to the pool get a box of
+        # their own.
+        box_indexes = self._box_indexes.setdefault(key, set())
+        free_indexes = [box_index for box_index
+                        in xrange(1, Sandbox.get_boxes_per_slot())
+                        if box_index not in box_indexes]
+        if self.size > 0 and len(free_indexes) > 0:
+            sandbox = Sandbox(file_cacher, box_index=free_indexes[0])
+            box_indexes.add(sandbox.box_index)
+        else:
+            sandbox = Sandbox(file_cacher)
+        self.created += 1
+        self.creation_time += monotonic_time() - start
+        return sandbox
+
+    def release(self, sandbox):
+        """Take back a sandbox that is not needed anymore, keeping it
+        if there is room, or deleting it otherwise.
+
+        sandbox (Sandbox): the sandbox.
+
+        raise (OSError, IOError): if the sandbox has to be deleted,
+            but it cannot be.
+
+        """
+        key = SandboxPool._key(sandbox.file_cacher)
+        if len(self._free.get(key, [])) + self._clearing.get(key, 0) \
+                < self.size:
+            self._clearing[key] = self._clearing.get(key, 0) + 1
+            self._clearers.spawn(self._clear, key, sandbox)
+            return
+
+        start = monotonic_time()
+        self._delete(sandbox)
+        self.deleted += 1
+        self.deletion_time += monotonic_time() - start
+
+    def _delete(self, sandbox):
+        """Delete a sandbox, making its box available to the next
+        ones.
+
+        sandbox (Sandbox): the sandbox.
+
+        raise (OSError, IOError): if the sandbox cannot be deleted.
+
+        """
+        self._box_indexes.get(SandboxPool._key(sandbox.file_cacher),
+                              set()).discard(getattr(sandbox, "box_index",
+                                                     None))
+        sandbox.delete()
+
+    def _clear(self, key, sandbox):
+        """Delete the files of a released sandbox in a thread, and
+        put it among the free ones (or delete it, if this fails or if
+        the pool has been closed meanwhile).
+
+        key (tuple): the key of the sandbox.
+        sandbox (Sandbox): the sandbox.
+
+        """
+        try:
+            gevent.get_hub().threadpool.spawn(sandbox.clear).get()
+        except (OSError, IOError):
+            logger.warning("Couldn't clear sandbox in %s, deleting it." %
+                           sandbox.path, exc_info=True)
+            try:
+                self._delete(sandbox)
+            except (OSError, IOError):
+                pass
+        else:
+            if self.size > 0:
+                self._free.setdefault(key, []).append(sandbox)
+            else:
+                try:
+                    self._delete(sandbox)
+                except (OSError, IOError):
+                    pass
+        finally:
+            self._clearing[key] -= 1
+
+    def close(self):
+        """Delete all the free sandboxes (waiting for the ones being
+        cleared) and stop keeping the released ones. To be called
+        when the worker shuts down.
+
+        """
+        self.size = 0
+        self._clearers.join()
+        for free in self._free.itervalues():
+            while len(free) > 0:
+                sandbox = free.pop()
+                try:
+                    self._delete(sandbox)
+                except (OSError, IOError):
+                    logger.warning("Couldn't delete sandbox in %s." %
+                                   sandbox.path, exc_info=True)
+
+    def get_status(self):
+        """Returns the statistics of the pool.
+
+        returns (dict): how many sandboxes were created, reused and
+                        deleted, and the time spent; the time saved by
+                        each reuse, estimated from the others.
+        """
+        saved = 0.0
+        if self.reused > 0 and self.created > 0:
+            saved = self.creation_time / self.created \
+                - self.reuse_time / self.reused
+            if self.deleted > 0:
+                saved += self.deletion_time / self.deleted
+        return {'size': self.size,
+                'free': sum(len(free) for free in self._free.itervalues()),
+                'created': self.created,
+                'creation_time': self.creation_time,
+                'reused': self.reused,
+                'reuse_time': self.reuse_time,
+                'deleted': self.deleted,
+                'deletion_time': self.deletion_time,
+                'saved_per_reuse': saved}
+
+
 Sandbox = {
     'stupid': StupidSandbox,
     'isolate': IsolateSandbox,
@@ -35,6 +35,8 @@ import logging
 
 from tornado.template import Template
 
+from cms.grading import EVALUATION_SKIPPED_TEXT
+
 
 logger = logging.getLogger(__name__)
 
@@ -119,6 +121,20 @@ class ScoreType(object):
         logger.error("Unimplemented method compute_score.")
         raise NotImplementedError("Please subclass this class.")
 
+    def get_evaluation_plan(self):
+        """Return the order in which to evaluate the testcases, and
+        which of them can be left out.
+
+        return ([[str]]|None): lists of codenames of testcases, to be
+            evaluated in that order; as soon as a testcase gets outcome
+            0.0, the following ones in its list can be left without an
+            evaluation, as the score would not change (compute_score
+            must allow for that). None if all testcases must be
+            evaluated.
+
+        """
+        return None
+
 
 class ScoreTypeAlone(ScoreType):
     """Intermediate class to manage tasks where the score of a
@@ -142,6 +158,10 @@ class ScoreTypeGroup(ScoreTypeAlone):
     'reduce'.
 
     """
+    # Whether a testcase with outcome 0.0 makes the score of its whole
+    # subtask 0.0, so that the other testcases can be left out.
+    SHORT_CIRCUIT = False
+
     # Mark strings for localization.
     N_("Subtask %d")
     N_("Outcome")
@@ -214,6 +234,13 @@ class ScoreTypeGroup(ScoreTypeAlone):
                         {{ _("N/A") }}
             {% end %}
                     </td>
+        {% elif "text" in tc %}
+                <tr class="undefined">
+                    <td>{{ _("N/A") }}</td>
+                    <td>{{ format_status_text(tc["text"], _) }}</td>
+                    <td>{{ _("N/A") }}</td>
+                    <td>{{ _("N/A") }}</td>
+                </tr>
         {% else %}
                 <tr class="undefined">
                     <td colspan="4">
@@ -238,20 +265,42 @@ class ScoreTypeGroup(ScoreTypeAlone):
         public_score = 0.0
         headers = list()
 
-        # XXX Lexicographical order by codename
+        for i, (parameter, indices) in enumerate(
+                zip(self.parameters, self.get_subtask_testcases())):
+            score += parameter[0]
+            if all(self.public_testcases[idx] for idx in indices):
+                public_score += parameter[0]
+            headers += ["Subtask %d (%g)" % (i + 1, parameter[0])]
+
+        return score, public_score, headers
+
+    def get_subtask_testcases(self):
+        """Return the testcases of each subtask.
+
+        The testcases are sorted by codename and given in this order
+        to the subtasks, each one taking as many as its parameters
+        say.
+
+        return ([[str]]): the codenames of the testcases, one list
+            for each subtask.
+
+        """
         indices = sorted(self.public_testcases.keys())
+        subtasks = []
         current = 0
 
-        for i, parameter in enumerate(self.parameters):
+        for parameter in self.parameters:
             next_ = current + parameter[1]
-            score += parameter[0]
-            if all(self.public_testcases[idx]
-                   for idx in indices[current:next_]):
-                public_score += parameter[0]
-            headers += ["Subtask %d (%g)" % (i + 1, parameter[0])]
+            subtasks.append(indices[current:next_])
             current = next_
 
-        return score, public_score, headers
+        return subtasks
+
+    def get_evaluation_plan(self):
+        """See ScoreType.get_evaluation_plan."""
+        if not self.SHORT_CIRCUIT:
+            return None
+        return self.get_subtask_testcases()
 
     def compute_score(self, submission_result):
         """Compute the score of a submission.
@@ -265,39 +314,47 @@ class ScoreTypeGroup(ScoreTypeAlone):
             return 0.0, "[]", 0.0, "[]", \
                 json.dumps(["%lg" % 0.0 for _ in self.parameters])
 
-        # XXX Lexicographical order by codename
-        indices = sorted(self.public_testcases.keys())
         evaluations = dict((ev.codename, ev)
                            for ev in submission_result.evaluations)
         subtasks = []
         public_subtasks = []
         ranking_details = []
-        tc_start = 0
-        tc_end = 0
-
-        for st_idx, parameter in enumerate(self.parameters):
-            tc_end = tc_start + parameter[1]
-            st_score = self.reduce([float(evaluations[idx].outcome)
-                                    for idx in indices[tc_start:tc_end]],
-                                   parameter) * parameter[0]
-            st_public = all(self.public_testcases[idx]
-                            for idx in indices[tc_start:tc_end])
-            tc_outcomes = dict((
-                idx,
-                self.get_public_outcome(
-                    float(evaluations[idx].outcome), parameter)
-                ) for idx in indices[tc_start:tc_end])
+
+        for st_idx, (parameter, indices) in enumerate(
+                zip(self.parameters, self.get_subtask_testcases())):
+            # The testcases left out by the evaluation plan have no
+            # evaluation: this is fine only if another testcase of
+            # the subtask already decided its score.
+            outcomes = [float(evaluations[idx].outcome)
+                        for idx in indices if idx in evaluations]
+            if len(outcomes) < len(indices) and \
+                    not (self.SHORT_CIRCUIT and
+                         any(outcome <= 0.0 for outcome in outcomes)):
+                raise ValueError(
+                    "Submission result %d(%d) has no evaluation for some "
+                    "testcases of subtask %d; it must be evaluated again." %
+                    (submission_result.submission_id,
+                     submission_result.dataset_id, st_idx + 1))
+            st_score = self.reduce(outcomes, parameter) * parameter[0]
+            st_public = all(self.public_testcases[idx] for idx in indices)
 
             testcases = []
             public_testcases = []
-            for idx in indices[tc_start:tc_end]:
-                testcases.append({
-                    "idx": idx,
-                    "outcome": tc_outcomes[idx],
-                    "text": evaluations[idx].text,
-                    "time": evaluations[idx].execution_time,
-                    "memory": evaluations[idx].execution_memory,
-                    })
+            for idx in indices:
+                if idx in evaluations:
+                    testcases.append({
+                        "idx": idx,
+                        "outcome": self.get_public_outcome(
+                            float(evaluations[idx].outcome), parameter),
+                        "text": evaluations[idx].text,
+                        "time": evaluations[idx].execution_time,
+                        "memory": evaluations[idx].execution_memory,
+                        })
+                else:
+                    testcases.append({
+                        "idx": idx,
+                        "text": json.dumps(EVALUATION_SKIPPED_TEXT),
+                        })
                 if self.public_testcases[idx]:
                     public_testcases.append(testcases[-1])
                 else:
@@ -318,8 +375,6 @@ class ScoreTypeGroup(ScoreTypeAlone):
 
             ranking_details.append("%g" % round(st_score, 2))
 
-            tc_start = tc_end
-
         score = sum(st["score"] for st in subtasks)
         public_score = sum(st["score"]
                            for st in public_subtasks
@@ -36,7 +36,7 @@ import traceback
 
 from cms import config
 from cms.grading import JobException
-from cms.grading.Sandbox import Sandbox
+from cms.grading.Sandbox import SandboxPool
 from cms.grading.Job import CompilationJob, EvaluationJob
 
 
@@ -45,8 +45,14 @@ logger = logging.getLogger(__name__)
 
 ## Sandbox lifecycle. ##
 
+# The sandboxes that can be used again; disabled unless a Worker
+# enables it (setting its size).
+sandbox_pool = SandboxPool()
+
+
 def create_sandbox(file_cacher):
-    """Create a sandbox, and return it.
+    """Create a sandbox (or take one from sandbox_pool), and return
+    it.
 
     file_cacher (FileCacher): a file cacher instance.
 
@@ -56,7 +62,7 @@ def create_sandbox(file_cacher):
 
     """
     try:
-        sandbox = Sandbox(file_cacher)
+        sandbox = sandbox_pool.acquire(file_cacher)
     except (OSError, IOError):
         err_msg = "Couldn't create sandbox."
         logger.error("%s\n%s" % (err_msg, traceback.format_exc()))
@@ -65,15 +71,15 @@ def create_sandbox(file_cacher):
 
 
 def delete_sandbox(sandbox):
-    """Delete the sandbox, if the configuration allows it to be
-    deleted.
+    """Delete the sandbox (or give it back to sandbox_pool), if the
+    configuration allows it to be deleted.
 
     sandbox (Sandbox): the sandbox to delete.
 
     """
     if not config.keep_sandbox:
         try:
-            sandbox.delete()
+            sandbox_pool.release(sandbox)
         except (IOError, OSError):
             err_msg = "Couldn't delete sandbox."
             logger.warning("%s\n%s" % (err_msg, traceback.format_exc()))
@@ -27,6 +27,9 @@ import logging
 import os
 
 from collections import namedtuple
+from functools import partial
+from itertools import chain
+from string import maketrans
 
 from sqlalchemy.orm import joinedload
 
@@ -498,6 +501,13 @@ def human_evaluation_message(plus):
         return None
 
 
+# The text shown for the testcases that were not evaluated because
+# another testcase of their subtask already decided its score (see
+# ScoreType.get_evaluation_plan); they have no Evaluation.
+EVALUATION_SKIPPED_TEXT = [N_("Not executed, since another testcase "
+                              "of the subtask failed")]
+
+
 def is_evaluation_passed(plus):
     return plus['exit_status'] == Sandbox.EXIT_OK
 
@@ -595,6 +605,54 @@ def white_diff_canonicalize(string):
     return string
 
 
+# How many bytes of each file white_diff processes at a time.
+WHITE_DIFF_BLOCK_SIZE = 1024 * 1024
+
+# Translation of the whitespaces other than newlines into spaces.
+_WHITE_DIFF_SPACES = maketrans("\t\r", "  ")
+
+
+def _white_diff_canonical_blocks(blocks, started, carry):
+    """Canonicalize a file for white_diff, one block at a time.
+
+    The canonical form of a file has a single space between the
+    tokens of a line, no whitespaces at the beginning and at the end
+    of the lines, and no empty lines at the end of the file, so that
+    two files are equal for white_diff if and only if their canonical
+    forms are equal. Each block is canonicalized without looking at
+    the others, except for the whitespaces at its end, that are
+    carried to the following block (a run of whitespaces may continue
+    there, or be at the end of the file).
+
+    blocks (iterable): the contents of the file, in consecutive
+        blocks.
+    started (bool): whether a non-whitespace was already found before
+        blocks (i.e., whether blocks is not at the beginning of the
+        file).
+    carry (string): the whitespaces just before blocks.
+
+    yield (string): the canonical form of the file, in non-empty
+        consecutive chunks.
+
+    """
+    for block in blocks:
+        block = carry + block
+        stripped = block.rstrip(WHITES)
+        carry = block[len(stripped):]
+        if stripped == '':
+            continue
+        # Only string methods, as they are much faster than regular
+        # expressions (or a loop) on large blocks.
+        stripped = stripped.translate(_WHITE_DIFF_SPACES)
+        while "  " in stripped:
+            stripped = stripped.replace("  ", " ")
+        stripped = stripped.replace(" \n", "\n").replace("\n ", "\n")
+        if not started:
+            stripped = stripped.lstrip(" ")
+            started = True
+        yield stripped
+
+
 def white_diff(output, res):
     """Compare the two output files. Two files are equal if for every
     integer i, line i of first file is equal to line i of second
@@ -606,34 +664,58 @@ def white_diff(output, res):
     'sequence of characters ending with \n or EOF and beginning right
     after BOF or \n'. In particular, every line has *at most* one \n.
 
+    The files are read in blocks of WHITE_DIFF_BLOCK_SIZE bytes: as
+    long as they are identical, they are just compared byte by byte;
+    from the first difference on, their canonical forms are compared
+    (see _white_diff_canonical_blocks), stopping at the first
+    mismatch.
+
     output (file): the first file to compare.
     res (file): the second file to compare.
     return (bool): True if the two file are equal as explained above.
 
     """
+    # The state of the canonicalization of the common prefix.
+    started = False
+    carry = ''
 
     while True:
-        lout = output.readline()
-        lres = res.readline()
-
-        # Both files finished: comparison succeded
-        if lres == '' and lout == '':
+        block_out = output.read(WHITE_DIFF_BLOCK_SIZE)
+        block_res = res.read(WHITE_DIFF_BLOCK_SIZE)
+        if block_out != block_res:
+            break
+        if block_out == '':
             return True
-
-        # Only one file finished: ok if the other contains only blanks
-        elif lres == '' or lout == '':
-            lout = lout.strip(WHITES)
-            lres = lres.strip(WHITES)
-            if lout != '' or lres != '':
-                return False
-
-        # Both file still have lines to go: ok if they agree except
-        # for the number of whitespaces
+        stripped = block_out.rstrip(WHITES)
+        if stripped != '':
+            started = True
+            carry = block_out[len(stripped):]
         else:
-            lout = white_diff_canonicalize(lout)
-            lres = white_diff_canonicalize(lres)
-            if lout != lres:
-                return False
+            carry += block_out
+
+    canonical_out = _white_diff_canonical_blocks(
+        chain([block_out], iter(partial(output.read,
+                                        WHITE_DIFF_BLOCK_SIZE), '')),
+        started, carry)
+    canonical_res = _white_diff_canonical_blocks(
+        chain([block_res], iter(partial(res.read,
+                                        WHITE_DIFF_BLOCK_SIZE), '')),
+        started, carry)
+
+    chunk_out = ''
+    chunk_res = ''
+    while True:
+        if chunk_out == '':
+            chunk_out = next(canonical_out, None)
+        if chunk_res == '':
+            chunk_res = next(canonical_res, None)
+        if chunk_out is None or chunk_res is None:
+            return chunk_out is None and chunk_res is None
+        length = min(len(chunk_out), len(chunk_res))
+        if chunk_out[:length] != chunk_res[:length]:
+            return False
+        chunk_out = chunk_out[length:]
+        chunk_res = chunk_res[length:]
 
 
 def white_diff_step(sandbox, output_filename,
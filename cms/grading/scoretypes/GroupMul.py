@@ -34,6 +34,7 @@ class GroupMul(ScoreTypeGroup):
     Parameters are [[m, t], ... ] (see ScoreTypeGroup).
 
     """
+    SHORT_CIRCUIT = True
 
     def get_public_outcome(self, outcome, parameter):
         """See ScoreTypeGroup."""
@@ -228,6 +228,8 @@ class BaseHandler(CommonRequestHandler):
                 .count()  # noqa
         params["contest_list"] = self.sql_session.query(Contest).all()
         params["cookie"] = str(self.cookies)
+        params["evaluation_shards"] = \
+            len(self.application.service.evaluation_services)
         return params
 
     def finish(self, *args, **kwds):
@@ -465,8 +467,10 @@ class AdminWebServer(WebService):
         self.notifications = []
 
         self.file_cacher = FileCacher(self)
-        self.evaluation_service = self.connect_to(
-            ServiceCoord("EvaluationService", 0))
+        self.evaluation_services = []
+        for i in xrange(get_service_shards("EvaluationService")):
+            self.evaluation_services.append(self.connect_to(
+                ServiceCoord("EvaluationService", i)))
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
         self.proxy_service = self.connect_to(
@@ -1151,7 +1155,9 @@ class ActivateDatasetHandler(BaseHandler):
 
             # This kicks off judging of any submissions which were previously
             # unloved, but are now part of an autojudged taskset.
-            self.application.service.evaluation_service.search_jobs_not_done()
+            for evaluation_service in \
+                    self.application.service.evaluation_services:
+                evaluation_service.search_jobs_not_done()
             self.application.service.scoring_service.search_jobs_not_done()
 
         # Now send notifications to contestants.
@@ -1195,7 +1201,9 @@ class ToggleAutojudgeDatasetHandler(BaseHandler):
 
             # This kicks off judging of any submissions which were previously
             # unloved, but are now part of an autojudged taskset.
-            self.application.service.evaluation_service.search_jobs_not_done()
+            for evaluation_service in \
+                    self.application.service.evaluation_services:
+                evaluation_service.search_jobs_not_done()
             self.application.service.scoring_service.search_jobs_not_done()
 
         self.redirect("/task/%s" % dataset.task_id)
@@ -59,12 +59,14 @@ from sqlalchemy import func
 from werkzeug.http import parse_accept_header
 from werkzeug.datastructures import LanguageAccept
 
-from cms import SOURCE_EXT_TO_LANGUAGE_MAP, config, ServiceCoord
+from cms import SOURCE_EXT_TO_LANGUAGE_MAP, config, ServiceCoord, \
+    get_service_shards
 from cms.io import WebService
 from cms.db import Session, Contest, User, Task, Question, Submission, Token, \
     File, UserTest, UserTestFile, UserTestManager
 from cms.db.filecacher import FileCacher
 from cms.grading.tasktypes import get_task_type
+from cms.service import get_evaluation_shard, LANE_LIVE, LANE_TEST
 from cms.grading.scoretypes import get_score_type
 from cms.server import file_handler_gen, extract_archive, \
     actual_phase_required, get_url_root, filter_ascii, \
@@ -425,13 +427,29 @@ class ContestWebServer(WebService):
         self.notifications = {}
 
         self.file_cacher = FileCacher(self)
-        self.evaluation_service = self.connect_to(
-            ServiceCoord("EvaluationService", 0))
+        # Submissions and user tests are sent to the shard of
+        # EvaluationService that owns them.
+        self.evaluation_services = []
+        for i in xrange(get_service_shards("EvaluationService")):
+            self.evaluation_services.append(self.connect_to(
+                ServiceCoord("EvaluationService", i)))
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
         self.proxy_service = self.connect_to(
             ServiceCoord("ProxyService", 0))
 
+        # The last load of the queue reported by each shard of
+        # EvaluationService (see EvaluationService.queue_load), or
+        # None if unknown.
+        self.queue_loads = [None] * len(self.evaluation_services)
+        self.add_timeout(self.check_queue_load, None,
+                         ContestWebServer.QUEUE_LOAD_CHECK_TIME
+                         .total_seconds(),
+                         immediately=True)
+
+    # How often we ask EvaluationService for the load of its queue.
+    QUEUE_LOAD_CHECK_TIME = timedelta(seconds=10)
+
     NOTIFICATION_ERROR = "error"
     NOTIFICATION_WARNING = "warning"
     NOTIFICATION_SUCCESS = "success"
@@ -451,6 +469,43 @@ class ContestWebServer(WebService):
             self.notifications[username] = []
         self.notifications[username].append((timestamp, subject, text, level))
 
+    def check_queue_load(self):
+        """Ask every shard of EvaluationService for the load of its
+        queue.
+
+        """
+        for shard, evaluation_service in \
+                enumerate(self.evaluation_services):
+            if evaluation_service.connected:
+                evaluation_service.queue_load(
+                    callback=self.queue_load_callback, plus=shard)
+            else:
+                self.queue_loads[shard] = None
+        return True
+
+    def queue_load_callback(self, data, shard, error=None):
+        """Callback for check_queue_load.
+
+        """
+        self.queue_loads[shard] = data if error is None else None
+
+    def estimated_wait(self, lane):
+        """Return how long a new job in the given lane of the queue of
+        EvaluationService is expected to take, in the worst case among
+        the shards.
+
+        lane (string): one of cms.service.LANE_*.
+
+        return (float): the estimated wait in seconds, or None if
+            unknown.
+
+        """
+        waits = [queue_load[lane]["estimated_wait"]
+                 for queue_load in self.queue_loads
+                 if queue_load is not None
+                 and queue_load[lane]["estimated_wait"] is not None]
+        return max(waits) if len(waits) > 0 else None
+
 
 class MainHandler(BaseHandler):
     """Home page handler.
@@ -598,7 +653,10 @@ class TaskSubmissionsHandler(BaseHandler):
             .filter(Submission.task == task).all()
 
         self.render("task_submissions.html",
-                    task=task, submissions=submissions, **self.r_params)
+                    task=task, submissions=submissions,
+                    estimated_wait=self.application.service.estimated_wait(
+                        LANE_LIVE),
+                    **self.r_params)
 
 
 class TaskStatementViewHandler(FileHandler):
@@ -1113,8 +1171,9 @@ class SubmitHandler(BaseHandler):
             self.sql_session.add(File(filename, digest, submission=submission))
         self.sql_session.add(submission)
         self.sql_session.commit()
-        self.application.service.evaluation_service.new_submission(
-            submission_id=submission.id)
+        self.application.service.evaluation_services[
+            get_evaluation_shard(submission.id)].new_submission(
+                submission_id=submission.id)
         self.application.service.add_notification(
             self.current_user.username,
             self.timestamp,
@@ -1326,7 +1385,10 @@ class UserTestInterfaceHandler(BaseHandler):
             default_task = self.contest.tasks[0]
 
         self.render("test_interface.html", default_task=default_task,
-                    user_tests=user_tests, **self.r_params)
+                    user_tests=user_tests,
+                    estimated_wait=self.application.service.estimated_wait(
+                        LANE_TEST),
+                    **self.r_params)
 
 
 class UserTestHandler(BaseHandler):
@@ -1354,6 +1416,25 @@ class UserTestHandler(BaseHandler):
         # Alias for easy access
         contest = self.contest
 
+        # Refuse user tests when the workers are overloaded, to give
+        # precedence to submissions.
+        estimated_wait = self.application.service.estimated_wait(LANE_TEST)
+        if config.max_user_test_wait is not None and \
+                estimated_wait is not None and \
+                estimated_wait > config.max_user_test_wait:
+            logger.info("Refused test of user %s because of an estimated "
+                        "wait of %d seconds." %
+                        (self.current_user.username, estimated_wait))
+            self.application.service.add_notification(
+                self.current_user.username,
+                self.timestamp,
+                self._("Too many tests!"),
+                self._("The evaluation system is overloaded at the "
+                       "moment; please try again in a few minutes."),
+                ContestWebServer.NOTIFICATION_ERROR)
+            self.redirect("/testing?%s" % quote(task.name, safe=''))
+            return
+
         # Enforce maximum number of user_tests
         try:
             if contest.max_user_test_number is not None:
@@ -1645,8 +1726,9 @@ class UserTestHandler(BaseHandler):
 
         self.sql_session.add(user_test)
         self.sql_session.commit()
-        self.application.service.evaluation_service.new_user_test(
-            user_test_id=user_test.id)
+        self.application.service.evaluation_services[
+            get_evaluation_shard(user_test.id)].new_user_test(
+                user_test_id=user_test.id)
         self.application.service.add_notification(
             self.current_user.username,
             self.timestamp,
@@ -51,3 +51,42 @@ function cmsrpc_request (service, shard, method, arguments, callback) {
         callback(data);
     });
 };
+
+/**
+ * Call a RPC method on all the shards of a remote service, proxied by
+ * AWS, and collect the results in a single response.
+ *
+ * The response passed to the callback has status "ok" only if all
+ * shards answered successfully (otherwise it has the status of the
+ * first failed request), and its data is the list of the data
+ * returned by each shard, in shard order.
+ *
+ * service: the name of the remote Service.
+ * shards: the number of shards of the remote Service.
+ * method: the name of the method.
+ * arguments: the keyword arguments (as an Object).
+ * callback: a function to call with the collected result.
+ */
+function cmsrpc_request_all (service, shards, method, arguments, callback) {
+    var result = {"status": "ok", "data": []};
+    var pending = shards;
+    if (pending == 0) {
+        callback(result);
+        return;
+    }
+    var make_callback = function (shard) {
+        return function (data) {
+            if (data["status"] != "ok" && result["status"] == "ok") {
+                result["status"] = data["status"];
+            }
+            result["data"][shard] = data["data"];
+            pending -= 1;
+            if (pending == 0) {
+                callback(result);
+            }
+        };
+    };
+    for (var i = 0; i < shards; i++) {
+        cmsrpc_request(service, i, method, arguments, make_callback(i));
+    }
+};
@@ -29,17 +29,31 @@ current ranking.
 
 """
 
+import bisect
+import errno
+import io
+import json
 import logging
+import os
 import random
 from datetime import timedelta
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
-from cms import ServiceCoord, get_service_shards
+import gevent
+from gevent.event import Event
+
+from sqlalchemy import and_, or_, func, case
+
+from cms import ServiceCoord, config, get_service_shards
+from cms.util import mkdir
 from cms.io import Service, rpc_method
-from cms.db import SessionGen, Contest, Dataset, Submission, \
-    SubmissionResult, UserTest, UserTestResult
-from cms.service import get_submission_results, get_datasets_to_judge
+from cms.db import SessionGen, Task, Dataset, Submission, \
+    SubmissionResult, UserTest, UserTestResult, Executable
+from cms.service import get_submission_results, get_datasets_to_judge, \
+    get_evaluation_shard, LANE_LIVE, LANE_TEST, LANE_BULK
 from cmscommon.datetime import make_datetime, make_timestamp
+from cms.grading import human_evaluation_message
+from cms.grading.Sandbox import Sandbox
 from cms.grading.Job import JobGroup
 
 
@@ -102,11 +116,55 @@ def user_test_to_evaluate(user_test_result):
         r.evaluation_tries < EvaluationService.MAX_TEST_EVALUATION_TRIES
 
 
+def submission_result_status(submission_result):
+    """Return the status of a submission result, as counted by
+    EvaluationService.submissions_status.
+
+    submission_result (SubmissionResult): a submission result.
+
+    return (string): one of "compilation_fail", "compiling",
+        "max_compilations", "scored", "evaluated", "evaluating",
+        "max_evaluations" and "invalid".
+
+    """
+    r = submission_result
+    if r.compilation_failed():
+        return "compilation_fail"
+    elif not r.compiled():
+        if r.compilation_tries >= EvaluationService.MAX_COMPILATION_TRIES:
+            return "max_compilations"
+        else:
+            return "compiling"
+    elif r.compilation_succeeded():
+        if r.evaluated():
+            if r.scored():
+                return "scored"
+            else:
+                return "evaluated"
+        else:
+            if r.evaluation_tries >= EvaluationService.MAX_EVALUATION_TRIES:
+                return "max_evaluations"
+            else:
+                return "evaluating"
+    else:
+        # Should not happen.
+        return "invalid"
+
+
 # job_type is a constant defined in EvaluationService.
 JobQueueEntry = namedtuple('JobQueueEntry',
                            ['job_type', 'object_id', 'dataset_id'])
 
 
+class JobGoneError(LookupError):
+    """Raised when a job is not to be given to a worker anymore (it
+    left the queue, or it finished) while it was loaded from the
+    database.
+
+    """
+    pass
+
+
 class JobQueue(object):
     """An instance of this class will contains the (unique) priority
     queue of jobs (compilations, evaluations, ...) that the ES needs
@@ -114,17 +172,53 @@ class JobQueue(object):
 
     The queue is implemented as a custom min-heap.
 
+    If the queue is fair, jobs with the same priority are served
+    round-robin among the users they belong to, instead of strictly
+    by timestamp: the n-th job of a user waiting in the queue at a
+    given priority is put in the n-th round (counting from the one
+    currently being served), and the rounds are served in order.
+    Hence a user submitting many times in a burst does not delay the
+    other users more than by a single job.
+
+    If the queue is longest first, jobs in the same round are served
+    in decreasing order of their estimated cost instead of by
+    timestamp, which keeps the time needed to finish a large batch of
+    jobs close to the minimum (the long jobs do not remain alone at
+    the end, keeping few workers busy while the others are idle).
+
     """
 
-    def __init__(self):
+    def __init__(self, fair=False, longest_first=False):
+        """fair (bool): whether to serve the users round-robin.
+        longest_first (bool): whether to serve the costliest jobs
+            first.
+
+        """
+        self._fair = fair
+        self._longest_first = longest_first
+
         # The queue: a min-heap whose elements are of the form
-        # (priority, timestamp, job), where job is the actual data.
+        # (priority, round, -cost, timestamp, job), where job is the
+        # actual data, round is always 0 if the queue is not fair and
+        # cost is always 0 if it is not longest first.
         self._queue = []
 
+        # The estimated cost of each job in the queue.
+        self._cost = {}
+
         # Reverse lookup for the jobs in the queue: a dictionary
         # associating the index in the queue to each job.
         self._reverse = {}
 
+        # The user of each job in the queue (None if unknown); the
+        # number of jobs and the last round of each user, for each
+        # priority (indexed by (priority, user)); the round being
+        # served, for each priority.
+        self._user = {}
+        self._user_jobs = {}
+        self._user_round = {}
+        self._round = {}
+
     def __contains__(self, job):
         """Implement the 'in' operator for a job in the queue.
 
@@ -145,8 +239,8 @@ class JobQueue(object):
         """
         self._queue[idx1], self._queue[idx2] = \
             self._queue[idx2], self._queue[idx1]
-        self._reverse[self._queue[idx1][2]] = idx1
-        self._reverse[self._queue[idx2][2]] = idx2
+        self._reverse[self._queue[idx1][4]] = idx1
+        self._reverse[self._queue[idx2][4]] = idx2
 
     def _up_heap(self, idx):
         """Take the element in position idx up in the heap until its
@@ -200,18 +294,64 @@ class JobQueue(object):
         idx = self._up_heap(idx)
         return self._down_heap(idx)
 
-    def push(self, job, priority, timestamp=None):
+    def _assign_round(self, job, priority):
+        """Compute the round of a job entering the queue (or changing
+        priority), and account it to its user.
+
+        job (JobQueueEntry): the job.
+        priority (int): the priority of the job.
+
+        return (int): the round of the job.
+
+        """
+        if not self._fair:
+            return 0
+        round_ = self._round.get(priority, 0)
+        user = self._user[job]
+        if user is None:
+            return round_
+        key = (priority, user)
+        if key in self._user_round:
+            round_ = max(round_, self._user_round[key] + 1)
+        self._user_round[key] = round_
+        self._user_jobs[key] = self._user_jobs.get(key, 0) + 1
+        return round_
+
+    def _release_round(self, job, priority):
+        """Forget a job leaving the queue (or changing priority) in
+        the accounting of its user.
+
+        job (JobQueueEntry): the job.
+        priority (int): the priority the job had.
+
+        """
+        key = (priority, self._user[job])
+        if key in self._user_jobs:
+            self._user_jobs[key] -= 1
+            if self._user_jobs[key] == 0:
+                del self._user_jobs[key]
+                del self._user_round[key]
+
+    def push(self, job, priority, timestamp=None, user=None, cost=0.0):
         """Push a job in the queue. If timestamp is not specified,
         uses the current time.
 
         job (JobQueueEntry): the job to add to the queue.
         priority (int): the priority of the job.
         timestamp (datetime): the time of the submission.
+        user (int): the id of the user the job belongs to, or None if
+            unknown (the job is then considered on its own).
+        cost (float): the estimated time (in seconds) a worker will
+            need to do the job.
 
         """
         if timestamp is None:
             timestamp = make_datetime()
-        self._queue.append((priority, timestamp, job))
+        self._user[job] = user
+        self._cost[job] = cost
+        self._queue.append((priority, self._assign_round(job, priority),
+                            -cost if self._longest_first else 0.0,
+                            timestamp, job))
         last = len(self._queue) - 1
         self._reverse[job] = last
         self._up_heap(last)
@@ -227,7 +367,8 @@ class JobQueue(object):
 
         """
         if len(self._queue) > 0:
-            return self._queue[0]
+            priority, _, _, timestamp, job = self._queue[0]
+            return priority, timestamp, job
         else:
             raise LookupError("Empty queue.")
 
@@ -241,26 +382,32 @@ class JobQueue(object):
 
         """
         top = self.top()
+        priority, round_, _, _, job = self._queue[0]
         last = len(self._queue) - 1
         self._swap(0, last)
 
-        del self._reverse[top[2]]
+        del self._reverse[job]
         del self._queue[last]
         if last > 0:
             self._down_heap(0)
+        self._round[priority] = max(self._round.get(priority, 0), round_)
+        self._release_round(job, priority)
+        del self._user[job]
+        del self._cost[job]
         return top
 
-    def remove(self, job):
+    def remove(self, job, served=False):
         """Remove a job from the queue. Raise a KeyError if not present.
 
         job (JobQueueEntry): the job to remove.
-
-        return (int, int, job): priority, timestamp, and job.
+        served (bool): whether the job leaves the queue because it is
+            being served (as with pop), and not because it is dropped.
 
         raise (KeyError): if job not present.
 
         """
         pos = self._reverse[job]
+        priority, round_ = self._queue[pos][:2]
         last = len(self._queue) - 1
         self._swap(pos, last)
 
@@ -268,6 +415,12 @@ class JobQueue(object):
         del self._queue[last]
         if pos != last:
             self._updown_heap(pos)
+        if served:
+            self._round[priority] = max(self._round.get(priority, 0),
+                                        round_)
+        self._release_round(job, priority)
+        del self._user[job]
+        del self._cost[job]
 
     def set_priority(self, job, priority):
         """Change the priority of a job inside the queue. Raises an
@@ -280,9 +433,12 @@ class JobQueue(object):
 
         """
         pos = self._reverse[job]
+        self._release_round(job, self._queue[pos][0])
         self._queue[pos] = (priority,
-                            self._queue[pos][1],
-                            self._queue[pos][2])
+                            self._assign_round(job, priority),
+                            self._queue[pos][2],
+                            self._queue[pos][3],
+                            self._queue[pos][4])
         self._updown_heap(pos)
 
     def length(self):
@@ -304,16 +460,844 @@ class JobQueue(object):
         be not correct, but the first element is the one at the top.
 
         returns (list): a list of dictionary containing the
-                        representation of the job, the priority and
-                        the timestamp.
+                        representation of the job, the priority,
+                        the timestamp and the user.
         """
         ret = []
         for data in self._queue:
-            ret.append({'job': data[2],
+            ret.append({'job': data[4],
                         'priority': data[0],
-                        'timestamp': make_timestamp(data[1])})
+                        'timestamp': make_timestamp(data[3]),
+                        'user': self._user[data[4]]})
         return ret
 
+    def get_cost(self):
+        """Returns the estimated total and maximum cost of the jobs in
+        the queue.
+
+        returns ((float, float)): the sum and the maximum (0.0 if the
+                                  queue is empty) of the costs.
+        """
+        return (sum(self._cost.itervalues()),
+                max(self._cost.itervalues()) if self._cost else 0.0)
+
+    def get_users_status(self):
+        """Returns how many jobs of each user are in the queue.
+
+        returns (dict): the number of jobs in the queue of each user
+                        (jobs whose user is unknown are not counted).
+        """
+        ret = {}
+        for user in self._user.itervalues():
+            if user is not None:
+                ret[user] = ret.get(user, 0) + 1
+        return ret
+
+
+class LaneJobQueue(object):
+    """A queue of jobs divided in lanes, each being a JobQueue, that
+    share the workers according to their weights.
+
+    Every job belongs to exactly one lane, and inside a lane jobs are
+    ordered as in JobQueue. Lanes are served using weighted fair
+    queuing (stride scheduling): each lane has a virtual time, which
+    advances by the inverse of the weight of the lane every time a
+    job is extracted from it, and the next job comes from the
+    non-empty lane with the smallest virtual time. Hence, when all
+    lanes have jobs waiting, each of them gets a number of workers
+    proportional to its weight, and the share of an empty lane goes
+    to the others.
+
+    """
+
+    def __init__(self, lanes, fair=False, longest_first=()):
+        """lanes ([(string, float)]): the names of the lanes with their
+            weights; ties are broken in favour of the lanes coming
+            first.
+        fair (bool): whether each lane serves its users round-robin
+            (see JobQueue).
+        longest_first ([string]): the lanes serving the costliest
+            jobs first (see JobQueue).
+
+        """
+        self._names = [name for name, _ in lanes]
+        self._weights = dict(lanes)
+        self._lanes = dict((name, JobQueue(fair, name in longest_first))
+                           for name in self._names)
+
+        # The virtual time of each lane, and the one of the last lane
+        # served (used to make a lane that was empty start again from
+        # the present, not from its past).
+        self._pass = dict((name, 0.0) for name in self._names)
+        self._virtual_time = 0.0
+
+        # The lane of each job in the queue, and when it entered it.
+        self._lane_of = {}
+        self._push_time = {}
+
+    def __contains__(self, job):
+        """Implement the 'in' operator for a job in the queue.
+
+        job (JobQueueEntry): a job to search.
+
+        return (bool): True if job is in the queue.
+
+        """
+        return job in self._lane_of
+
+    def _next_lane(self):
+        """Return the lane from which the next job has to be taken.
+
+        return (string): the name of the lane.
+
+        raise (LookupError): on empty queue.
+
+        """
+        best = None
+        for name in self._names:
+            if not self._lanes[name].empty() and \
+                    (best is None or self._pass[name] < self._pass[best]):
+                best = name
+        if best is None:
+            raise LookupError("Empty queue.")
+        return best
+
+    def push(self, job, priority, timestamp=None, lane=None, user=None,
+             cost=0.0):
+        """Push a job in a lane of the queue. If timestamp is not
+        specified, uses the current time.
+
+        job (JobQueueEntry): the job to add to the queue.
+        priority (int): the priority of the job.
+        timestamp (datetime): the time of the submission.
+        lane (string): the lane of the job, or None for the first.
+        user (int): the id of the user the job belongs to, or None.
+        cost (float): the estimated time (in seconds) a worker will
+            need to do the job.
+
+        """
+        if lane is None:
+            lane = self._names[0]
+        if self._lanes[lane].empty():
+            self._pass[lane] = max(self._pass[lane], self._virtual_time)
+        self._lanes[lane].push(job, priority, timestamp, user, cost)
+        self._lane_of[job] = lane
+        self._push_time[job] = make_datetime()
+
+    def top(self):
+        """Returns the first element in the queue without extracting
+        it. If the queue is empty raises an exception.
+
+        returns ((int, datetime, JobQueueEntry)): first element in the
+            queue.
+
+        raise (LookupError): on empty queue.
+
+        """
+        return self._lanes[self._next_lane()].top()
+
+    def pop(self):
+        """Extracts (and returns) the first element in the queue.
+
+        returns ((int, datetime, JobQueueEntry)): first element in the
+            queue.
+
+        raise (LookupError): on empty queue.
+
+        """
+        lane = self._next_lane()
+        top = self._lanes[lane].pop()
+        self._virtual_time = self._pass[lane]
+        self._pass[lane] += 1.0 / self._weights[lane]
+        del self._lane_of[top[2]]
+        del self._push_time[top[2]]
+        return top
+
+    def remove(self, job, served=False):
+        """Remove a job from the queue. Raise a KeyError if not present.
+
+        job (JobQueueEntry): the job to remove.
+        served (bool): whether the job leaves the queue because it is
+            being served (as with pop), and hence is accounted to its
+            lane, and not because it is dropped.
+
+        raise (KeyError): if job not present.
+
+        """
+        lane = self._lane_of[job]
+        self._lanes[lane].remove(job, served)
+        if served:
+            self._virtual_time = self._pass[lane]
+            self._pass[lane] += 1.0 / self._weights[lane]
+        del self._lane_of[job]
+        del self._push_time[job]
+
+    def set_priority(self, job, priority):
+        """Change the priority of a job inside its lane. Raises an
+        exception if the job is not in the queue.
+
+        job (JobQueueEntry): the job whose priority needs to change.
+        priority (int): the new priority.
+
+        raise (LookupError): if job not present.
+
+        """
+        self._lanes[self._lane_of[job]].set_priority(job, priority)
+
+    def length(self, lane=None):
+        """Returns the number of elements in the queue, or in a lane.
+
+        lane (string): the lane, or None for the whole queue.
+
+        returns (int): length of the queue
+        """
+        if lane is not None:
+            return self._lanes[lane].length()
+        return len(self._lane_of)
+
+    def empty(self):
+        """Returns if the queue is empty.
+
+        returns (bool): is the queue empty?
+        """
+        return self.length() == 0
+
+    def get_status(self):
+        """Returns the content of the queue, lane by lane (see
+        JobQueue.get_status).
+
+        returns (list): a list of dictionary containing the
+                        representation of the job, the priority, the
+                        timestamp and the lane.
+        """
+        ret = []
+        for name in self._names:
+            for item in self._lanes[name].get_status():
+                item['lane'] = name
+                ret.append(item)
+        return ret
+
+    def get_lanes_status(self):
+        """Returns the length of each lane, and for how long the jobs
+        in it have been waiting.
+
+        returns (dict): for each lane, a dictionary with its weight,
+                        its length, the maximum and average time (in
+                        seconds) spent in the queue by its jobs, and
+                        their total and maximum estimated cost.
+        """
+        now = make_datetime()
+        ret = dict((name, {'weight': self._weights[name],
+                           'length': self._lanes[name].length(),
+                           'max_wait': 0.0,
+                           'avg_wait': 0.0,
+                           'cost': self._lanes[name].get_cost()[0],
+                           'max_cost': self._lanes[name].get_cost()[1]})
+                   for name in self._names)
+        for job, lane in self._lane_of.iteritems():
+            wait = (now - self._push_time[job]).total_seconds()
+            ret[lane]['max_wait'] = max(ret[lane]['max_wait'], wait)
+            ret[lane]['avg_wait'] += wait / ret[lane]['length']
+        return ret
+
+    def get_estimated_waits(self, throughput):
+        """Returns how long a job entering each lane would wait,
+        given the jobs already in the queue.
+
+        throughput (float): how many jobs are extracted from the
+            queue per second.
+
+        returns (dict): for each lane, a dictionary with its length
+                        and the estimated time (in seconds) before a
+                        new job in it is completed.
+        """
+        busy_weight = sum(self._weights[name] for name in self._names
+                          if not self._lanes[name].empty())
+        ret = {}
+        for name in self._names:
+            length = self._lanes[name].length()
+            # The share of the workers the lane would get.
+            share = self._weights[name] / \
+                (busy_weight + (self._weights[name] if length == 0 else 0))
+            ret[name] = {'length': length,
+                         'estimated_wait': (length + 1) / (throughput * share)}
+        return ret
+
+    def get_users_status(self):
+        """Returns how many jobs of each user are in the queue (see
+        JobQueue.get_users_status).
+
+        returns (dict): the number of jobs in the queue of each user.
+        """
+        ret = {}
+        for name in self._names:
+            for user, count in \
+                    self._lanes[name].get_users_status().iteritems():
+                ret[user] = ret.get(user, 0) + count
+        return ret
+
+
+class LatencyHistogram(object):
+    """A histogram of durations, with buckets of exponentially
+    growing size, used to keep track of the latencies of the jobs.
+
+    """
+
+    # Upper bounds (in seconds) of the buckets; the last bucket holds
+    # the durations longer than the last bound.
+    BOUNDS = [0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0, 30.0, 100.0, 300.0,
+              1000.0]
+
+    def __init__(self):
+        self._counts = [0] * (len(LatencyHistogram.BOUNDS) + 1)
+        self._sum = 0.0
+        self._max = 0.0
+
+    def add(self, seconds):
+        """Record a duration.
+
+        seconds (float): the duration.
+
+        """
+        self._counts[bisect.bisect_left(LatencyHistogram.BOUNDS,
+                                        seconds)] += 1
+        self._sum += seconds
+        self._max = max(self._max, seconds)
+
+    def get_status(self):
+        """Returns the content of the histogram.
+
+        returns (dict): the upper bounds of the buckets, the number
+                        of durations in each of them (one more than
+                        the bounds), and their sum and maximum.
+        """
+        return {'bounds': LatencyHistogram.BOUNDS,
+                'counts': self._counts,
+                'sum': self._sum,
+                'max': self._max}
+
+
+class CostModel(object):
+    """Estimates of the time a worker needs to do a job, based on the
+    number of testcases and time limit of the dataset, and on the
+    average time per testcase of the previous evaluations of the same
+    user on the same task (or of all users, if there are none yet).
+
+    It also keeps the average time the workers took per job (i.e.,
+    per testcase for evaluations) for each type of job and dataset,
+    used to detect the jobs taking too long (see WorkerPool).
+
+    """
+
+    # Weight of the last evaluation in the average times.
+    DECAY = 0.3
+
+    # Estimated cost of a compilation, and of an evaluation on a
+    # dataset that we cannot find.
+    COMPILATION_COST = 1.0
+    DEFAULT_COST = 1.0
+
+    # How long we keep the information on a dataset before loading
+    # it again, as the admins may change it.
+    DATASET_TTL = timedelta(seconds=300)
+
+    def __init__(self):
+        # The time we loaded it, the task id, the number of testcases
+        # and the time limit of each dataset we saw.
+        self._datasets = {}
+
+        # The average time per testcase, indexed by (task_id,
+        # user_id) and by task_id.
+        self._user_time = {}
+        self._task_time = {}
+
+        # The average time taken by a worker per job, indexed by
+        # (job_type, dataset_id).
+        self._job_time = {}
+
+    def _get_dataset(self, dataset_id):
+        """Return the information on a dataset used by the estimates.
+
+        dataset_id (int): the id of the dataset.
+
+        return ((int, int, float)): the id of the task, the number of
+            testcases and the time limit (or None) of the dataset, or
+            None if the dataset does not exist.
+
+        """
+        info = self._datasets.get(dataset_id)
+        if info is None or \
+                make_datetime() - info[0] > CostModel.DATASET_TTL:
+            with SessionGen() as session:
+                dataset = Dataset.get_from_id(dataset_id, session)
+                if dataset is None:
+                    self._datasets.pop(dataset_id, None)
+                    return None
+                info = (make_datetime(), dataset.task_id,
+                        len(dataset.testcases), dataset.time_limit)
+            self._datasets[dataset_id] = info
+        return info[1:]
+
+    def forget_dataset(self, dataset_id=None):
+        """Forget the information on a dataset (e.g., because it was
+        changed), so that it is loaded again when needed.
+
+        dataset_id (int): the id of the dataset, or None for all.
+
+        """
+        if dataset_id is None:
+            self._datasets.clear()
+            self._job_time.clear()
+        else:
+            self._datasets.pop(dataset_id, None)
+            for key in self._job_time.keys():
+                if key[1] == dataset_id:
+                    del self._job_time[key]
+
+    def estimate(self, job, user_id):
+        """Return the estimated cost of a job.
+
+        job (JobQueueEntry): the job.
+        user_id (int): the id of the owner of the job, or None.
+
+        return (float): the estimated time (in seconds) needed by a
+            worker to do the job.
+
+        """
+        if job.job_type in (EvaluationService.JOB_TYPE_COMPILATION,
+                            EvaluationService.JOB_TYPE_TEST_COMPILATION):
+            return CostModel.COMPILATION_COST
+        dataset = self._get_dataset(job.dataset_id)
+        if dataset is None:
+            return CostModel.DEFAULT_COST
+        task_id, testcases, time_limit = dataset
+        if job.job_type == EvaluationService.JOB_TYPE_TEST_EVALUATION:
+            testcases = 1
+        time = self._user_time.get(
+            (task_id, user_id),
+            self._task_time.get(task_id, time_limit
+                                if time_limit is not None else 1.0))
+        if time_limit is not None:
+            time = min(time, time_limit)
+        return testcases * time
+
+    def record(self, task_id, user_id, job_group):
+        """Update the average times with the result of an evaluation.
+
+        task_id (int): the id of the task of the evaluation.
+        user_id (int): the id of the owner of the evaluation.
+        job_group (JobGroup): the evaluation, as done by the workers.
+
+        """
+        times = [job.plus.get('execution_wall_clock_time')
+                 for job in job_group.jobs.itervalues()
+                 if job.plus is not None and
+                 job.plus.get('execution_wall_clock_time') is not None]
+        if times == []:
+            return
+        time = sum(times) / len(times)
+        for averages, key in [(self._user_time, (task_id, user_id)),
+                              (self._task_time, task_id)]:
+            if key in averages:
+                averages[key] += CostModel.DECAY * (time - averages[key])
+            else:
+                averages[key] = time
+
+    def get_job_time(self, job):
+        """Return the average time a worker took per job (i.e., per
+        testcase for evaluations) for the job groups of the same type
+        and dataset as a job.
+
+        job (JobQueueEntry): the job.
+
+        return (float): the time in seconds, or None if we have no
+            data yet.
+
+        """
+        return self._job_time.get((job.job_type, job.dataset_id))
+
+    def record_job_time(self, job, seconds):
+        """Update the average time per job with the one of a job group
+        just done by a worker.
+
+        job (JobQueueEntry): the job.
+        seconds (float): the time the worker took per job.
+
+        """
+        key = (job.job_type, job.dataset_id)
+        if key in self._job_time:
+            self._job_time[key] += CostModel.DECAY * \
+                (seconds - self._job_time[key])
+        else:
+            self._job_time[key] = seconds
+
+
+class ResultCache(object):
+    """The results of the last jobs, indexed by everything that
+    determines them, to reuse them when the same job has to be done
+    again (e.g., when a contestant resubmits the same files, or for an
+    invalidation) without running it through a worker.
+
+    Subclasses define the key and which fields of the result to keep.
+
+    """
+
+    def __init__(self, size):
+        """size (int): the maximum number of results to keep; the
+            least recently used are dropped first.
+
+        """
+        self._size = size
+        self._results = OrderedDict()
+
+        # Statistics for the status RPC methods.
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(job):
+        """Return the key under which to store the result of a job.
+
+        job (Job): the job.
+
+        return (tuple): the key.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
+    @staticmethod
+    def _storable(job):
+        """Return whether the result of a successful job can be
+        stored (by default, always).
+
+        job (Job): a job done by a worker.
+
+        return (bool): whether to store its result.
+
+        """
+        return True
+
+    @staticmethod
+    def _export(job):
+        """Return the result of a job, to be stored.
+
+        job (Job): a job done by a worker.
+
+        return (dict): the fields of the result.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
+    @staticmethod
+    def _import(job, result):
+        """Fill a job with a stored result.
+
+        job (Job): the job to fill.
+        result (dict): the result, as returned by _export.
+
+        """
+        raise NotImplementedError("Please subclass this class.")
+
+    def add(self, job_group):
+        """Store the results of the successful jobs of a group.
+
+        job_group (JobGroup): the jobs, as returned by a worker.
+
+        """
+        for job in job_group.jobs.itervalues():
+            if not job.success or not self._storable(job):
+                continue
+            key = self._key(job)
+            self._results.pop(key, None)
+            self._results[key] = self._export(job)
+        while len(self._results) > self._size:
+            self._results.popitem(last=False)
+
+    def fill(self, job_group):
+        """Fill the jobs of a group with the stored results, where
+        present.
+
+        job_group (JobGroup): the jobs to do; if all of them are
+            found, it is now as if a worker did them.
+
+        return ({string: Job}): the jobs that were filled.
+
+        """
+        filled = {}
+        for name, job in job_group.jobs.iteritems():
+            result = self._results.pop(self._key(job), None)
+            if result is None:
+                self.misses += 1
+                continue
+            self.hits += 1
+            self._results[self._key(job)] = result
+            self._import(job, result)
+            job.success = True
+            filled[name] = job
+        if len(filled) == len(job_group.jobs):
+            job_group.success = True
+        return filled
+
+    def get_status(self):
+        """Returns the statistics of the cache.
+
+        returns (dict): the number of hits and misses, and of results
+                        stored.
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._results)}
+
+
+class CompilationCache(ResultCache):
+    """The results of the last compilations, indexed by task type and
+    parameters, language, and digests of sources and managers.
+
+    """
+
+    @staticmethod
+    def _key(job):
+        """See ResultCache._key."""
+        return (job.task_type,
+                json.dumps(job.task_type_parameters, sort_keys=True),
+                job.language,
+                tuple(sorted((filename, file_.digest)
+                             for filename, file_ in job.files.iteritems())),
+                tuple(sorted((filename, manager.digest)
+                             for filename, manager
+                             in job.managers.iteritems())))
+
+    @staticmethod
+    def _storable(job):
+        """See ResultCache._storable. Compilations that timed out are
+        not stored, since the same sources could compile in time on a
+        less loaded worker (nor are sandbox errors, if ever reported
+        as a failed compilation).
+
+        """
+        return job.compilation_success or \
+            (job.plus or {}).get("exit_status") not in (
+                Sandbox.EXIT_TIMEOUT, Sandbox.EXIT_SANDBOX_ERROR)
+
+    @staticmethod
+    def _export(job):
+        """See ResultCache._export."""
+        return {'compilation_success': job.compilation_success,
+                'executables': dict(
+                    (filename, executable.digest)
+                    for filename, executable
+                    in job.executables.iteritems()),
+                'text': job.text,
+                'plus': job.plus}
+
+    @staticmethod
+    def _import(job, result):
+        """See ResultCache._import."""
+        job.compilation_success = result['compilation_success']
+        job.executables = dict(
+            (filename, Executable(filename, digest))
+            for filename, digest in result['executables'].iteritems())
+        job.text = result['text']
+        job.plus = result['plus']
+
+
+class EvaluationMemo(ResultCache):
+    """The results of the last evaluations on single testcases,
+    indexed by the executables and by everything defining the
+    testcase (input and output, limits, task type and parameters,
+    managers). Hence two submissions compiling to the same executable
+    share the outcomes, also across datasets with the same testcases.
+
+    """
+
+    @staticmethod
+    def _key(job):
+        """See ResultCache._key."""
+        # Sources are used only by task types without executables
+        # (i.e., output only); otherwise they do not matter.
+        files = ()
+        if len(job.executables) == 0:
+            files = tuple(sorted((filename, file_.digest)
+                                 for filename, file_
+                                 in job.files.iteritems()))
+        return (job.task_type,
+                json.dumps(job.task_type_parameters, sort_keys=True),
+                job.language,
+                tuple(sorted((filename, executable.digest)
+                             for filename, executable
+                             in job.executables.iteritems())),
+                files,
+                tuple(sorted((filename, manager.digest)
+                             for filename, manager
+                             in job.managers.iteritems())),
+                job.input,
+                job.output,
+                job.time_limit,
+                job.memory_limit)
+
+    @staticmethod
+    def _storable(job):
+        """See ResultCache._storable. As for compilations, outcomes
+        of executions that timed out (or of sandbox errors) are not
+        stored, since they depend on the load of the worker.
+
+        """
+        return (job.plus or {}).get("exit_status") not in (
+            Sandbox.EXIT_TIMEOUT, Sandbox.EXIT_SANDBOX_ERROR)
+
+    @staticmethod
+    def _export(job):
+        """See ResultCache._export."""
+        return {'outcome': job.outcome,
+                'text': job.text,
+                'plus': job.plus,
+                'shard': job.shard,
+                'sandboxes': job.sandboxes}
+
+    @staticmethod
+    def _import(job, result):
+        """See ResultCache._import."""
+        job.outcome = result['outcome']
+        job.text = result['text']
+        job.plus = result['plus']
+        job.shard = result['shard']
+        job.sandboxes = result['sandboxes']
+
+
+class QueueJournal(object):
+    """A journal on disk of the jobs that ES has to do, either waiting
+    in the queue or assigned to a worker, so that a restarted ES can
+    resume from where it was, with the same order.
+
+    The journal is a file with a JSON list on each line: either
+    ["push", job_type, object_id, dataset_id, priority, timestamp,
+    lane, user], written when a job enters the queue, or ["done",
+    job_type, object_id, dataset_id], written when it is completed or
+    dropped. Lines are only appended (and flushed, but not synced, so
+    they survive a crash of ES but not of the machine); from time to
+    time the journal is compacted, rewriting only the jobs still to
+    do. A failure to write disables the journal, as it is just an
+    optimization: ES always looks for the jobs to do in the database.
+
+    """
+
+    def __init__(self, path):
+        """path (string): the path of the journal file.
+
+        """
+        self._path = path
+        self._file = None
+
+        # The jobs to do, with the arguments they were pushed with,
+        # and the number of lines in the file.
+        self._entries = {}
+        self._lines = 0
+
+    def load(self):
+        """Read the journal left by a previous run, and open it to
+        record the new changes.
+
+        return ([tuple]): the jobs still to do, as tuples (job,
+            priority, timestamp, lane, user).
+
+        """
+        try:
+            with io.open(self._path, "rb") as journal:
+                for line in journal:
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, TypeError, IndexError):
+                        # Probably a line truncated by a crash.
+                        logger.warning("Invalid line in the queue "
+                                       "journal, skipping it.")
+        except IOError as error:
+            if error.errno != errno.ENOENT:
+                logger.error("Cannot read the queue journal %s: %s." %
+                             (self._path, error))
+        self.compact()
+        return [(job,) + data for job, data in self._entries.iteritems()]
+
+    def _apply(self, record):
+        """Update the jobs to do with a line of the journal.
+
+        record (list): the decoded line.
+
+        """
+        job = JobQueueEntry(*record[1:4])
+        if record[0] == "push":
+            self._entries[job] = (record[4], make_datetime(record[5]),
+                                  record[6], record[7])
+        elif record[0] == "done":
+            self._entries.pop(job, None)
+        else:
+            raise ValueError("Unknown operation %r." % record[0])
+
+    def _write(self, record):
+        """Append a line to the journal.
+
+        record (list): the line to write.
+
+        """
+        self._apply(record)
+        if self._file is None:
+            return
+        try:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            self._lines += 1
+        except IOError as error:
+            logger.error("Cannot write the queue journal %s, disabling "
+                         "it: %s." % (self._path, error))
+            self._file = None
+
+    def push(self, job, priority, timestamp, lane, user):
+        """Record that a job entered the queue.
+
+        job (JobQueueEntry): the job.
+        priority (int): the priority of the job.
+        timestamp (datetime): the time of the submission.
+        lane (string): the lane of the job.
+        user (int): the id of the user the job belongs to, or None.
+
+        """
+        self._write(["push"] + list(job) +
+                    [priority, make_timestamp(timestamp), lane, user])
+
+    def done(self, job):
+        """Record that a job was completed or dropped.
+
+        job (JobQueueEntry): the job.
+
+        """
+        if job in self._entries:
+            self._write(["done"] + list(job))
+
+    def compact(self):
+        """Rewrite the journal with only the jobs still to do, if it
+        contains other lines.
+
+        """
+        if self._file is not None and self._lines == len(self._entries):
+            return
+        temp_path = self._path + ".new"
+        try:
+            with io.open(temp_path, "wb") as journal:
+                for job, (priority, timestamp, lane, user) \
+                        in self._entries.iteritems():
+                    journal.write(json.dumps(
+                        ["push"] + list(job) +
+                        [priority, make_timestamp(timestamp), lane,
+                         user]) + "\n")
+            os.rename(temp_path, self._path)
+            if self._file is not None:
+                self._file.close()
+            self._file = io.open(self._path, "ab")
+            self._lines = len(self._entries)
+        except (IOError, OSError) as error:
+            logger.error("Cannot write the queue journal %s, disabling "
+                         "it: %s." % (self._path, error))
+            self._file = None
+
 
 class WorkerPool(object):
     """This class keeps the state of the workers attached to ES, and
@@ -324,15 +1308,27 @@ class WorkerPool(object):
     WORKER_INACTIVE = None
     WORKER_DISABLED = "disabled"
 
-    def __init__(self, service):
+    # How many of the last datasets and executables given to a worker
+    # we assume to be still in its file cache.
+    LOCALITY_CACHE_SIZE = 64
+
+    # Weight of the last duration observed in the average time per
+    # job, used to detect jobs that are taking too long.
+    DURATION_DECAY = 0.2
+
+    def __init__(self, service, slots=1):
         """service (Service): the EvaluationService using this
         WorkerPool.
+        slots (int): the number of execution slots of each worker.
 
         """
         self._service = service
+        self._slots = slots
         self._worker = {}
         # These dictionary stores data about the workers (identified
-        # by their shard number). Side data is anything one want to
+        # by their shard number, or by shard * slots + slot for
+        # workers with many slots, each treated as a different worker
+        # sharing the connection). Side data is anything one want to
         # attach to the worker. Schedule disabling to True means that
         # we are going to disable the worker as soon as possible (when
         # it finishes the current job). The current job is also
@@ -345,31 +1341,84 @@ class WorkerPool(object):
         self._schedule_disabling = {}
         self._ignore = {}
 
+        # Evaluations can be split in chunks of testcases, each given
+        # to a different worker. For such jobs, this dictionary stores
+        # the shards of the workers whose chunk is still running
+        # ("pending") and the JobGroups received so far ("results").
+        self._chunks = {}
+
+        # Reverse index of self._job: for each job (including the
+        # placeholders WORKER_*) the set of shards of the workers
+        # doing it. Always update it via _set_job.
+        self._shards_by_job = {}
+
+        # For each worker with a job, the number of jobs (e.g.,
+        # testcases) in the job group it was sent, how many of them it
+        # reported as done, when it last did, and how long it may take
+        # to do the next one before being considered stuck; for each
+        # type of job, the average time it took to do one of them (used
+        # when the service's CostModel has no data for the dataset).
+        self._size = {}
+        self._done = {}
+        self._last_progress = {}
+        self._job_timeout = {}
+        self._time_per_job = {}
+        # The average time taken by a worker to do a whole job group.
+        self._time_per_job_group = None
+
+        # For each worker (the actual one, shared by its slots), the
+        # files it should have in its cache because of the jobs it has
+        # been given, in the form of keys as returned by
+        # _locality_keys, from the least to the most recently used.
+        self._cached = {}
+
+    def __len__(self):
+        return len(self._worker)
+
     def __contains__(self, job):
-        for shard in self._worker:
-            if job == self._job[shard] and not self._ignore[shard]:
+        for shard in self._shards_by_job.get(job, ()):
+            if not self._ignore[shard]:
                 return True
         return False
 
+    def _set_job(self, shard, job):
+        """Assign a job (or a placeholder) to a worker, keeping the
+        reverse index up to date.
+
+        shard (int): the worker.
+        job (JobQueueEntry): the job, or WorkerPool.WORKER_*.
+
+        """
+        if shard in self._job:
+            old_shards = self._shards_by_job[self._job[shard]]
+            old_shards.discard(shard)
+            if len(old_shards) == 0:
+                del self._shards_by_job[self._job[shard]]
+        self._job[shard] = job
+        self._shards_by_job.setdefault(job, set()).add(shard)
+
     def add_worker(self, worker_coord):
         """Add a new worker to the worker pool.
 
         worker_coord (ServiceCoord): the coordinates of the worker.
 
         """
-        shard = worker_coord.shard
         # Instruct GeventLibrary to connect ES to the Worker.
-        self._worker[shard] = self._service.connect_to(
+        worker = self._service.connect_to(
             worker_coord,
             on_connect=self.on_worker_connected)
-
-        # And we fill all data.
-        self._job[shard] = WorkerPool.WORKER_INACTIVE
-        self._start_time[shard] = None
-        self._side_data[shard] = None
-        self._schedule_disabling[shard] = False
-        self._ignore[shard] = False
-        logger.debug("Worker %s added." % shard)
+        self._cached[worker_coord.shard] = OrderedDict()
+
+        # And we fill all data, for each slot.
+        for slot in xrange(self._slots):
+            shard = worker_coord.shard * self._slots + slot
+            self._worker[shard] = worker
+            self._set_job(shard, WorkerPool.WORKER_INACTIVE)
+            self._start_time[shard] = None
+            self._side_data[shard] = None
+            self._schedule_disabling[shard] = False
+            self._ignore[shard] = False
+            logger.debug("Worker %s added." % shard)
 
     def on_worker_connected(self, worker_coord):
         """To be called when a worker comes alive after being
@@ -380,76 +1429,555 @@ class WorkerPool(object):
                                      that came online.
 
         """
-        shard = worker_coord.shard
-        logger.info("Worker %s online again." % shard)
+        shard = worker_coord.shard * self._slots
+        logger.info("Worker %s online again." % worker_coord.shard)
         self._worker[shard].precache_files(contest_id=self._service.contest_id)
+        # The worker may be able to take a job.
+        self._service.trigger_dispatch()
         # We don't requeue the job, because a connection lost does not
         # invalidate a potential result given by the worker (as the
         # problem was the connection and not the machine on which the
         # worker is).
 
-    def acquire_worker(self, job, side_data=None):
+    @staticmethod
+    def _locality_keys(job):
+        """Return what a worker needs to have in its cache to do a job
+        without downloading files, and what it has in its cache after
+        doing it: the testcases and managers of the dataset, and the
+        files (notably, the executables produced by the compilation)
+        of the submission or user test.
+
+        job (JobQueueEntry): the job.
+
+        return ([tuple]): the keys of the files used by the job.
+
+        """
+        job_type, object_id, dataset_id = job
+        if job_type in (EvaluationService.JOB_TYPE_TEST_COMPILATION,
+                        EvaluationService.JOB_TYPE_TEST_EVALUATION):
+            kind = "user_test"
+        else:
+            kind = "submission"
+        return [("dataset", dataset_id), (kind, object_id, dataset_id)]
+
+    def _idle_workers(self, job):
+        """Return the connected idle workers, the ones that already
+        have the files needed by job in their cache first.
+
+        job (JobQueueEntry): the job to do.
+
+        return ([int]): the shards of the idle workers, in order of
+            preference (random among equally good ones).
+
+        """
+        keys = WorkerPool._locality_keys(job)
+        shards = [shard for shard in self._shards_by_job.get(
+            WorkerPool.WORKER_INACTIVE, ())
+            if self._worker[shard].connected]
+        random.shuffle(shards)
+        shards.sort(key=lambda shard: -sum(
+            1 for key in keys
+            if key in self._cached[shard // self._slots]))
+        return shards
+
+    def _remember_cached(self, shard, job):
+        """Record that a worker is going to have in its cache the
+        files needed by job.
+
+        shard (int): the worker.
+        job (JobQueueEntry): the job given to the worker.
+
+        """
+        cached = self._cached[shard // self._slots]
+        for key in WorkerPool._locality_keys(job):
+            cached.pop(key, None)
+            cached[key] = True
+        while len(cached) > WorkerPool.LOCALITY_CACHE_SIZE:
+            cached.popitem(last=False)
+
+    def acquire_worker(self, job, side_data=None, skip=None):
         """Tries to assign a job to an available worker. If no workers
         are available then this returns None, otherwise this returns
         the chosen worker.
 
+        Workers that already did jobs on the same dataset (and, for
+        evaluations, the compilation of the same submission) are
+        preferred, since they probably have the files in their cache.
+
+        Evaluations with enough testcases are split in chunks among
+        the available workers (see EvaluationService.
+        MIN_TESTCASES_PER_CHUNK); in that case the returned worker is
+        the one that got the first chunk.
+
         job (JobQueueEntry): the job to assign to a worker.
         side_data (object): object to attach to the worker for later
             use.
+        skip (set): for evaluations, the codenames of the testcases
+            not to evaluate.
 
         returns (int): None if no workers are available, the worker
             assigned to the job otherwise.
 
+        raise (JobGoneError): if the job left the queue while it was
+            being loaded.
+
         """
-        # We look for an available worker
-        try:
-            shard = self.find_worker(WorkerPool.WORKER_INACTIVE,
-                                     require_connection=True,
-                                     random_worker=True)
-        except LookupError:
+        # We look for the available workers, best first.
+        idle_shards = self._idle_workers(job)
+        if idle_shards == []:
             return None
 
+        # Loading the job group yields to other greenlets, which may
+        # look for idle workers too: we book them in advance. Only
+        # evaluations may use more than one of them.
+        if job.job_type != EvaluationService.JOB_TYPE_EVALUATION:
+            idle_shards = idle_shards[:1]
+        self._reserve(idle_shards, job, side_data)
+        try:
+            with SessionGen() as session:
+                job_group = WorkerPool.get_job_group(job, session, skip)
+        except:
+            self._unreserve(idle_shards, job)
+            raise
+
+        # Meanwhile the job may have been removed from the queue, or
+        # invalidated (hence ignored) and pushed again.
+        if job not in self._service.queue or \
+                not all(self._is_reserved(shard, job)
+                        for shard in idle_shards):
+            self._unreserve(idle_shards, job)
+            raise JobGoneError("Job %r left the queue while loading it." %
+                               (job,))
+
+        # The testcases of an evaluation are independent, so we can
+        # split them among the other idle workers.
+        shards = idle_shards[:1]
+        if job.job_type == EvaluationService.JOB_TYPE_EVALUATION:
+            max_chunks = len(job_group.jobs) // \
+                EvaluationService.MIN_TESTCASES_PER_CHUNK
+            shards = idle_shards[:max(max_chunks, 1)]
+        self._unreserve(idle_shards[len(shards):], job)
+        job_groups = job_group.split(len(shards))
+        if len(job_groups) > 1:
+            self._chunks[job] = {"pending": set(shards),
+                                 "results": []}
+
+        for shard, job_group in zip(shards, job_groups):
+            self._send_job_group(shard, job, job_group, side_data,
+                                 " on %d testcases" % len(job_group.jobs)
+                                 if len(job_groups) > 1 else "")
+        return shards[0]
+
+    def _reserve(self, shards, job, side_data):
+        """Assign a job to idle workers before sending it to them (see
+        _send_job_group), so that nobody else picks them meanwhile.
+
+        shards ([int]): the idle workers.
+        job (JobQueueEntry): the job.
+        side_data (object): as in acquire_worker.
+
+        """
+        for shard in shards:
+            self._set_job(shard, job)
+            self._side_data[shard] = side_data
+
+    def _is_reserved(self, shard, job):
+        """Return whether a worker is still reserved for a job, that
+        is, the job has been neither sent to it nor ignored.
+
+        shard (int): the worker.
+        job (JobQueueEntry): the job.
+
+        return (bool): True if the worker is still reserved for job.
+
+        """
+        return self._job[shard] == job and \
+            self._start_time[shard] is None and not self._ignore[shard]
+
+    def _unreserve(self, shards, job):
+        """Make idle again the workers reserved for a job that will
+        not be sent to them.
+
+        shards ([int]): the workers.
+        job (JobQueueEntry): the job.
+
+        """
+        for shard in shards:
+            if self._job[shard] == job and self._start_time[shard] is None:
+                self._side_data[shard] = None
+                self._ignore[shard] = False
+                self._set_job(shard, WorkerPool.WORKER_INACTIVE)
+
+    @staticmethod
+    def get_job_group(job, session, skip=None):
+        """Build the JobGroup to send to a worker to do job.
+
+        job (JobQueueEntry): the job.
+        session (Session): the session to use to load the data.
+        skip (set): for evaluations, the codenames of the testcases
+            to leave out.
+
+        return (JobGroup): the job group for job.
+
+        """
+        job_type, object_id, dataset_id = job
+        dataset = Dataset.get_from_id(dataset_id, session)
+        if job_type == EvaluationService.JOB_TYPE_COMPILATION:
+            submission = Submission.get_from_id(object_id, session)
+            return JobGroup.from_submission_compilation(submission, dataset)
+        elif job_type == EvaluationService.JOB_TYPE_EVALUATION:
+            submission = Submission.get_from_id(object_id, session)
+            return JobGroup.from_submission_evaluation(submission, dataset,
+                                                       skip)
+        elif job_type == EvaluationService.JOB_TYPE_TEST_COMPILATION:
+            user_test = UserTest.get_from_id(object_id, session)
+            return JobGroup.from_user_test_compilation(user_test, dataset)
+        elif job_type == EvaluationService.JOB_TYPE_TEST_EVALUATION:
+            user_test = UserTest.get_from_id(object_id, session)
+            return JobGroup.from_user_test_evaluation(user_test, dataset)
+
+    def _send_job_group(self, shard, job, job_group, side_data,
+                        description=""):
+        """Assign a job (or a chunk of it) to an idle worker, and send
+        it the corresponding job group.
+
+        shard (int): the worker.
+        job (JobQueueEntry): the job.
+        job_group (JobGroup): what the worker has to do.
+        side_data (object): object to attach to the worker for later
+            use.
+        description (string): details to add to the log message.
+
+        """
+        job_type, object_id, dataset_id = job
+
         # Then we fill the info for future memory
-        self._job[shard] = job
+        self._set_job(shard, job)
         self._start_time[shard] = make_datetime()
         self._side_data[shard] = side_data
+        self._size[shard] = len(job_group.jobs)
+        self._done[shard] = 0
+        self._last_progress[shard] = self._start_time[shard]
+        self._job_timeout[shard] = self._get_job_timeout(job, job_group)
+        self._remember_cached(shard, job)
         logger.debug("Worker %s acquired." % shard)
 
         # And finally we ask the worker to do the job
-        job_type, object_id, dataset_id = job
         timestamp = side_data[1]
         queue_time = self._start_time[shard] - timestamp
-        logger.info("Asking worker %s to %s submission/user test %d(%d) "
-                    " (%s after submission)." %
-                    (shard, job_type, object_id, dataset_id, queue_time))
+        logger.info("Asking worker %s to %s submission/user test "
+                    "%d(%d) (%s after submission)%s." %
+                    (shard, job_type, object_id, dataset_id,
+                     queue_time, description))
+
+        self._worker[shard].execute_job_group(
+            job_group_dict=job_group.export_to_dict(),
+            slot=shard % self._slots,
+            callback=self._service.action_finished,
+            plus=(job_type, object_id, dataset_id, side_data, shard))
+
+    def _get_job_timeout(self, job, job_group):
+        """Return how long a worker may take to do one of the jobs of
+        a job group, that is, the time between two progress reports,
+        before we consider it stuck.
+
+        The time is derived from the limits of the sandbox for the
+        jobs (and from the time they took so far, if longer), scaled
+        for the overhead of preparing the sandbox and of checking the
+        output, plus a small margin. Fetching the files of a job does
+        not count, as the worker reports its progress after each of
+        them.
+
+        job (JobQueueEntry): the job.
+        job_group (JobGroup): the job group sent to the worker.
+
+        return (timedelta): the timeout.
+
+        """
+        if job.job_type in (EvaluationService.JOB_TYPE_COMPILATION,
+                            EvaluationService.JOB_TYPE_TEST_COMPILATION):
+            bound = EvaluationService.COMPILATION_WALL_CLOCK_LIMIT
+        else:
+            time_limits = [job2.time_limit
+                           for job2 in job_group.jobs.itervalues()]
+            if time_limits == [] or None in time_limits:
+                return EvaluationService.WORKER_TIMEOUT
+            # See evaluation_step: this is the wall clock limit.
+            bound = timedelta(seconds=2 * max(time_limits) + 1)
+        time_per_job = self._get_time_per_job(job)
+        if time_per_job is not None:
+            bound = max(bound, timedelta(
+                seconds=time_per_job * EvaluationService.SPECULATION_FACTOR))
+        return min(bound * EvaluationService.JOB_TIMEOUT_FACTOR
+                   + EvaluationService.JOB_TIMEOUT_MARGIN,
+                   EvaluationService.WORKER_TIMEOUT)
+
+    def record_progress(self, shard, done):
+        """Record that a worker reported how many jobs of its job
+        group are done (which it does also before starting each of
+        them, to show it is alive).
+
+        shard (int): the worker.
+        done (int): the number of jobs done.
+
+        """
+        if self._start_time.get(shard) is None or \
+                done < self._done[shard]:
+            return
+        self._done[shard] = done
+        self._last_progress[shard] = make_datetime()
+
+    def _get_time_per_job(self, job):
+        """Return how long a worker takes for each job (i.e., testcase
+        for evaluations) of a job group, given how long the ones of
+        the same type took so far on the same dataset, or on any
+        dataset if there are none.
+
+        job (JobQueueEntry): the job.
+
+        return (float): the time in seconds, or None if we have no
+            data yet.
+
+        """
+        seconds = self._service.cost_model.get_job_time(job)
+        if seconds is None:
+            seconds = self._time_per_job.get(job.job_type)
+        return seconds
+
+    def _expected_duration(self, shard):
+        """Return how long the job of a worker is expected to take,
+        given how long the jobs of the same type took so far (see
+        _get_time_per_job).
+
+        shard (int): a busy worker.
+
+        return (timedelta): the expected duration, or None if we have
+            no data yet.
+
+        """
+        time_per_job = self._get_time_per_job(self._job[shard])
+        if time_per_job is None:
+            return None
+        return timedelta(seconds=time_per_job * self._size[shard])
+
+    def prefetch(self, job, skip=None):
+        """Send the files needed by a job to the busy worker expected
+        to finish first, so that they are in its cache when the job is
+        given to it (the worker becomes the preferred one for the job,
+        see _idle_workers).
+
+        job (JobQueueEntry): a job waiting for a worker.
+        skip (set): as in acquire_worker.
+
+        returns (int): None if no workers are busy, the worker to
+            which the files were sent otherwise.
+
+        """
+        now = make_datetime()
+        shards = []
+        for shard in self._worker:
+            if self._start_time[shard] is None or self._ignore[shard] or \
+                    not self._worker[shard].connected:
+                continue
+            expected = self._expected_duration(shard)
+            if expected is None:
+                expected = timedelta()
+            shards.append((expected - (now - self._start_time[shard]),
+                           shard))
+        if shards == []:
+            return None
+        shard = min(shards)[1]
 
         with SessionGen() as session:
-            if job_type == EvaluationService.JOB_TYPE_COMPILATION:
-                submission = Submission.get_from_id(object_id, session)
-                dataset = Dataset.get_from_id(dataset_id, session)
-                job_group = \
-                    JobGroup.from_submission_compilation(submission, dataset)
-            elif job_type == EvaluationService.JOB_TYPE_EVALUATION:
-                submission = Submission.get_from_id(object_id, session)
-                dataset = Dataset.get_from_id(dataset_id, session)
-                job_group = \
-                    JobGroup.from_submission_evaluation(submission, dataset)
-            elif job_type == EvaluationService.JOB_TYPE_TEST_COMPILATION:
-                user_test = UserTest.get_from_id(object_id, session)
-                dataset = Dataset.get_from_id(dataset_id, session)
-                job_group = \
-                    JobGroup.from_user_test_compilation(user_test, dataset)
-            elif job_type == EvaluationService.JOB_TYPE_TEST_EVALUATION:
-                user_test = UserTest.get_from_id(object_id, session)
-                dataset = Dataset.get_from_id(dataset_id, session)
-                job_group = \
-                    JobGroup.from_user_test_evaluation(user_test, dataset)
+            job_group = WorkerPool.get_job_group(job, session, skip)
+        digests = set()
+        for job2 in job_group.jobs.itervalues():
+            digests.update(job2.get_digests())
+
+        self._remember_cached(shard, job)
+        logger.debug("Sending %d files of job %r to worker %s in "
+                     "advance." % (len(digests), job, shard))
+        self._worker[shard].prefetch_files(digests=sorted(digests))
+        return shard
+
+    def _record_duration(self, shard):
+        """Update the average time per job (that is, per testcase for
+        evaluations) with the one of a worker that just finished.
+
+        shard (int): the worker, not yet released.
+
+        """
+        job = self._job[shard]
+        job_type = job.job_type
+        total_seconds = (make_datetime() - self._start_time[shard]) \
+            .total_seconds()
+        seconds = total_seconds / max(self._size[shard], 1)
+        self._service.cost_model.record_job_time(job, seconds)
+        if job_type in self._time_per_job:
+            seconds = WorkerPool.DURATION_DECAY * seconds + \
+                (1 - WorkerPool.DURATION_DECAY) * \
+                self._time_per_job[job_type]
+        self._time_per_job[job_type] = seconds
+        if self._time_per_job_group is not None:
+            total_seconds = WorkerPool.DURATION_DECAY * total_seconds + \
+                (1 - WorkerPool.DURATION_DECAY) * self._time_per_job_group
+        self._time_per_job_group = total_seconds
+
+    def get_throughput(self):
+        """Return how many job groups the pool is able to complete per
+        second, given the available workers and the average time they
+        took so far.
+
+        return (float): the job groups per second, or None if we have
+            no data yet.
+
+        """
+        if self._time_per_job_group is None:
+            return None
+        return max(self.count_workers(), 1) / \
+            max(self._time_per_job_group, 0.001)
+
+    def count_workers(self):
+        """Return how many workers are available to do jobs.
+
+        return (int): the number of workers connected and not
+            disabled.
+
+        """
+        return sum(1 for shard in self._worker
+                   if self._worker[shard].connected and
+                   self._job[shard] != WorkerPool.WORKER_DISABLED)
+
+    def find_stragglers(self):
+        """Return the jobs that are taking much longer than expected
+        (see EvaluationService.SPECULATION_FACTOR), and that could be
+        given to another worker: they must be neither split in chunks
+        nor already duplicated.
+
+        return ([JobQueueEntry]): the straggling jobs.
+
+        """
+        now = make_datetime()
+        stragglers = []
+        for job, shards in self._shards_by_job.iteritems():
+            if job in (WorkerPool.WORKER_INACTIVE,
+                       WorkerPool.WORKER_DISABLED) \
+                    or len(shards) != 1 or job in self._chunks:
+                continue
+            shard = iter(shards).next()
+            if self._ignore[shard] or self._start_time[shard] is None:
+                continue
+            expected = self._expected_duration(shard)
+            if expected is None:
+                continue
+            active_for = now - self._start_time[shard]
+            if active_for > EvaluationService.SPECULATION_MIN_TIME and \
+                    active_for > \
+                    expected * EvaluationService.SPECULATION_FACTOR:
+                stragglers.append(job)
+        return stragglers
+
+    def speculate(self, job, skip=None):
+        """Give a copy of a job already running to another idle
+        worker; the first copy to finish successfully will be used
+        (see drop_copies).
+
+        job (JobQueueEntry): the job to duplicate.
+        skip (set): as in acquire_worker.
+
+        returns (int): None if no workers are available, the worker
+            assigned to the copy otherwise.
+
+        raise (JobGoneError): if the job is not running anymore.
+
+        """
+        shard = self.find_worker(job)
+        idle_shards = self._idle_workers(job)
+        if idle_shards == []:
+            return None
+
+        # As in acquire_worker, we book the worker before loading.
+        copy_shard = idle_shards[0]
+        self._reserve([copy_shard], job, self._side_data[shard])
+        try:
+            with SessionGen() as session:
+                job_group = WorkerPool.get_job_group(job, session, skip)
+        except:
+            self._unreserve([copy_shard], job)
+            raise
+
+        # The original copy may have finished meanwhile.
+        if not self._is_reserved(copy_shard, job) or \
+                self._job[shard] != job or self._ignore[shard]:
+            self._unreserve([copy_shard], job)
+            raise JobGoneError("Job %r finished while loading it." % (job,))
+
+        self._send_job_group(copy_shard, job, job_group,
+                             self._side_data[shard],
+                             " (copy of the one on worker %s)" % shard)
+        return copy_shard
+
+    def drop_copies(self, job):
+        """Ignore the other copies of a job, after one of them
+        finished (and its worker has been released).
+
+        job (JobQueueEntry): the job.
+
+        return (bool): True if there were other copies.
+
+        """
+        if job in self._chunks or job not in self:
+            return False
+        self.ignore_job(job)
+        return True
+
+    def is_split(self, job):
+        """Return whether a job has been split in chunks among many
+        workers, and is still waiting for some of them.
+
+        job (JobQueueEntry): the job to check.
+
+        returns (bool): True if the job is split in chunks.
+
+        """
+        return job in self._chunks
+
+    def merge_chunk(self, job, shard, job_group):
+        """Record the result of a chunk of a job split among many
+        workers.
 
-            self._worker[shard].execute_job_group(
-                job_group_dict=job_group.export_to_dict(),
-                callback=self._service.action_finished,
-                plus=(job_type, object_id, dataset_id, side_data, shard))
-        return shard
+        job (JobQueueEntry): the job the chunk belongs to.
+        shard (int): the worker that computed the chunk.
+        job_group (JobGroup): the result of the chunk.
+
+        returns (JobGroup): None if some chunks are still missing,
+            otherwise the result of the whole job.
+
+        """
+        chunks = self._chunks[job]
+        chunks["pending"].discard(shard)
+        chunks["results"].append(job_group)
+        if len(chunks["pending"]) > 0:
+            return None
+        del self._chunks[job]
+        return JobGroup.merge(chunks["results"])
+
+    def abort_chunks(self, job):
+        """Forget the chunks of a job split among many workers,
+        ignoring the ones that are still running. To be called when
+        a chunk failed or got lost, as the job will be retried as a
+        whole.
+
+        job (JobQueueEntry): the job whose chunks are to be dropped.
+
+        """
+        chunks = self._chunks.pop(job, None)
+        if chunks is None:
+            return
+        for shard in chunks["pending"]:
+            if self._job[shard] == job and not self._ignore[shard]:
+                self._ignore[shard] = True
+                self._worker[shard].ignore_job(slot=shard % self._slots)
 
     def release_worker(self, shard):
         """To be called by ES when it receives a notification that a
@@ -469,15 +1997,17 @@ class WorkerPool(object):
             logger.error(err_msg)
             raise ValueError(err_msg)
         ret = self._ignore[shard]
+        if not ret:
+            self._record_duration(shard)
         self._start_time[shard] = None
         self._side_data[shard] = None
         self._ignore[shard] = False
         if self._schedule_disabling[shard]:
-            self._job[shard] = WorkerPool.WORKER_DISABLED
+            self._set_job(shard, WorkerPool.WORKER_DISABLED)
             self._schedule_disabling[shard] = False
             logger.info("Worker %s released and disabled." % shard)
         else:
-            self._job[shard] = WorkerPool.WORKER_INACTIVE
+            self._set_job(shard, WorkerPool.WORKER_INACTIVE)
             logger.debug("Worker %s released." % shard)
         return ret
 
@@ -500,12 +2030,11 @@ class WorkerPool(object):
 
         """
         pool = []
-        for shard, worker_job in self._job.iteritems():
-            if worker_job == job:
-                if not require_connection or self._worker[shard].connected:
-                    pool.append(shard)
-                    if not random_worker:
-                        return shard
+        for shard in self._shards_by_job.get(job, ()):
+            if not require_connection or self._worker[shard].connected:
+                pool.append(shard)
+                if not random_worker:
+                    return shard
         if pool == []:
             raise LookupError("No such job.")
         else:
@@ -519,9 +2048,27 @@ class WorkerPool(object):
         raise (LookupError): if job is not found.
 
         """
-        shard = self.find_worker(job)
-        self._ignore[shard] = True
-        self._worker[shard].ignore_job()
+        # A job may be split among many workers: we ignore all of them.
+        shards = list(self._shards_by_job.get(job, ()))
+        if shards == []:
+            raise LookupError("No such job.")
+        self._chunks.pop(job, None)
+        for shard in shards:
+            self._ignore[shard] = True
+            self._worker[shard].ignore_job(slot=shard % self._slots)
+
+    def get_jobs(self):
+        """Returns the jobs currently assigned to some worker (and not
+        to be ignored).
+
+        return ([JobQueueEntry]): the jobs, each once even if split
+                                  among many workers.
+
+        """
+        return [job for job in self._shards_by_job
+                if job not in (WorkerPool.WORKER_INACTIVE,
+                               WorkerPool.WORKER_DISABLED)
+                and job in self]
 
     def get_status(self):
         """Returns a dict with info about the current status of all
@@ -548,7 +2095,9 @@ class WorkerPool(object):
         return result
 
     def check_timeouts(self):
-        """Check if some worker is not responding in too much time. If
+        """Check if some worker is not responding in too much time
+        (i.e., it did not report progress on its job group for longer
+        than the timeout of a single job, see _get_job_timeout). If
         this is the case, the worker is scheduled for disabling, and
         we send him a message trying to shut it down.
 
@@ -560,9 +2109,9 @@ class WorkerPool(object):
         lost_jobs = []
         for shard in self._worker:
             if self._start_time[shard] is not None:
-                active_for = now - self._start_time[shard]
+                active_for = now - self._last_progress[shard]
 
-                if active_for > EvaluationService.WORKER_TIMEOUT:
+                if active_for > self._job_timeout[shard]:
                     # Here shard is a working worker with no sign of
                     # intelligent life for too much time.
                     logger.error("Disabling and shutting down "
@@ -586,7 +2135,7 @@ class WorkerPool(object):
                     self.release_worker(shard)
                     self._worker[shard].quit("No response in %s." % active_for)
 
-        return lost_jobs
+        return self._drop_lost_chunks(lost_jobs)
 
     def check_connections(self):
         """Check if a worker we assigned a job to disconnects. In this
@@ -598,16 +2147,39 @@ class WorkerPool(object):
         """
         lost_jobs = []
         for shard in self._worker:
+            # Workers reserved for a job that is still being loaded
+            # are handled once it is sent to them.
             if not self._worker[shard].connected and \
-                    self._job[shard] not in [WorkerPool.WORKER_DISABLED,
-                                             WorkerPool.WORKER_INACTIVE]:
+                    self._start_time[shard] is not None:
                 if not self._ignore[shard]:
                     job = self._job[shard]
                     priority, timestamp = self._side_data[shard]
                     lost_jobs.append((priority, timestamp, job))
+                # Not a real result: do not take its duration into
+                # account.
+                self._ignore[shard] = True
                 self.release_worker(shard)
 
-        return lost_jobs
+        return self._drop_lost_chunks(lost_jobs)
+
+    def _drop_lost_chunks(self, lost_jobs):
+        """Deal with lost jobs that were split among many workers: if
+        a chunk is lost, the job has to be redone as a whole, hence
+        its other chunks are ignored, and the job is returned once
+        even if many of its chunks were lost.
+
+        lost_jobs (list): list of tuples (priority, timestamp, job).
+
+        return (list): the same list, without duplicate jobs.
+
+        """
+        result = []
+        for priority, timestamp, job in lost_jobs:
+            if any(job == other_job for _, _, other_job in result):
+                continue
+            self.abort_chunks(job)
+            result.append((priority, timestamp, job))
+        return result
 
 
 class EvaluationService(Service):
@@ -626,123 +2198,355 @@ class EvaluationService(Service):
     JOB_TYPE_TEST_COMPILATION = "compile_test"
     JOB_TYPE_TEST_EVALUATION = "evaluate_test"
 
+    # The weights of the lanes of the queue (see cms.service): when
+    # all of them have jobs waiting, the workers are shared in these
+    # proportions.
+    LANES = [(LANE_LIVE, 6.0), (LANE_TEST, 3.0), (LANE_BULK, 1.0)]
+
     MAX_COMPILATION_TRIES = 3
     MAX_EVALUATION_TRIES = 3
     MAX_TEST_COMPILATION_TRIES = 3
     MAX_TEST_EVALUATION_TRIES = 3
 
+    # How many compilation results to keep for reuse.
+    COMPILATION_CACHE_SIZE = 10000
+
+    # How many outcomes of evaluations on single testcases to keep for
+    # reuse.
+    EVALUATION_MEMO_SIZE = 200000
+
+    # Evaluations are split among the idle workers in chunks of at
+    # least this many testcases.
+    MIN_TESTCASES_PER_CHUNK = 4
+
     INVALIDATE_COMPILATION = 0
     INVALIDATE_EVALUATION = 1
 
-    # Seconds after which we declare a worker stale.
+    # Seconds without progress after which we declare a worker stale,
+    # if we cannot estimate how long its jobs take (see
+    # WorkerPool._get_job_timeout), and at most in any case.
     WORKER_TIMEOUT = timedelta(seconds=600)
+    # The wall clock limit of compilations (see compilation_step), and
+    # how the limits of the jobs become their timeouts: the overhead
+    # of a job (sandboxes, checking the output) grows with its limits,
+    # while fetching its files is covered by the progress reports of
+    # the worker.
+    COMPILATION_WALL_CLOCK_LIMIT = timedelta(seconds=20)
+    JOB_TIMEOUT_FACTOR = 2
+    JOB_TIMEOUT_MARGIN = timedelta(seconds=10)
     # How often we check for stale workers.
-    WORKER_TIMEOUT_CHECK_TIME = timedelta(seconds=300)
+    WORKER_TIMEOUT_CHECK_TIME = timedelta(seconds=5)
 
     # How often we check if a worker is connected.
     WORKER_CONNECTION_CHECK_TIME = timedelta(seconds=10)
 
-    # How often we check if we can assign a job to a worker.
-    CHECK_DISPATCH_TIME = timedelta(seconds=2)
+    # How often we rewrite the journal of the queue, dropping the
+    # jobs already done.
+    JOURNAL_COMPACTION_TIME = timedelta(seconds=60)
+
+    # How often we check if we can assign a job to a worker, even if
+    # nothing happened that could allow it (jobs are dispatched as
+    # soon as a job is queued or a worker is released or connects;
+    # this is just a safety net).
+    CHECK_DISPATCH_TIME = timedelta(seconds=10)
+
+    # A job running SPECULATION_FACTOR times longer than expected (and
+    # at least SPECULATION_MIN_TIME) is given also to an idle worker,
+    # in case its worker is slow or stuck.
+    CHECK_STRAGGLERS_TIME = timedelta(seconds=5)
+    SPECULATION_FACTOR = 3
+    SPECULATION_MIN_TIME = timedelta(seconds=10)
 
     # How often we look for submission not compiled/evaluated.
     JOBS_NOT_DONE_CHECK_TIME = timedelta(seconds=117)
+    # How often the look for submissions not compiled/evaluated
+    # considers all submissions, and not only the new ones.
+    JOBS_NOT_DONE_FULL_CHECK_TIME = timedelta(seconds=1200)
+
+    # How often we recompute from the database the statistics on the
+    # submissions, which are otherwise kept up to date in memory.
+    SUBMISSIONS_STATUS_CHECK_TIME = timedelta(seconds=60)
 
     def __init__(self, shard, contest_id):
         Service.__init__(self, shard)
 
         self.contest_id = contest_id
 
-        self.queue = JobQueue()
-        self.pool = WorkerPool(self)
+        self.queue = LaneJobQueue(
+            EvaluationService.LANES, config.fair_queuing,
+            [LANE_BULK] if config.bulk_longest_first
+            else [])
+        self.cost_model = CostModel()
+        # The submission results (as pairs (submission_id, dataset_id))
+        # whose jobs belong to the bulk lane.
+        self.bulk_results = set()
+        # The user owning each submission or user test result with
+        # jobs in the queue or in the pool (see job_result).
+        self.result_users = {}
+        self.pool = WorkerPool(self, config.worker_slots)
+
+        # The highest ids of submissions and user tests already looked
+        # at by search_jobs_not_done, and the time of its last full
+        # run (i.e., looking also at the older ones).
+        self.submission_watermark = 0
+        self.user_test_watermark = 0
+        self.last_full_search = None
+
+        # The statistics returned by submissions_status, or None if
+        # not yet computed.
+        self.submissions_stats = None
+
+        # The time each job in the queue or in the pool entered the
+        # queue and (if it did) was given to a worker, and the
+        # histograms of the latencies of the various stages of the
+        # jobs, indexed by (stage, job type, task id); see
+        # latency_status.
+        self.job_times = {}
+        self.latencies = {}
+
+        # The results of the last compilations, the last job we did
+        # not find there (to avoid looking it up again while it waits
+        # for a worker), and the compilations pushed by an
+        # invalidation, which are not looked up.
+        self.compilation_cache = CompilationCache(
+            EvaluationService.COMPILATION_CACHE_SIZE)
+        self.compilation_cache_missed = None
+        self.recompile = set()
+
+        # The last job whose files were sent to a busy worker.
+        self.prefetched_job = None
+
+        # The outcomes of the last evaluations, and, for each
+        # evaluation in the queue or running, the testcases whose
+        # outcome was found there (none for the evaluations pushed
+        # by an invalidation, which are not looked up).
+        self.evaluation_memo = EvaluationMemo(
+            EvaluationService.EVALUATION_MEMO_SIZE)
+        self.memoized = {}
+
         self.scoring_service = self.connect_to(
             ServiceCoord("ScoringService", 0))
 
+        # When EvaluationService is sharded, each shard uses only the
+        # workers it owns, and takes care only of the submissions and
+        # user tests it owns (see get_evaluation_shard).
         for i in xrange(get_service_shards("Worker")):
-            worker = ServiceCoord("Worker", i)
-            self.pool.add_worker(worker)
+            if get_evaluation_shard(i) == self.shard:
+                worker = ServiceCoord("Worker", i)
+                self.pool.add_worker(worker)
+        if len(self.pool) == 0:
+            logger.warning("No worker assigned to this shard; the jobs "
+                           "will be queued but never dispatched.")
+
+        # Set up and spawn the dispatcher.
+        self._dispatcher_event = Event()
+        gevent.spawn(self._dispatcher_loop)
+
+        # Resume the work left by the previous run, before accepting
+        # new one.
+        if not mkdir(config.data_dir):
+            logger.error("Cannot create the directory %s." %
+                         config.data_dir)
+        self.journal = QueueJournal(os.path.join(
+            config.data_dir, "%s_%d_contest_%d.journal" %
+            (self.name, self.shard, self.contest_id)))
+        self.restore_queue()
 
-        self.add_timeout(self.dispatch_jobs, None,
-                         EvaluationService.CHECK_DISPATCH_TIME
-                         .total_seconds(),
-                         immediately=True)
         self.add_timeout(self.check_workers_timeout, None,
                          EvaluationService.WORKER_TIMEOUT_CHECK_TIME
                          .total_seconds(),
                          immediately=False)
+        self.add_timeout(self.check_stragglers, None,
+                         EvaluationService.CHECK_STRAGGLERS_TIME
+                         .total_seconds(),
+                         immediately=False)
         self.add_timeout(self.check_workers_connection, None,
                          EvaluationService.WORKER_CONNECTION_CHECK_TIME
                          .total_seconds(),
                          immediately=False)
-        self.add_timeout(self.search_jobs_not_done, None,
+        self.add_timeout(self.check_jobs_not_done, None,
                          EvaluationService.JOBS_NOT_DONE_CHECK_TIME
                          .total_seconds(),
                          immediately=True)
+        self.add_timeout(self.check_submissions_status, None,
+                         EvaluationService.SUBMISSIONS_STATUS_CHECK_TIME
+                         .total_seconds(),
+                         immediately=False)
+        self.add_timeout(self.compact_journal, None,
+                         EvaluationService.JOURNAL_COMPACTION_TIME
+                         .total_seconds(),
+                         immediately=False)
+
+    def restore_queue(self):
+        """Put back in the queue the jobs recorded in the journal by
+        the previous run, both the ones that were in the queue and the
+        ones that were assigned to a worker (whose results are lost).
+
+        The database may have changed in the meantime, hence the jobs
+        that are not to be done anymore (see job_to_do) are dropped.
+
+        """
+        entries = self.journal.load()
+        restored = 0
+        with SessionGen() as session:
+            for job, priority, timestamp, lane, user_id in entries:
+                try:
+                    pushed = self.owns(job.object_id) and \
+                        self.job_to_do(job, session) and \
+                        self.push_in_queue(job, priority, timestamp, lane,
+                                           user_id)
+                except Exception:
+                    logger.warning("Cannot restore job %r from the queue "
+                                   "journal, dropping it." % (job,),
+                                   exc_info=True)
+                    pushed = False
+                if pushed:
+                    restored += 1
+                else:
+                    self.journal.done(job)
+        if restored > 0:
+            logger.info("Restored %d jobs from the queue journal." %
+                        restored)
+
+    def job_to_do(self, job, session):
+        """Return whether a job still has to be done according to the
+        database, that is, whether its submission or user test and its
+        dataset exist and belong to the contest, and the result is
+        still to be compiled or evaluated.
+
+        job (JobQueueEntry): the job.
+        session (Session): the session to use.
+
+        return (bool): True if the job has to be done.
+
+        """
+        job_type, object_id, dataset_id = job
+        dataset = Dataset.get_from_id(dataset_id, session)
+        if dataset is None or dataset.task.contest_id != self.contest_id:
+            return False
+
+        if job_type in (EvaluationService.JOB_TYPE_COMPILATION,
+                        EvaluationService.JOB_TYPE_EVALUATION):
+            submission = Submission.get_from_id(object_id, session)
+            if submission is None or submission.task_id != dataset.task_id:
+                return False
+            submission_result = submission.get_result(dataset)
+            if job_type == EvaluationService.JOB_TYPE_COMPILATION:
+                return to_compile(submission_result)
+            else:
+                return to_evaluate(submission_result)
+
+        elif job_type in (EvaluationService.JOB_TYPE_TEST_COMPILATION,
+                          EvaluationService.JOB_TYPE_TEST_EVALUATION):
+            user_test = UserTest.get_from_id(object_id, session)
+            if user_test is None or user_test.task_id != dataset.task_id:
+                return False
+            user_test_result = user_test.get_result(dataset)
+            if job_type == EvaluationService.JOB_TYPE_TEST_COMPILATION:
+                return user_test_to_compile(user_test_result)
+            else:
+                return user_test_to_evaluate(user_test_result)
+
+        return False
+
+    def compact_journal(self):
+        """Compact the journal of the queue.
+
+        """
+        self.journal.compact()
+        return True
+
+    def owns(self, object_id):
+        """Return whether this shard is in charge of an object.
+
+        object_id (int): the id of a submission or of a user test.
+
+        returns (bool): True if the object is compiled and evaluated
+                        by this shard.
+
+        """
+        return get_evaluation_shard(object_id) == self.shard
+
+    def check_jobs_not_done(self):
+        """Periodically look for jobs not done, considering only the
+        submissions and user tests not seen before, except once in a
+        while (see JOBS_NOT_DONE_FULL_CHECK_TIME).
+
+        """
+        full = self.last_full_search is None or \
+            make_datetime() - self.last_full_search >= \
+            EvaluationService.JOBS_NOT_DONE_FULL_CHECK_TIME
+        self.search_jobs_not_done(full=full)
+
+        # Run forever.
+        return True
 
     @rpc_method
-    def search_jobs_not_done(self):
+    def search_jobs_not_done(self, full=True):
         """Look in the database for submissions that have not been
         compiled or evaluated for no good reasons. Put the missing job
         in the queue.
 
+        Only the results in a non-final state (or missing) are fetched
+        from the database, using the partial indexes on the result
+        tables.
+
+        full (bool): if False, look only at the submissions and user
+            tests newer than the ones seen by the previous search.
+
         """
+        # In a full search, the jobs to do for submissions we already
+        # saw are due to a change of the datasets to judge, hence they
+        # go in the bulk lane.
+        if full:
+            self.last_full_search = make_datetime()
+            submission_watermark = 0
+            user_test_watermark = 0
+            bulk_watermark = self.submission_watermark
+        else:
+            submission_watermark = self.submission_watermark
+            user_test_watermark = self.user_test_watermark
+            bulk_watermark = 0
+
         new_jobs = 0
         with SessionGen() as session:
-            contest = session.query(Contest).\
-                filter_by(id=self.contest_id).first()
-
-            # Only adding submission not compiled/evaluated that have
-            # not yet reached the limit of tries.
-            for submission in contest.get_submissions():
-                for dataset in get_datasets_to_judge(submission.task):
-                    submission_result = \
-                        submission.get_result_or_create(dataset)
-                    if to_compile(submission_result):
-                        if self.push_in_queue(
-                                JobQueueEntry(
-                                    EvaluationService.JOB_TYPE_COMPILATION,
-                                    submission.id,
-                                    dataset.id),
-                                EvaluationService.JOB_PRIORITY_HIGH,
-                                submission.timestamp):
-                            new_jobs += 1
-                    elif to_evaluate(submission_result):
-                        if self.push_in_queue(
-                                JobQueueEntry(
-                                    EvaluationService.JOB_TYPE_EVALUATION,
-                                    submission.id,
-                                    dataset.id),
-                                EvaluationService.JOB_PRIORITY_MEDIUM,
-                                submission.timestamp):
-                            new_jobs += 1
-
-            # The same for user tests
-            for user_test in contest.get_user_tests():
-                for dataset in get_datasets_to_judge(user_test.task):
-                    user_test_result = \
-                        user_test.get_result_or_create(dataset)
-                    if user_test_to_compile(user_test_result):
-                        if self.push_in_queue(
-                                JobQueueEntry(
-                                    EvaluationService.
-                                    JOB_TYPE_TEST_COMPILATION,
-                                    user_test.id,
-                                    dataset.id),
-                                EvaluationService.JOB_PRIORITY_HIGH,
-                                user_test.timestamp):
-                            new_jobs += 1
-                    elif user_test_to_evaluate(user_test_result):
-                        if self.push_in_queue(
-                                JobQueueEntry(
-                                    EvaluationService.JOB_TYPE_TEST_EVALUATION,
-                                    user_test.id,
-                                    dataset.id),
-                                EvaluationService.JOB_PRIORITY_MEDIUM,
-                                user_test.timestamp):
-                            new_jobs += 1
+            # We read the new watermarks before searching, so that
+            # objects created during the search are considered again
+            # by the next one.
+            new_submission_watermark = session.query(
+                func.max(Submission.id))\
+                .join(Task, Submission.task_id == Task.id)\
+                .filter(Task.contest_id == self.contest_id).scalar()
+            new_user_test_watermark = session.query(
+                func.max(UserTest.id))\
+                .join(Task, UserTest.task_id == Task.id)\
+                .filter(Task.contest_id == self.contest_id).scalar()
+
+            new_jobs += self._search_jobs_not_done(
+                session, Submission, SubmissionResult,
+                SubmissionResult.submission_id, submission_watermark,
+                bulk_watermark,
+                EvaluationService.JOB_TYPE_COMPILATION,
+                EvaluationService.MAX_COMPILATION_TRIES,
+                EvaluationService.JOB_TYPE_EVALUATION,
+                EvaluationService.MAX_EVALUATION_TRIES)
+            new_jobs += self._search_jobs_not_done(
+                session, UserTest, UserTestResult,
+                UserTestResult.user_test_id, user_test_watermark, 0,
+                EvaluationService.JOB_TYPE_TEST_COMPILATION,
+                EvaluationService.MAX_TEST_COMPILATION_TRIES,
+                EvaluationService.JOB_TYPE_TEST_EVALUATION,
+                EvaluationService.MAX_TEST_EVALUATION_TRIES)
 
             session.commit()
 
+        if new_submission_watermark is not None:
+            self.submission_watermark = max(self.submission_watermark,
+                                            new_submission_watermark)
+        if new_user_test_watermark is not None:
+            self.user_test_watermark = max(self.user_test_watermark,
+                                           new_user_test_watermark)
+
         if new_jobs > 0:
             logger.info("Found %s submissions or user tests with "
                         "jobs to do." % new_jobs)
@@ -750,6 +2554,134 @@ class EvaluationService(Service):
         # Run forever.
         return True
 
+    def _search_jobs_not_done(self, session, cls, result_cls, result_id,
+                              watermark, bulk_watermark,
+                              compilation_type, max_compilations,
+                              evaluation_type, max_evaluations):
+        """Queue the jobs to do for submissions or for user tests.
+
+        This mirrors to_compile and to_evaluate (or their user test
+        counterparts), but the checks are done by the database.
+
+        session (Session): the database session to use.
+        cls (type): either Submission or UserTest.
+        result_cls (type): either SubmissionResult or UserTestResult.
+        result_id (Column): the column of result_cls referring to cls.
+        watermark (int): consider only the objects with a larger id.
+        bulk_watermark (int): put in the bulk lane the jobs of the
+            objects with a smaller or equal id.
+        compilation_type (string): the type of the compilation jobs.
+        max_compilations (int): the maximum number of compilation
+            tries.
+        evaluation_type (string): the type of the evaluation jobs.
+        max_evaluations (int): the maximum number of evaluation tries.
+
+        return (int): the number of jobs added to the queue.
+
+        """
+        new_jobs = 0
+
+        # Keep "== None" and "== True" in filter arguments. SQLAlchemy
+        # does not understand "is None" and "is True".
+        to_judge = or_(Dataset.autojudge == True,  # noqa
+                       Dataset.id == Task.active_dataset_id)
+
+        # The other shards take care of the other objects (see owns).
+        shards = get_service_shards("EvaluationService")
+
+        # First, the objects that lack a result for some dataset to
+        # judge: we create it, and they have to be compiled.
+        missing = session.query(cls, Dataset)\
+            .join(Task, cls.task_id == Task.id)\
+            .join(Dataset, Dataset.task_id == Task.id)\
+            .outerjoin(result_cls, and_(result_id == cls.id,
+                                        result_cls.dataset_id == Dataset.id))\
+            .filter(Task.contest_id == self.contest_id)\
+            .filter(cls.id > watermark)\
+            .filter(to_judge)\
+            .filter(result_id == None)  # noqa
+        if shards > 1:
+            missing = missing.filter(cls.id % shards == self.shard)
+        for obj, dataset in missing.all():
+            result = obj.get_result_or_create(dataset)
+            if cls is Submission:
+                self.update_submissions_status(result, None)
+            if self.push_in_queue(
+                    JobQueueEntry(compilation_type, obj.id, dataset.id),
+                    EvaluationService.JOB_PRIORITY_HIGH,
+                    obj.timestamp,
+                    LANE_BULK if obj.id <= bulk_watermark else None,
+                    obj.user_id):
+                new_jobs += 1
+
+        # Then, the results in a non-final state, that have not yet
+        # reached the limit of tries.
+        pending = session.query(result_id, result_cls.dataset_id,
+                                result_cls.compilation_outcome,
+                                cls.timestamp, cls.user_id)\
+            .join(cls, result_id == cls.id)\
+            .join(Task, cls.task_id == Task.id)\
+            .join(Dataset, result_cls.dataset_id == Dataset.id)\
+            .filter(Task.contest_id == self.contest_id)\
+            .filter(cls.id > watermark)\
+            .filter(to_judge)\
+            .filter(or_(
+                and_(result_cls.compilation_outcome == None,
+                     result_cls.compilation_tries < max_compilations),
+                and_(result_cls.compilation_outcome == "ok",
+                     result_cls.evaluation_outcome == None,
+                     result_cls.evaluation_tries < max_evaluations)))  # noqa
+        if shards > 1:
+            pending = pending.filter(cls.id % shards == self.shard)
+        for object_id, dataset_id, compilation_outcome, timestamp, user_id \
+                in pending.all():
+            if compilation_outcome is None:
+                job = JobQueueEntry(compilation_type, object_id, dataset_id)
+                priority = EvaluationService.JOB_PRIORITY_HIGH
+            else:
+                job = JobQueueEntry(evaluation_type, object_id, dataset_id)
+                priority = EvaluationService.JOB_PRIORITY_MEDIUM
+            if self.push_in_queue(job, priority, timestamp,
+                                  LANE_BULK if object_id <= bulk_watermark
+                                  else None,
+                                  user_id):
+                new_jobs += 1
+
+        return new_jobs
+
+    def _dispatcher_loop(self):
+        """Dispatch the jobs to the workers whenever it may be possible.
+
+        This is an infinite loop that waits for a call to
+        trigger_dispatch (or for CHECK_DISPATCH_TIME to pass, as a
+        safety net) and then dispatches as many jobs as it can. Any
+        error is sent to the logger and then suppressed, because the
+        loop must go on.
+
+        """
+        while True:
+            triggered = self._dispatcher_event.wait(
+                EvaluationService.CHECK_DISPATCH_TIME.total_seconds())
+            self._dispatcher_event.clear()
+
+            try:
+                if triggered:
+                    while self.dispatch_one_job():
+                        pass
+                else:
+                    self.dispatch_jobs()
+            except Exception:
+                logger.error("Unexpected error when dispatching jobs.",
+                             exc_info=True)
+
+    def trigger_dispatch(self):
+        """Make the dispatcher loop try to dispatch jobs as soon as
+        possible. To be called whenever a job enters the queue or a
+        worker becomes available.
+
+        """
+        self._dispatcher_event.set()
+
     def dispatch_jobs(self):
         """Check if there are pending jobs, and tries to distribute as
         many of them to the available workers.
@@ -777,13 +2709,232 @@ class EvaluationService(Service):
         except LookupError:
             return False
 
-        res = self.pool.acquire_worker(job, side_data=(priority, timestamp))
+        try:
+            if self.compile_from_cache(job) or \
+                    self.evaluate_from_memo(job):
+                return True
+            res = self.pool.acquire_worker(job,
+                                           side_data=(priority, timestamp),
+                                           skip=self.memoized.get(job))
+        except JobGoneError:
+            # The job was removed (or invalidated) while it was loaded
+            # from the database: we try with the new top.
+            return True
+        except Exception:
+            # Otherwise it would stay at the top, blocking the others.
+            # The next full search for jobs not done will find it
+            # again (see check_jobs_not_done).
+            logger.error("Cannot load job %r, dropping it." % (job,),
+                         exc_info=True)
+            self.remove_job(job)
+            return True
         if res is not None:
-            self.queue.pop()
+            # Other jobs may have entered the queue while the job was
+            # loaded from the database, hence it may not be the top
+            # anymore.
+            if job in self.queue:
+                self.queue.remove(job, served=True)
+            self.job_times.setdefault(job, {})["started"] = make_datetime()
             return True
         else:
+            # All workers are busy: we prepare the one finishing first
+            # for the next job.
+            if config.prefetch_files and job != self.prefetched_job:
+                self.prefetched_job = job
+                self.pool.prefetch(job, self.memoized.get(job))
+            return False
+
+    def compile_from_cache(self, job):
+        """If job is a compilation of sources already compiled, reuse
+        the result of the previous compilation instead of giving it
+        to a worker.
+
+        job (JobQueueEntry): the job at the top of the queue.
+
+        return (bool): True if the job left the queue, because it was
+            done using the cache (or removed in the meantime).
+
+        """
+        if job.job_type not in (EvaluationService.JOB_TYPE_COMPILATION,
+                                EvaluationService.JOB_TYPE_TEST_COMPILATION) \
+                or job == self.compilation_cache_missed \
+                or job in self.recompile:
+            return False
+
+        with SessionGen() as session:
+            job_group = WorkerPool.get_job_group(job, session)
+        # The queue may have changed while loading the job.
+        if job not in self.queue:
+            return True
+        if not self.compilation_cache.fill(job_group):
+            self.compilation_cache_missed = job
+            return False
+
+        logger.info("Action %s for submission %s completed using the "
+                    "result of an identical compilation." %
+                    (job.job_type, job.object_id))
+        self.queue.remove(job, served=True)
+        self.journal.done(job)
+        job_times = self.job_times.pop(job, {})
+        job_times["received"] = make_datetime()
+        self.store_result(job, True, job_group, job_times)
+        self.forget_result(job)
+        return True
+
+    def evaluate_from_memo(self, job):
+        """If job is an evaluation of an executable already evaluated
+        on some of the same testcases (see EvaluationMemo and
+        reuse_other_datasets), reuse those outcomes; if there are all
+        of them, complete the job without giving it to a worker.
+
+        job (JobQueueEntry): the job at the top of the queue.
+
+        return (bool): True if the job left the queue, because it was
+            done using the memo (or removed in the meantime).
+
+        """
+        if job.job_type != EvaluationService.JOB_TYPE_EVALUATION \
+                or job in self.memoized:
+            return False
+
+        with SessionGen() as session:
+            job_group = WorkerPool.get_job_group(job, session)
+            self.memoized[job] = self.evaluation_memo.fill(job_group)
+            if not job_group.success:
+                self.memoized[job].update(self.reuse_other_datasets(
+                    job, job_group, session))
+        # The queue may have changed while loading the job.
+        if job not in self.queue:
+            self.memoized.pop(job, None)
+            return True
+        if not job_group.success:
+            if len(self.memoized[job]) > 0:
+                logger.info("Action %s for submission %s will reuse the "
+                            "outcomes of %d testcases." %
+                            (job.job_type, job.object_id,
+                             len(self.memoized[job])))
             return False
 
+        logger.info("Action %s for submission %s completed using the "
+                    "outcomes of an identical executable." %
+                    (job.job_type, job.object_id))
+        del self.memoized[job]
+        self.queue.remove(job, served=True)
+        self.journal.done(job)
+        job_times = self.job_times.pop(job, {})
+        job_times["received"] = make_datetime()
+        self.store_result(job, True, job_group, job_times)
+        self.forget_result(job)
+        return True
+
+    @staticmethod
+    def reuse_other_datasets(job, job_group, session):
+        """Fill the testcases of an evaluation that have not changed
+        since another dataset of the task on which the submission was
+        already evaluated (e.g., a dataset that was cloned to fix some
+        testcases).
+
+        job (JobQueueEntry): the evaluation.
+        job_group (JobGroup): the job group of the evaluation, as
+            returned by WorkerPool.get_job_group.
+        session (Session): the session to use.
+
+        return ({string: EvaluationJob}): the jobs that were filled.
+
+        """
+        dataset = Dataset.get_from_id(job.dataset_id, session)
+        submission = Submission.get_from_id(job.object_id, session)
+        filled = {}
+        for submission_result in submission.results:
+            if submission_result.dataset_id != dataset.id and \
+                    submission_result.evaluated():
+                filled.update(EvaluationService.reuse_evaluations(
+                    job_group, dataset, submission_result))
+        return filled
+
+    @staticmethod
+    def reuse_evaluations(job_group, dataset, submission_result):
+        """Fill the jobs of an evaluation with the outcomes of the
+        evaluation of the same executables on another dataset, for
+        the testcases that are the same in both.
+
+        job_group (JobGroup): the evaluation on dataset.
+        dataset (Dataset): the dataset of job_group.
+        submission_result (SubmissionResult): the evaluated result of
+            the same submission on another dataset.
+
+        return ({string: EvaluationJob}): the jobs that were filled.
+
+        """
+        other = submission_result.dataset
+        if (other.task_type, other.task_type_parameters,
+                other.time_limit, other.memory_limit) != \
+                (dataset.task_type, dataset.task_type_parameters,
+                 dataset.time_limit, dataset.memory_limit) or \
+                dict((filename, manager.digest)
+                     for filename, manager in other.managers.iteritems()) != \
+                dict((filename, manager.digest)
+                     for filename, manager in dataset.managers.iteritems()):
+            return {}
+        executables = dict((filename, executable.digest)
+                           for filename, executable
+                           in submission_result.executables.iteritems())
+        # As in EvaluationMemo._storable, the outcomes of executions
+        # that timed out are not reused (sandbox errors are not
+        # stored at all); timeouts are recognized from their text,
+        # since the evaluations do not keep the exit status.
+        timeout_text = human_evaluation_message(
+            {'exit_status': Sandbox.EXIT_TIMEOUT})
+
+        filled = {}
+        for evaluation in submission_result.evaluations:
+            codename = evaluation.codename
+            job = job_group.jobs.get(codename)
+            if job is None or job.success or \
+                    json.loads(evaluation.text) == timeout_text or \
+                    (evaluation.testcase.input, evaluation.testcase.output) \
+                    != (job.input, job.output) or \
+                    dict((filename, executable.digest)
+                         for filename, executable
+                         in job.executables.iteritems()) != executables:
+                continue
+            job.success = True
+            job.outcome = evaluation.outcome
+            job.text = json.loads(evaluation.text)
+            job.plus = {
+                'execution_time': evaluation.execution_time,
+                'execution_wall_clock_time':
+                evaluation.execution_wall_clock_time,
+                'execution_memory': evaluation.execution_memory}
+            job.shard = evaluation.evaluation_shard
+            job.sandboxes = evaluation.evaluation_sandbox.split(":") \
+                if evaluation.evaluation_sandbox else []
+            filled[codename] = job
+
+        if all(job.success for job in job_group.jobs.itervalues()):
+            job_group.success = True
+        return filled
+
+    @rpc_method
+    def evaluation_memo_status(self):
+        """Returns the statistics of the evaluation memo (see
+        ResultCache.get_status).
+
+        returns (dict): the statistics.
+
+        """
+        return self.evaluation_memo.get_status()
+
+    @rpc_method
+    def compilation_cache_status(self):
+        """Returns the statistics of the compilation cache (see
+        ResultCache.get_status).
+
+        returns (dict): the statistics.
+
+        """
+        return self.compilation_cache.get_status()
+
     @rpc_method
     def submissions_status(self):
         """Returns a dictionary of statistics about the number of
@@ -795,11 +2946,49 @@ class EvaluationService(Service):
         check from the admin.
 
         The status of a submission is checked on its result for the
-        active dataset of its task.
+        active dataset of its task (see submission_result_status).
+
+        The statistics are kept in memory, updated at every change we
+        make to a submission result, and recomputed periodically from
+        the database (to account for the changes done by others, for
+        example the scoring).
 
         return (dict): statistics on the submissions.
 
         """
+        if self.submissions_stats is None:
+            self.check_submissions_status()
+        return dict(self.submissions_stats)
+
+    def check_submissions_status(self):
+        """Recompute the statistics on the submissions from the
+        database, with a single grouped query.
+
+        """
+        r = SubmissionResult
+        status = case([
+            (r.compilation_outcome == "fail", "compilation_fail"),
+            (and_(r.compilation_outcome == None,
+                  r.compilation_tries >=
+                  EvaluationService.MAX_COMPILATION_TRIES),
+             "max_compilations"),
+            (r.compilation_outcome == None, "compiling"),
+            (and_(r.compilation_outcome == "ok",
+                  r.evaluation_outcome != None,
+                  r.score != None,
+                  r.score_details != None,
+                  r.public_score != None,
+                  r.public_score_details != None,
+                  r.ranking_score_details != None), "scored"),
+            (and_(r.compilation_outcome == "ok",
+                  r.evaluation_outcome != None), "evaluated"),
+            (and_(r.compilation_outcome == "ok",
+                  r.evaluation_tries >=
+                  EvaluationService.MAX_EVALUATION_TRIES),
+             "max_evaluations"),
+            (r.compilation_outcome == "ok", "evaluating"),
+            ], else_="invalid").label("status")  # noqa
+
         stats = {
             "scored": 0,
             "evaluated": 0,
@@ -810,42 +2999,151 @@ class EvaluationService(Service):
             "max_evaluations": 0,
             "invalid": 0}
         with SessionGen() as session:
-            contest = Contest.get_from_id(self.contest_id, session)
-            for submission_result in contest.get_submission_results():
-                if submission_result.compilation_failed():
-                    stats["compilation_fail"] += 1
-                elif not submission_result.compiled():
-                    if submission_result.compilation_tries >= \
-                            EvaluationService.MAX_COMPILATION_TRIES:
-                        stats["max_compilations"] += 1
-                    else:
-                        stats["compiling"] += 1
-                elif submission_result.compilation_succeeded():
-                    if submission_result.evaluated():
-                        if submission_result.scored():
-                            stats["scored"] += 1
-                        else:
-                            stats["evaluated"] += 1
-                    else:
-                        if submission_result.evaluation_tries >= \
-                                EvaluationService.MAX_EVALUATION_TRIES:
-                            stats["max_evaluations"] += 1
-                        else:
-                            stats["evaluating"] += 1
-                else:
-                    # Should not happen.
-                    stats["invalid"] += 1
-        return stats
+            query = session.query(status, func.count())\
+                .select_from(SubmissionResult)\
+                .join(Submission, r.submission_id == Submission.id)\
+                .join(Task, Submission.task_id == Task.id)\
+                .filter(Task.contest_id == self.contest_id)\
+                .filter(Task.active_dataset_id == r.dataset_id)
+            shards = get_service_shards("EvaluationService")
+            if shards > 1:
+                query = query.filter(Submission.id % shards == self.shard)
+            for key, count in query.group_by("status").all():
+                stats[key] = count
+
+        self.submissions_stats = stats
+
+        # Run forever.
+        return True
+
+    def update_submissions_status(self, submission_result, old_status):
+        """Update the statistics on the submissions after a change to
+        a submission result.
+
+        submission_result (SubmissionResult): the changed submission
+            result.
+        old_status (string): its status before the change (as given
+            by submission_result_status), or None if it has just been
+            created.
+
+        """
+        if self.submissions_stats is None:
+            return
+        submission = submission_result.submission
+        if submission_result.dataset is not submission.task.active_dataset:
+            return
+        if old_status is not None:
+            self.submissions_stats[old_status] -= 1
+        self.submissions_stats[
+            submission_result_status(submission_result)] += 1
 
     @rpc_method
     def queue_status(self):
-        """Returns a list whose elements are the jobs currently in the
-        queue (see Queue.get_status).
+        """Returns the jobs currently in the queue, and the status of
+        its lanes (see LaneJobQueue.get_status and get_lanes_status).
+
+        returns (dict): the list of queued elements (under the key
+                        "jobs") and the dictionary with the status of
+                        each lane (under the key "lanes"), including
+                        the predicted time to empty it (under the key
+                        "completion").
+
+        """
+        lanes = self.queue.get_lanes_status()
+        # How long each lane would take to be emptied if it had all
+        # the workers, given the estimated costs of its jobs.
+        workers = self.pool.count_workers()
+        for lane in lanes.itervalues():
+            lane["completion"] = max(lane["cost"] / workers,
+                                     lane["max_cost"]) \
+                if workers > 0 else None
+        return {"jobs": self.queue.get_status(),
+                "lanes": lanes,
+                "users": self.users_status()}
+
+    @rpc_method
+    def job_progress(self, shard, slot, done):
+        """Called by a worker each time it starts or finishes a job
+        of its current job group, to show it is not stuck.
+
+        shard (int): the shard of the worker.
+        slot (int): the slot doing the job group.
+        done (int): how many jobs of the group are done.
+
+        """
+        self.pool.record_progress(shard * config.worker_slots + slot, done)
+
+    @rpc_method
+    def queue_load(self):
+        """Returns the length of each lane of the queue and the time a
+        new job in it would take to be completed, as estimated from
+        the recent throughput of the workers. Meant to be called often
+        (e.g., by ContestWebServer to inform the contestants).
+
+        returns (dict): for each lane, a dictionary with its length
+                        and the estimated wait in seconds (None if it
+                        cannot be estimated yet).
+
+        """
+        throughput = self.pool.get_throughput()
+        if throughput is None:
+            return dict((name, {"length": self.queue.length(lane=name),
+                                "estimated_wait": None})
+                        for name, _ in EvaluationService.LANES)
+        return self.queue.get_estimated_waits(throughput)
+
+    def record_latency(self, stage, job_type, task_id, latency):
+        """Add a duration to the histogram of the latencies of a stage
+        of the jobs.
+
+        stage (string): one of "queue" (from push_in_queue to
+            acquire_worker), "execution" (until the worker reports
+            back), "write" (storing the result in action_finished)
+            and "scoring" (handing the result to ScoringService).
+        job_type (string): the type of the job.
+        task_id (int): the task of the submission or user test.
+        latency (timedelta): the duration.
+
+        """
+        key = (stage, job_type, task_id)
+        if key not in self.latencies:
+            self.latencies[key] = LatencyHistogram()
+        self.latencies[key].add(latency.total_seconds())
+
+    @rpc_method
+    def latency_status(self):
+        """Returns the histograms of the latencies of the stages of
+        the jobs (see record_latency).
+
+        returns (list): a list of dictionaries with the stage, the job
+                        type, the task id and the histogram (see
+                        LatencyHistogram.get_status).
 
-        returns (list): the list with the queued elements.
+        """
+        return [{"stage": stage,
+                 "job_type": job_type,
+                 "task_id": task_id,
+                 "histogram": histogram.get_status()}
+                for (stage, job_type, task_id), histogram
+                in self.latencies.iteritems()]
+
+    def users_status(self):
+        """Returns the number of outstanding jobs of each user, that
+        is, of jobs in the queue or assigned to a worker.
+
+        returns (dict): for each user id, a dictionary with the number
+                        of jobs in the queue and assigned to a worker.
 
         """
-        return self.queue.get_status()
+        ret = dict((user, {"queued": count, "running": 0})
+                   for user, count in
+                   self.queue.get_users_status().iteritems())
+        for job in self.pool.get_jobs():
+            user = self.result_users.get(self.job_result(job))
+            if user is not None:
+                ret.setdefault(user, {"queued": 0, "running": 0})
+                ret[user]["running"] += 1
+        return ret
 
     @rpc_method
     def workers_status(self):
@@ -867,7 +3165,8 @@ class EvaluationService(Service):
         for priority, timestamp, job in lost_jobs:
             logger.info("Job %r put again in the queue because of "
                         "worker timeout." % (job,))
-            self.push_in_queue(job, priority, timestamp)
+            if not self.push_in_queue(job, priority, timestamp):
+                self.forget_result(job)
         return True
 
     def check_workers_connection(self):
@@ -879,7 +3178,28 @@ class EvaluationService(Service):
         for priority, timestamp, job in lost_jobs:
             logger.info("Job %r put again in the queue because of "
                         "disconnected worker." % (job,))
-            self.push_in_queue(job, priority, timestamp)
+            if not self.push_in_queue(job, priority, timestamp):
+                self.forget_result(job)
+        return True
+
+    def check_stragglers(self):
+        """We ask WorkerPool for the jobs that are taking too long, and
+        if there is nothing else to do we give a copy of them to idle
+        workers.
+
+        """
+        if not self.queue.empty():
+            return True
+        for job in self.pool.find_stragglers():
+            try:
+                shard = self.pool.speculate(job, self.memoized.get(job))
+            except JobGoneError:
+                # The job finished in the meantime.
+                continue
+            if shard is None:
+                break
+            logger.info("Job %r given also to worker %s because it is "
+                        "taking too long." % (job, shard))
         return True
 
     def submission_busy(self, submission_id, dataset_id):
@@ -932,11 +3252,88 @@ class EvaluationService(Service):
         else:
             raise Exception("Wrong job type %s" % job_type)
 
-    def push_in_queue(self, job, priority, timestamp):
+    def job_lane(self, job):
+        """Return the lane of the queue a job belongs to.
+
+        job (JobQueueEntry): the job.
+
+        return (string): one of the cms.service.LANE_*.
+
+        """
+        job_type, object_id, dataset_id = job
+        if job_type in (EvaluationService.JOB_TYPE_TEST_COMPILATION,
+                        EvaluationService.JOB_TYPE_TEST_EVALUATION):
+            return LANE_TEST
+        elif (object_id, dataset_id) in self.bulk_results:
+            return LANE_BULK
+        else:
+            return LANE_LIVE
+
+    def job_result(self, job):
+        """Return the submission or user test result a job is about.
+
+        job (JobQueueEntry): the job.
+
+        return ((bool, int, int)): whether the job is about a user
+            test, the id of the submission or user test, and the id of
+            the dataset.
+
+        """
+        job_type, object_id, dataset_id = job
+        return (job_type in (EvaluationService.JOB_TYPE_TEST_COMPILATION,
+                             EvaluationService.JOB_TYPE_TEST_EVALUATION),
+                object_id, dataset_id)
+
+    def forget_result(self, job):
+        """Forget the lane and the user of the submission or user test
+        result a job is about, unless it still has jobs in the queue
+        or assigned to a worker. To be called whenever a job leaves
+        the queue or the pool, in any way.
+
+        job (JobQueueEntry): the job.
+
+        """
+        if self.job_busy(job):
+            return
+        if job.job_type in (EvaluationService.JOB_TYPE_COMPILATION,
+                            EvaluationService.JOB_TYPE_EVALUATION):
+            self.bulk_results.discard((job.object_id, job.dataset_id))
+        self.result_users.pop(self.job_result(job), None)
+
+    def remove_job(self, job):
+        """Take a job out of the queue or the pool, forgetting about
+        it, if it is there.
+
+        job (JobQueueEntry): the job.
+
+        """
+        try:
+            self.queue.remove(job)
+        except KeyError:
+            pass  # Ok, the job wasn't in the queue.
+        try:
+            self.pool.ignore_job(job)
+        except LookupError:
+            pass  # Ok, the job wasn't in the pool.
+        self.journal.done(job)
+        self.job_times.pop(job, None)
+        self.memoized.pop(job, None)
+        self.recompile.discard(job)
+        self.forget_result(job)
+
+    def push_in_queue(self, job, priority, timestamp, lane=None,
+                      user_id=None):
         """Push a job in the job queue if the submission is not
         already in the queue or assigned to a worker.
 
         job (JobQueueEntry): the job to put in the queue.
+        lane (string): the lane of the queue to use, or None to use
+            the one given by job_lane. If it is the bulk lane, also
+            the following jobs of the same submission will be put
+            there.
+        user_id (int): the id of the user owning the submission or
+            user test, or None to use the one of the previous jobs of
+            the same result (if any).
 
         return (bool): True if pushed, False if not.
 
@@ -944,7 +3341,21 @@ class EvaluationService(Service):
         if self.job_busy(job):
             return False
         else:
-            self.queue.push(job, priority, timestamp)
+            if lane is None:
+                lane = self.job_lane(job)
+            elif lane == LANE_BULK and \
+                    job.job_type in (EvaluationService.JOB_TYPE_COMPILATION,
+                                     EvaluationService.JOB_TYPE_EVALUATION):
+                self.bulk_results.add((job.object_id, job.dataset_id))
+            if user_id is None:
+                user_id = self.result_users.get(self.job_result(job))
+            else:
+                self.result_users[self.job_result(job)] = user_id
+            self.queue.push(job, priority, timestamp, lane, user_id,
+                            self.cost_model.estimate(job, user_id))
+            self.journal.push(job, priority, timestamp, lane, user_id)
+            self.job_times[job] = {"pushed": make_datetime()}
+            self.trigger_dispatch()
             return True
 
     def action_finished(self, data, plus, error=None):
@@ -970,11 +3381,16 @@ class EvaluationService(Service):
         # returning True) we interrupt the execution of this method and
         # do nothing because in that case we know the job has returned
         # to the queue and perhaps already been reassigned to another
-        # worker.
-        if self.pool.release_worker(shard):
+        # worker. In any case, the worker can now take another job.
+        ignore = self.pool.release_worker(shard)
+        self.trigger_dispatch()
+        if ignore:
+            self.forget_result(
+                JobQueueEntry(job_type, object_id, dataset_id))
             return
 
         job_success = True
+        job_group = None
         if error is not None:
             logger.error("Received error from Worker: `%s'." % error)
             job_success = False
@@ -993,11 +3409,78 @@ class EvaluationService(Service):
                                  "not successful." % shard)
                     job_success = False
 
-        _, timestamp = side_data
+        # If the job was given to many workers because it was taking
+        # too long, we use the first successful result and ignore the
+        # other copies; a failure is ignored as long as another copy
+        # is still running.
+        job = JobQueueEntry(job_type, object_id, dataset_id)
+        if not self.pool.is_split(job) and job in self.pool:
+            if not job_success:
+                logger.info("Action %s for submission %s failed on worker "
+                            "%s, waiting for its copy." %
+                            (job_type, object_id, shard))
+                return
+            self.pool.drop_copies(job)
+
+        # If the job was split in chunks among many workers, we wait
+        # for all of them before storing the result. If a chunk
+        # failed, the other ones are useless, as the job is going to
+        # be retried as a whole.
+        if self.pool.is_split(job):
+            if not job_success:
+                self.pool.abort_chunks(job)
+            else:
+                job_group = self.pool.merge_chunk(job, shard, job_group)
+                if job_group is None:
+                    logger.info("Chunk of action %s for submission %s "
+                                "completed by worker %s." %
+                                (job_type, object_id, shard))
+                    return
+
+        # The job is not to be done anymore (if it needs to be
+        # retried, it will be pushed again).
+        self.journal.done(job)
+        job_times = self.job_times.pop(job, {})
+        job_times["received"] = make_datetime()
+        memoized = self.memoized.pop(job, {})
+        self.recompile.discard(job)
 
         logger.info("Action %s for submission %s completed. Success: %s." %
                     (job_type, object_id, job_success))
 
+        # Compilations are deterministic: we remember their results,
+        # to reuse them for identical sources.
+        if job_success and \
+                job_type in (EvaluationService.JOB_TYPE_COMPILATION,
+                             EvaluationService.JOB_TYPE_TEST_COMPILATION):
+            self.compilation_cache.add(job_group)
+
+        # Evaluations are deterministic too, given the executable and
+        # the testcase; we complete the job with the outcomes we
+        # already knew.
+        if job_success and \
+                job_type == EvaluationService.JOB_TYPE_EVALUATION:
+            self.evaluation_memo.add(job_group)
+            job_group.jobs.update(memoized)
+
+        self.store_result(job, job_success, job_group, job_times)
+        self.forget_result(job)
+
+    def store_result(self, job, job_success, job_group, job_times):
+        """Write the result of a job in the database, and take the
+        actions that follow (queueing other jobs, notifying other
+        services, ...).
+
+        job (JobQueueEntry): the job.
+        job_success (bool): whether the job was successful.
+        job_group (JobGroup): the result of the job (meaningful only
+            if successful).
+        job_times (dict): the times of the stages of the job, used to
+            record their latencies (see record_latency).
+
+        """
+        job_type, object_id, dataset_id = job
+
         # We get the submission from DB and update it.
         with SessionGen() as session:
             if job_type == EvaluationService.JOB_TYPE_COMPILATION:
@@ -1009,12 +3492,16 @@ class EvaluationService(Service):
                                  (object_id, dataset_id))
                     return
 
+                old_status = submission_result_status(submission_result)
                 submission_result.compilation_tries += 1
 
                 if job_success:
                     job_group.to_submission_compilation(submission_result)
 
                 self.compilation_ended(submission_result)
+                self.update_submissions_status(submission_result,
+                                               old_status)
+                task_id = submission_result.submission.task_id
 
             elif job_type == EvaluationService.JOB_TYPE_EVALUATION:
                 submission_result = SubmissionResult.get_from_id(
@@ -1025,12 +3512,20 @@ class EvaluationService(Service):
                                  (object_id, dataset_id))
                     return
 
+                old_status = submission_result_status(submission_result)
                 submission_result.evaluation_tries += 1
 
                 if job_success:
                     job_group.to_submission_evaluation(submission_result)
+                    self.cost_model.record(
+                        submission_result.submission.task_id,
+                        submission_result.submission.user_id,
+                        job_group)
 
                 self.evaluation_ended(submission_result)
+                self.update_submissions_status(submission_result,
+                                               old_status)
+                task_id = submission_result.submission.task_id
 
             elif job_type == EvaluationService.JOB_TYPE_TEST_COMPILATION:
                 user_test_result = UserTestResult.get_from_id(
@@ -1047,6 +3542,7 @@ class EvaluationService(Service):
                     job_group.to_user_test_compilation(user_test_result)
 
                 self.user_test_compilation_ended(user_test_result)
+                task_id = user_test_result.user_test.task_id
 
             elif job_type == EvaluationService.JOB_TYPE_TEST_EVALUATION:
                 user_test_result = UserTestResult.get_from_id(
@@ -1063,6 +3559,7 @@ class EvaluationService(Service):
                     job_group.to_user_test_evaluation(user_test_result)
 
                 self.user_test_evaluation_ended(user_test_result)
+                task_id = user_test_result.user_test.task_id
 
             else:
                 logger.error("Invalid job type %r." % job_type)
@@ -1070,6 +3567,15 @@ class EvaluationService(Service):
 
             session.commit()
 
+        if "pushed" in job_times and "started" in job_times:
+            self.record_latency("queue", job_type, task_id,
+                                job_times["started"] - job_times["pushed"])
+        if "started" in job_times:
+            self.record_latency("execution", job_type, task_id,
+                                job_times["received"] - job_times["started"])
+        self.record_latency("write", job_type, task_id,
+                            make_datetime() - job_times["received"])
+
     def compilation_ended(self, submission_result):
         """Actions to be performed when we have a submission that has
         ended compilation . In particular: we queue evaluation if
@@ -1089,7 +3595,8 @@ class EvaluationService(Service):
                     submission_result.submission_id,
                     submission_result.dataset_id),
                 EvaluationService.JOB_PRIORITY_MEDIUM,
-                submission.timestamp)
+                submission.timestamp,
+                user_id=submission.user_id)
         # If instead submission failed compilation, we don't evaluate,
         # but we inform ScoringService of the new submission. We need
         # to commit before so it has up to date information.
@@ -1101,7 +3608,10 @@ class EvaluationService(Service):
             submission_result.sa_session.commit()
             self.scoring_service.new_evaluation(
                 submission_id=submission_result.submission_id,
-                dataset_id=submission_result.dataset_id)
+                dataset_id=submission_result.dataset_id,
+                callback=self.new_evaluation_callback,
+                plus=(EvaluationService.JOB_TYPE_COMPILATION,
+                      submission.task_id, make_datetime()))
         # If compilation failed for our fault, we requeue or not.
         elif submission_result.compilation_outcome is None:
             if submission_result.compilation_tries > \
@@ -1119,7 +3629,8 @@ class EvaluationService(Service):
                         submission_result.submission_id,
                         submission_result.dataset_id),
                     EvaluationService.JOB_PRIORITY_MEDIUM,
-                    submission.timestamp)
+                    submission.timestamp,
+                    user_id=submission.user_id)
         # Otherwise, error.
         else:
             logger.error("Compilation outcome %r not recognized." %
@@ -1142,7 +3653,10 @@ class EvaluationService(Service):
             submission_result.sa_session.commit()
             self.scoring_service.new_evaluation(
                 submission_id=submission_result.submission_id,
-                dataset_id=submission_result.dataset_id)
+                dataset_id=submission_result.dataset_id,
+                callback=self.new_evaluation_callback,
+                plus=(EvaluationService.JOB_TYPE_EVALUATION,
+                      submission.task_id, make_datetime()))
         # Evaluation unsuccessful, we requeue (or not).
         elif submission_result.evaluation_tries > \
                 EvaluationService.MAX_EVALUATION_TRIES:
@@ -1159,7 +3673,21 @@ class EvaluationService(Service):
                     submission_result.submission_id,
                     submission_result.dataset_id),
                 EvaluationService.JOB_PRIORITY_LOW,
-                submission.timestamp)
+                submission.timestamp,
+                user_id=submission.user_id)
+
+    def new_evaluation_callback(self, data, plus, error=None):
+        """Callback for ScoringService.new_evaluation, to measure how
+        long it takes to hand over a result.
+
+        plus ((string, int, datetime)): the job type, the task id and
+            the time of the call.
+
+        """
+        if error is None:
+            job_type, task_id, sent = plus
+            self.record_latency("scoring", job_type, task_id,
+                                make_datetime() - sent)
 
     def user_test_compilation_ended(self, user_test_result):
         """Actions to be performed when we have a user test that has
@@ -1178,7 +3706,8 @@ class EvaluationService(Service):
                     user_test_result.user_test_id,
                     user_test_result.dataset_id),
                 EvaluationService.JOB_PRIORITY_MEDIUM,
-                user_test.timestamp)
+                user_test.timestamp,
+                user_id=user_test.user_id)
         # If instead user test failed compilation, we don't evaluatate
         elif user_test_result.compilation_failed():
             logger.info("User test %d(%d) did not compile. Not going to "
@@ -1202,7 +3731,8 @@ class EvaluationService(Service):
                         user_test_result.user_test_id,
                         user_test_result.dataset_id),
                     EvaluationService.JOB_PRIORITY_MEDIUM,
-                    user_test.timestamp)
+                    user_test.timestamp,
+                    user_id=user_test.user_id)
         # Otherwise, error.
         else:
             logger.error("Compilation outcome %r not recognized." %
@@ -1233,7 +3763,8 @@ class EvaluationService(Service):
                         user_test_result.user_test_id,
                         user_test_result.dataset_id),
                     EvaluationService.JOB_PRIORITY_LOW,
-                    user_test.timestamp)
+                    user_test.timestamp,
+                    user_id=user_test.user_id)
 
     @rpc_method
     def new_submission(self, submission_id):
@@ -1246,6 +3777,11 @@ class EvaluationService(Service):
         returns (bool): True if everything went well.
 
         """
+        if not self.owns(submission_id):
+            logger.warning("[new_submission] Submission %d belongs to "
+                           "another shard, ignoring." % submission_id)
+            return
+
         with SessionGen() as session:
             submission = Submission.get_from_id(submission_id, session)
             if submission is None:
@@ -1254,8 +3790,14 @@ class EvaluationService(Service):
                 return
 
             for dataset in get_datasets_to_judge(submission.task):
-                submission_result = submission.get_result_or_create(dataset)
+                submission_result = submission.get_result(dataset)
+                if submission_result is None:
+                    submission_result = SubmissionResult(
+                        submission=submission, dataset=dataset)
+                    self.update_submissions_status(submission_result, None)
 
+                # The contestant is waiting only for the evaluation on
+                # the active dataset.
                 if to_compile(submission_result):
                     self.push_in_queue(
                         JobQueueEntry(
@@ -1263,7 +3805,11 @@ class EvaluationService(Service):
                             submission.id,
                             dataset.id),
                         EvaluationService.JOB_PRIORITY_HIGH,
-                        submission.timestamp)
+                        submission.timestamp,
+                        LANE_LIVE
+                        if dataset is submission.task.active_dataset
+                        else LANE_BULK,
+                        submission.user_id)
 
             session.commit()
 
@@ -1278,6 +3824,11 @@ class EvaluationService(Service):
         returns (bool): True if everything went well.
 
         """
+        if not self.owns(user_test_id):
+            logger.warning("[new_user_test] User test %d belongs to "
+                           "another shard, ignoring." % user_test_id)
+            return
+
         with SessionGen() as session:
             user_test = UserTest.get_from_id(user_test_id, session)
             if user_test is None:
@@ -1295,7 +3846,8 @@ class EvaluationService(Service):
                             user_test.id,
                             dataset.id),
                         EvaluationService.JOB_PRIORITY_HIGH,
-                        user_test.timestamp)
+                        user_test.timestamp,
+                        user_id=user_test.user_id)
 
             session.commit()
 
@@ -1337,6 +3889,9 @@ class EvaluationService(Service):
             raise ValueError(
                 "Unexpected invalidation level `%s'." % level)
 
+        # Invalidations usually follow a change of the dataset.
+        self.cost_model.forget_dataset(dataset_id)
+
         with SessionGen() as session:
             submission_results = get_submission_results(
                 # Give contest_id only if all others are None.
@@ -1344,6 +3899,11 @@ class EvaluationService(Service):
                 if {user_id, task_id, submission_id, dataset_id} == {None}
                 else None,
                 user_id, task_id, submission_id, dataset_id, session)
+            # The other shards invalidate the results they own.
+            submission_results = [
+                submission_result
+                for submission_result in submission_results
+                if self.owns(submission_result.submission_id)]
 
             logger.info("Submission results to invalidate %s for: %d." %
                         (level, len(submission_results)))
@@ -1362,36 +3922,44 @@ class EvaluationService(Service):
                         submission_result.dataset_id),
                     ]
                 for job in jobs:
-                    try:
-                        self.queue.remove(job)
-                    except KeyError:
-                        pass  # Ok, the job wasn't in the queue.
-                    try:
-                        self.pool.ignore_job(job)
-                    except LookupError:
-                        pass  # Ok, the job wasn't in the pool.
+                    self.remove_job(job)
 
                 # We invalidate the appropriate data and queue the jobs to
                 # recompute those data.
+                old_status = submission_result_status(submission_result)
                 if level == "compilation":
                     submission_result.invalidate_compilation()
                     if to_compile(submission_result):
-                        self.push_in_queue(
-                            JobQueueEntry(
-                                EvaluationService.JOB_TYPE_COMPILATION,
-                                submission_result.submission_id,
-                                submission_result.dataset_id),
-                            EvaluationService.JOB_PRIORITY_HIGH,
-                            submission_result.submission.timestamp)
+                        job = JobQueueEntry(
+                            EvaluationService.JOB_TYPE_COMPILATION,
+                            submission_result.submission_id,
+                            submission_result.dataset_id)
+                        # An invalidation asks for a real compilation:
+                        # we do not reuse a previous one.
+                        if self.push_in_queue(
+                                job,
+                                EvaluationService.JOB_PRIORITY_HIGH,
+                                submission_result.submission.timestamp,
+                                LANE_BULK,
+                                submission_result.submission.user_id):
+                            self.recompile.add(job)
                 elif level == "evaluation":
                     submission_result.invalidate_evaluation()
                     if to_evaluate(submission_result):
-                        self.push_in_queue(
-                            JobQueueEntry(
-                                EvaluationService.JOB_TYPE_EVALUATION,
-                                submission_result.submission_id,
-                                submission_result.dataset_id),
-                            EvaluationService.JOB_PRIORITY_MEDIUM,
-                            submission_result.submission.timestamp)
+                        job = JobQueueEntry(
+                            EvaluationService.JOB_TYPE_EVALUATION,
+                            submission_result.submission_id,
+                            submission_result.dataset_id)
+                        # An invalidation asks for a real run: we do
+                        # not reuse the outcomes we already know.
+                        if self.push_in_queue(
+                                job,
+                                EvaluationService.JOB_PRIORITY_MEDIUM,
+                                submission_result.submission.timestamp,
+                                LANE_BULK,
+                                submission_result.submission.user_id):
+                            self.memoized[job] = {}
+                self.update_submissions_status(submission_result,
+                                               old_status)
 
             session.commit()
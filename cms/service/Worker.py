@@ -21,15 +21,21 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+from collections import OrderedDict
 
 import gevent.coros
+import gevent.local
 
+from cms import ServiceCoord, config
 from cms.io import Service, rpc_method
 from cms.db import SessionGen, Contest
 from cms.db.filecacher import FileCacher
 from cms.grading import JobException
+from cms.grading.Sandbox import IsolateSandbox
 from cms.grading.tasktypes import get_task_type
+from cms.grading.TaskType import sandbox_pool
 from cms.grading.Job import JobGroup
+from cms.service import get_evaluation_shard
 
 
 logger = logging.getLogger(__name__)
@@ -41,29 +47,124 @@ class Worker(Service):
     operations are in the TaskType classes, while the sandbox is in
     the Sandbox module.
 
+    A worker has config.worker_slots execution slots, each able to do
+    a job group at the same time as the others, using its own sandbox
+    box id (and CPUs, see config.worker_slot_cpus) but sharing the
+    file cacher.
+
     """
 
     JOB_TYPE_COMPILATION = "compile"
     JOB_TYPE_EVALUATION = "evaluate"
 
+    # How many TaskType instances to keep (the least recently used
+    # are discarded first).
+    TASK_TYPE_CACHE_SIZE = 32
+
     def __init__(self, shard):
         Service.__init__(self, shard)
         self.file_cacher = FileCacher(self)
+        # Decide (and log) where the sandboxes go to link the files of
+        # the cache in them.
+        self.file_cacher.check_links()
+
+        self.slots = config.worker_slots
+        self.work_locks = [gevent.coros.RLock()
+                           for _ in xrange(self.slots)]
+        self._ignore_job = [False] * self.slots
+
+        # The slot of the job group executed by the current greenlet.
+        self._local = gevent.local.local()
+
+        # TaskType instances indexed by (name, JSON-encoded
+        # parameters), from the least to the most recently used.
+        self._task_types = OrderedDict()
+
+        # Keep the sandboxes to use them again (see SandboxPool).
+        sandbox_pool.size = config.sandbox_pool_size
 
-        self.work_lock = gevent.coros.RLock()
-        self._ignore_job = False
+        # Fail now, rather than at the first execution, if isolate
+        # does not have boxes for all our slots.
+        if config.sandbox_implementation == 'isolate':
+            IsolateSandbox.check_box_ids(shard)
+
+        # The shard of EvaluationService we report our progress to.
+        self.evaluation_service = self.connect_to(
+            ServiceCoord("EvaluationService", get_evaluation_shard(shard)))
+
+    def run(self):
+        """See Service.run. When the worker shuts down, the sandboxes
+        kept to be used again are deleted.
+
+        """
+        try:
+            return Service.run(self)
+        finally:
+            sandbox_pool.close()
+
+    @property
+    def slot(self):
+        """The slot of the job group executed by the current
+        greenlet (used to choose the sandbox box id).
+
+        """
+        return getattr(self._local, "slot", 0)
+
+    def get_task_type(self, name, parameters):
+        """Return the TaskType for the given name and parameters,
+        reusing the instance created for a previous job if possible,
+        instead of looking up the class and parsing the parameters
+        again.
+
+        name (str): the name of the TaskType class.
+        parameters (str): the JSON-encoded parameters.
+
+        return (TaskType): an instance of the correct TaskType class.
+
+        """
+        key = (name, parameters)
+        task_type = self._task_types.pop(key, None)
+        if task_type is None:
+            task_type = get_task_type(name, parameters)
+            while len(self._task_types) >= Worker.TASK_TYPE_CACHE_SIZE:
+                self._task_types.popitem(last=False)
+        self._task_types[key] = task_type
+        return task_type
+
+    def discard_task_type(self, name, parameters):
+        """Forget the TaskType for the given name and parameters
+        (for example because it failed and its state is no longer
+        trustworthy).
+
+        name (str): the name of the TaskType class.
+        parameters (str): the JSON-encoded parameters.
+
+        """
+        self._task_types.pop((name, parameters), None)
 
     @rpc_method
-    def ignore_job(self):
+    def ignore_job(self, slot=0):
         """RPC that inform the worker that its result for the current
         action will be discarded. The worker will try to return as
         soon as possible even if this means that the result are
         inconsistent.
 
+        slot (int): the slot doing the action.
+
         """
         # We remember to quit as soon as possible.
-        logger.info("Trying to interrupt job as requested.")
-        self._ignore_job = True
+        logger.info("Trying to interrupt job in slot %d as requested." %
+                    slot)
+        self._ignore_job[slot] = True
+
+    @rpc_method
+    def sandbox_pool_status(self):
+        """Return the statistics of the pool of sandboxes.
+
+        returns (dict): see SandboxPool.get_status.
+
+        """
+        return sandbox_pool.get_status()
 
     @rpc_method
     def precache_files(self, contest_id):
@@ -85,51 +186,131 @@ class Worker(Service):
         logger.info("Precaching finished.")
 
     @rpc_method
-    def execute_job_group(self, job_group_dict):
+    def prefetch_files(self, digests):
+        """RPC to ask the worker to load in its cache the files of a
+        job group it is probably going to receive soon, while it is
+        busy with another one.
+
+        digests ([unicode]): the digests of the files.
+
+        """
+        for digest in digests:
+            if self.file_cacher.is_cached(digest):
+                continue
+            try:
+                self.file_cacher.load(digest)
+            except KeyError:
+                logger.warning("Cannot prefetch file %s." % digest)
+
+    def _fetch_files(self, job, slot, done):
+        """Load in the cache the files of a job that are not there
+        yet, reporting progress to ES after each of them, so that
+        slow downloads do not make the job time out.
+
+        job (Job): the job about to be executed.
+        slot (int): the slot executing the job.
+        done (int): how many jobs of the group are done.
+
+        """
+        for digest in sorted(job.get_digests()):
+            if self.file_cacher.is_cached(digest):
+                continue
+            try:
+                self.file_cacher.load(digest)
+            except KeyError:
+                # The task type will fail, reporting it.
+                continue
+            self.evaluation_service.job_progress(
+                shard=self.shard, slot=slot, done=done)
+
+    @rpc_method
+    def execute_job_group(self, job_group_dict, slot=0):
         """Receive a group of jobs in a dict format and executes them
         one by one.
 
         job_group_dict (dict): a dictionary suitable to be imported
             from JobGroup.
+        slot (int): the execution slot to use.
 
         """
         job_group = JobGroup.import_from_dict(job_group_dict)
 
-        if self.work_lock.acquire(False):
-
-            try:
-                self._ignore_job = False
+        if not 0 <= slot < self.slots:
+            err_msg = "Request received for slot %d, but the worker has " \
+                "%d slots (check that worker_slots is the same in the " \
+                "configuration of all services)." % (slot, self.slots)
+            logger.warning(err_msg)
+            raise JobException(err_msg)
 
-                for k, job in job_group.jobs.iteritems():
-                    logger.info("Starting job.",
-                                extra={"operation": job.info})
+        if self.work_locks[slot].acquire(False):
 
+            try:
+                self._ignore_job[slot] = False
+                self._local.slot = slot
+
+                # For the jobs in the plan, the index of their list;
+                # the lists whose remaining jobs can be left out; and
+                # the jobs left out, which are not returned at all, so
+                # that they get no evaluation.
+                plan_index = {}
+                for i, plan_keys in enumerate(job_group.plan or []):
+                    for k in plan_keys:
+                        plan_index[k] = i
+                failed = set()
+                skipped = []
+
+                for done, k in enumerate(job_group.get_ordered_keys(), 1):
+                    job = job_group.jobs[k]
                     job.shard = self.shard
 
-                    # FIXME This is actually kind of a workaround...
-                    # The only TaskType that needs it is OutputOnly.
-                    job._key = k
-
-                    # FIXME We're creating a new TaskType for each Job
-                    # even if, at the moment, a JobGroup always uses
-                    # the same TaskType and the same parameters. Yet,
-                    # this could change in the future, so the best
-                    # solution is to keep a cache of TaskTypes objects
-                    # (like ScoringService does with ScoreTypes, except
-                    # that we cannot index by Dataset ID here...).
-                    task_type = get_task_type(job.task_type,
-                                              job.task_type_parameters)
-                    task_type.execute_job(job, self.file_cacher)
-
-                    logger.info("Finished job.",
-                                extra={"operation": job.info})
-
-                    if not job.success or self._ignore_job:
+                    if plan_index.get(k) in failed:
+                        logger.info("Skipping job, as its subtask failed.",
+                                    extra={"operation": job.info})
+                        skipped.append(k)
+                        job.success = True
+
+                    else:
+                        logger.info("Starting job.",
+                                    extra={"operation": job.info})
+                        self._fetch_files(job, slot, done - 1)
+                        # The timeout of ES starts from here, hence
+                        # from our last report (see job_progress).
+                        self.evaluation_service.job_progress(
+                            shard=self.shard, slot=slot, done=done - 1)
+
+                        # FIXME This is actually kind of a workaround...
+                        # The only TaskType that needs it is OutputOnly.
+                        job._key = k
+
+                        task_type = self.get_task_type(
+                            job.task_type, job.task_type_parameters)
+                        try:
+                            task_type.execute_job(job, self.file_cacher)
+                        except:
+                            self.discard_task_type(
+                                job.task_type, job.task_type_parameters)
+                            raise
+
+                        logger.info("Finished job.",
+                                    extra={"operation": job.info})
+
+                        if k in plan_index and job.success and \
+                                job.outcome is not None and \
+                                float(job.outcome) <= 0.0:
+                            failed.add(plan_index[k])
+
+                    self.evaluation_service.job_progress(
+                        shard=self.shard, slot=slot, done=done)
+
+                    if not job.success or self._ignore_job[slot]:
                         job_group.success = False
                         break
                 else:
                     job_group.success = True
 
+                for k in skipped:
+                    del job_group.jobs[k]
+
                 return job_group.export_to_dict()
 
             except:
@@ -138,12 +319,12 @@ class Worker(Service):
                 raise JobException(err_msg)
 
             finally:
-                self.work_lock.release()
+                self.work_locks[slot].release()
 
         else:
             err_msg = "Request received, but declined because of acquired " \
-                "lock (Worker is busy executing another job group, this " \
-                "should not happen: check if there are more than one ES " \
-                "running, or for bugs in ES."
+                "lock (slot %d of Worker is busy executing another job " \
+                "group, this should not happen: check if there are more " \
+                "than one ES running, or for bugs in ES." % slot
             logger.warning(err_msg)
             raise JobException(err_msg)
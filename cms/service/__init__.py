@@ -23,12 +23,21 @@
 
 import logging
 
+from cms import get_service_shards
 from cms.db import SessionGen, User, Task, Submission, SubmissionResult
 
 
 logger = logging.getLogger(__name__)
 
 
+# The lanes of the queue of EvaluationService: user tests, submissions
+# coming from the contestants, and (re-)evaluations requested by the
+# admins or concerning datasets other than the active ones.
+LANE_LIVE = "live"
+LANE_TEST = "test"
+LANE_BULK = "bulk"
+
+
 def get_submissions(contest_id=None, user_id=None, task_id=None,
                     submission_id=None, session=None):
     """Search for submissions that match the given criteria
@@ -160,3 +169,20 @@ def get_datasets_to_judge(task):
             judge.append(dataset)
 
     return judge
+
+
+def get_evaluation_shard(object_id):
+    """Return the shard of EvaluationService in charge of an object.
+
+    Submissions and user tests are partitioned among the shards of
+    EvaluationService according to their id, so that each shard
+    compiles and evaluates only its own part of them. The same rule,
+    applied to the shard number of a Worker, tells which shard of
+    EvaluationService that Worker belongs to.
+
+    object_id (int): the id of a submission or of a user test, or the
+                     shard number of a Worker.
+    returns (int): the shard of EvaluationService owning the object.
+
+    """
+    return object_id % max(get_service_shards("EvaluationService"), 1)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compare the time taken by white_diff with the one of the previous,
+line by line, implementation, on large generated outputs.
+
+"""
+
+from __future__ import print_function
+
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+from cms.grading import white_diff, white_diff_canonicalize, WHITES
+
+
+def white_diff_by_lines(output, res):
+    """The previous implementation of white_diff, reading the files
+    line by line and canonicalizing each line.
+
+    """
+    while True:
+        lout = output.readline()
+        lres = res.readline()
+        if lres == '' and lout == '':
+            return True
+        elif lres == '' or lout == '':
+            if lout.strip(WHITES) != '' or lres.strip(WHITES) != '':
+                return False
+        elif white_diff_canonicalize(lout) != white_diff_canonicalize(lres):
+            return False
+
+
+def generate_files(directory, size):
+    """Write the files to compare.
+
+    directory (string): where to write them.
+    size (int): the approximate size of each file, in bytes.
+
+    return ([(string, string, string)]): for each comparison, its
+        description and the paths of the two files.
+
+    """
+    rand = random.Random(0)
+    lines = []
+    length = 0
+    while length < size:
+        line = " ".join(str(rand.randint(0, 10 ** 9))
+                        for _ in xrange(rand.randint(1, 10)))
+        lines.append(line)
+        length += len(line) + 1
+
+    def write(name, content):
+        path = os.path.join(directory, name)
+        with open(path, "wb") as file_:
+            file_.write(content)
+        return path
+
+    correct = write("correct", "\n".join(lines) + "\n")
+    identical = write("identical", "\n".join(lines) + "\n")
+    spaced = write("spaced", "\r\n".join(line.replace(" ", "  \t")
+                                         for line in lines) + "\n\n")
+    wrong = write("wrong", "\n".join(lines[:-1]) + "\n0\n")
+    return [("identical", correct, identical),
+            ("whitespace differences", correct, spaced),
+            ("wrong last line", correct, wrong)]
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the white diff.")
+    parser.add_argument("-s", "--size", type=int, default=50,
+                        help="size of the outputs, in MB (default 50)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        comparisons = generate_files(directory, args.size * 1024 * 1024)
+        for description, first, second in comparisons:
+            print("%s:" % description)
+            for name, function in [("by lines", white_diff_by_lines),
+                                   ("by blocks", white_diff)]:
+                with open(first, "rb") as output:
+                    with open(second, "rb") as res:
+                        start = time.time()
+                        result = function(output, res)
+                        elapsed = time.time() - start
+                print("  %-10s %-6s %8.3f s" % (name, result, elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for putting the files from FS in the sandboxes."""
+
+import errno
+import io
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+from mock import patch
+
+from cms.db.filecacher import FileCacher, FICLONE
+from cms.grading.Sandbox import StupidSandbox
+
+
+def fake_clone(dst_fd, request, src_fd):
+    """Do what the FICLONE ioctl does, with a copy."""
+    assert request == FICLONE
+    os.write(dst_fd, os.read(src_fd, 1024))
+
+
+class LinkingSandbox(StupidSandbox):
+    """A sandbox linking the files from the cache, as if its programs
+    could not write them (as with isolate).
+
+    """
+    CAN_LINK_FILES = True
+
+
+class TestSandboxFiles(unittest.TestCase):
+    """Test the methods creating files from FS in the sandboxes."""
+
+    def setUp(self):
+        self.storage = tempfile.mkdtemp()
+        self.file_cacher = FileCacher(path=self.storage)
+        self.digest = self.file_cacher.put_file_content("1 2\n")
+        self.cache_path = os.path.join(self.file_cacher.file_dir,
+                                       self.digest)
+        self.sandbox = StupidSandbox(self.file_cacher)
+
+    def tearDown(self):
+        self.sandbox.delete()
+        self.file_cacher.destroy_cache()
+        shutil.rmtree(self.storage)
+
+    def read(self, path):
+        with io.open(path, "rb") as file_:
+            return file_.read()
+
+    def test_link(self):
+        """Files are linked from the cache when possible, readable by
+        everybody, and writing the file in the sandbox afterwards
+        does not change the cache.
+
+        """
+        sandbox = LinkingSandbox(self.file_cacher)
+        try:
+            sandbox.create_file_from_storage("run", self.digest,
+                                             executable=True)
+
+            path = sandbox.relative_path("run")
+            self.assertTrue(os.path.samefile(path, self.cache_path))
+            mode = os.stat(path).st_mode
+            self.assertTrue(mode & stat.S_IROTH)
+            self.assertTrue(mode & stat.S_IXOTH)
+            self.assertFalse(mode & stat.S_IWOTH)
+
+            sandbox.create_file_from_string("run", "3 4\n")
+            self.assertFalse(os.path.samefile(path, self.cache_path))
+            self.assertEqual(self.read(path), "3 4\n")
+            self.assertEqual(self.read(self.cache_path), "1 2\n")
+        finally:
+            sandbox.delete()
+
+    def test_link_fallback(self):
+        """If a link fails, the file is copied, and the next ones are
+        not linked.
+
+        """
+        sandbox = LinkingSandbox(self.file_cacher)
+        try:
+            with patch("os.link",
+                       side_effect=OSError(errno.EXDEV,
+                                           "Invalid cross-device link")) \
+                    as link:
+                sandbox.create_file_from_storage("input.txt", self.digest)
+                sandbox.create_file_from_storage("other.txt", self.digest)
+
+            self.assertEqual(len(link.mock_calls), 1)
+            self.assertFalse(self.file_cacher.can_link)
+            for filename in ["input.txt", "other.txt"]:
+                path = sandbox.relative_path(filename)
+                self.assertFalse(os.path.samefile(path, self.cache_path))
+                self.assertEqual(self.read(path), "1 2\n")
+        finally:
+            sandbox.delete()
+
+    def test_check_links(self):
+        """The sandboxes go in the cache if links cannot be created
+        from the cache to the temporary directory.
+
+        """
+        self.assertTrue(self.file_cacher.check_links())
+
+        real_link = os.link
+
+        def link(src, dst):
+            if not dst.startswith(self.file_cacher.file_dir):
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            real_link(src, dst)
+
+        with patch("os.link", side_effect=link):
+            self.assertTrue(self.file_cacher.check_links())
+        self.assertEqual(self.file_cacher.sandbox_dir,
+                         self.file_cacher.temp_dir)
+
+        with patch("os.link", side_effect=OSError(errno.EPERM,
+                                                  "Not permitted")):
+            self.assertFalse(self.file_cacher.check_links())
+        self.assertFalse(self.file_cacher.can_link)
+
+    def test_clone(self):
+        """Files are cloned from the cache when possible, and are
+        different files from the one in the cache.
+
+        """
+        with patch("fcntl.ioctl", side_effect=fake_clone) as ioctl:
+            self.sandbox.create_file_from_storage("input.txt", self.digest)
+
+        self.assertEqual(len(ioctl.mock_calls), 1)
+        path = self.sandbox.relative_path("input.txt")
+        self.assertFalse(os.path.samefile(path, self.cache_path))
+        self.assertEqual(self.read(path), "1 2\n")
+
+        self.sandbox.create_file_from_string("input.txt", "3 4\n")
+        self.assertEqual(self.read(path), "3 4\n")
+        self.assertEqual(self.read(self.cache_path), "1 2\n")
+
+    def test_copy_fallback(self):
+        """If a clone fails, the file is copied, and so are the next
+        ones.
+
+        """
+        with patch("fcntl.ioctl",
+                   side_effect=IOError(errno.EOPNOTSUPP,
+                                       "Operation not supported")) \
+                as ioctl:
+            self.sandbox.create_file_from_storage("input.txt", self.digest)
+            self.sandbox.create_file_from_storage("other.txt", self.digest)
+
+        self.assertEqual(len(ioctl.mock_calls), 1)
+        self.assertFalse(self.file_cacher.can_clone)
+        for filename in ["input.txt", "other.txt"]:
+            path = self.sandbox.relative_path(filename)
+            self.assertFalse(os.path.samefile(path, self.cache_path))
+            self.assertEqual(self.read(path), "1 2\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
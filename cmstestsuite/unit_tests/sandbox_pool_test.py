@@ -0,0 +1,162 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the pool of sandboxes."""
+
+import os
+import sys
+import unittest
+from mock import patch
+
+from cms import config
+from cms.grading.Sandbox import IsolateSandbox, SandboxInterfaceException, \
+    SandboxPool, StupidSandbox
+
+
+# The module, since cms.grading.Sandbox is the class of the sandbox.
+sandbox_module = sys.modules["cms.grading.Sandbox"]
+
+
+class BoxedSandbox(StupidSandbox):
+    """A sandbox with boxes, as IsolateSandbox."""
+
+    @staticmethod
+    def get_boxes_per_slot():
+        return 3
+
+    def __init__(self, file_cacher=None, temp_dir=None, box_index=0):
+        StupidSandbox.__init__(self, file_cacher, temp_dir)
+        self.box_index = box_index
+
+
+class TestSandboxPool(unittest.TestCase):
+    """Test the class SandboxPool."""
+
+    def setUp(self):
+        self.sandbox_class = sandbox_module.Sandbox
+        sandbox_module.Sandbox = StupidSandbox
+        self.sandboxes = []
+
+    def tearDown(self):
+        sandbox_module.Sandbox = self.sandbox_class
+        for sandbox in self.sandboxes:
+            if os.path.exists(sandbox.path):
+                sandbox.delete()
+
+    def acquire(self, pool):
+        sandbox = pool.acquire(None)
+        self.sandboxes.append(sandbox)
+        return sandbox
+
+    def test_reuse(self):
+        """A released sandbox is emptied, reset and used again.
+
+        """
+        pool = SandboxPool(1)
+        sandbox = self.acquire(pool)
+        sandbox.create_file_from_string("input.txt", "1 2\n")
+        sandbox.timeout = 1.0
+        pool.release(sandbox)
+        pool._clearers.join()  # Let it clear the sandbox.
+
+        self.assertIs(self.acquire(pool), sandbox)
+        self.assertEqual(os.listdir(sandbox.path), [])
+        self.assertIsNone(sandbox.timeout)
+        self.assertEqual(pool.get_status()["reused"], 1)
+
+    def test_full(self):
+        """Sandboxes are deleted when the pool is full.
+
+        """
+        pool = SandboxPool(1)
+        first = self.acquire(pool)
+        second = self.acquire(pool)
+        pool.release(first)
+        pool.release(second)
+        pool._clearers.join()
+
+        self.assertFalse(os.path.exists(second.path))
+        self.assertIs(self.acquire(pool), first)
+        self.assertEqual(pool.get_status()["created"], 2)
+        self.assertEqual(pool.get_status()["deleted"], 1)
+
+    def test_box_indexes(self):
+        """The sandboxes created by the pool have a box of their own
+        while there are any left, and it is available again when they
+        are deleted.
+
+        """
+        sandbox_module.Sandbox = BoxedSandbox
+        pool = SandboxPool(1)
+        sandboxes = [self.acquire(pool) for _ in xrange(3)]
+        self.assertEqual([sandbox.box_index for sandbox in sandboxes],
+                         [1, 2, 0])
+
+        pool.release(sandboxes[0])
+        pool.release(sandboxes[1])
+        pool._clearers.join()
+
+        self.assertIs(self.acquire(pool), sandboxes[0])
+        self.assertEqual(self.acquire(pool).box_index, 2)
+
+    def test_close(self):
+        """Closing the pool deletes the free sandboxes, also the ones
+        still being cleared.
+
+        """
+        pool = SandboxPool(2)
+        first = self.acquire(pool)
+        second = self.acquire(pool)
+        pool.release(first)
+        pool._clearers.join()
+        pool.release(second)
+        pool.close()
+
+        self.assertFalse(os.path.exists(first.path))
+        self.assertFalse(os.path.exists(second.path))
+        self.assertEqual(pool.get_status()["free"], 0)
+
+
+class TestIsolateBoxIds(unittest.TestCase):
+    """Test the box ids of isolate used by the workers."""
+
+    @patch.object(config, "worker_slots", 4)
+    @patch.object(config, "sandbox_pool_size", 2)
+    def test_box_ids(self):
+        """Each slot has its boxes, and box 0 is left alone.
+
+        """
+        self.assertEqual(IsolateSandbox.get_boxes_per_slot(), 3)
+        self.assertEqual(IsolateSandbox.get_box_id(0, 0, 0), 1)
+        self.assertEqual(IsolateSandbox.get_box_id(0, 3, 2), 12)
+        self.assertEqual(IsolateSandbox.get_box_id(1, 0, 0), 13)
+
+    @patch.object(config, "worker_slots", 32)
+    @patch.object(config, "sandbox_pool_size", 2)
+    @patch.object(IsolateSandbox, "get_num_boxes", return_value=100)
+    def test_check_box_ids(self, _):
+        """A worker needing more boxes than isolate has fails.
+
+        """
+        IsolateSandbox.check_box_ids(0)
+        with self.assertRaises(SandboxInterfaceException):
+            IsolateSandbox.check_box_ids(1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the subtasks of the group score types."""
+
+import json
+import unittest
+from mock import Mock
+
+from cms.grading import EVALUATION_SKIPPED_TEXT
+from cms.grading.scoretypes.GroupMin import GroupMin
+
+
+class TestGroupMin(unittest.TestCase):
+    """Test the evaluation plan and the scores of GroupMin."""
+
+    def setUp(self):
+        # Two subtasks, taking the testcases in order of codename.
+        self.score_type = GroupMin(
+            [[40, 2], [60, 3]],
+            dict((codename, True)
+                 for codename in ["b", "a", "e", "c", "d"]))
+
+    @staticmethod
+    def new_submission_result(outcomes):
+        """Return a submission result with the given outcomes.
+
+        outcomes ({string: string}): the outcome of each evaluated
+            testcase.
+
+        """
+        submission_result = Mock(submission_id=1, dataset_id=1)
+        submission_result.evaluated.return_value = True
+        submission_result.evaluations = [
+            Mock(codename=codename, outcome=outcome,
+                 text=json.dumps([]), execution_time=0.1,
+                 execution_memory=1024)
+            for codename, outcome in outcomes.iteritems()]
+        return submission_result
+
+    def test_evaluation_plan(self):
+        """The plan follows the subtasks used for the score."""
+        self.assertEquals(self.score_type.get_evaluation_plan(),
+                          [["a", "b"], ["c", "d", "e"]])
+        self.assertEquals(self.score_type.get_evaluation_plan(),
+                          self.score_type.get_subtask_testcases())
+
+    def test_compute_score_skipped(self):
+        """Testcases left out after a failure have no evaluation, and
+        are shown as not executed.
+
+        """
+        score, details, unused_public_score, unused_public_details, \
+            ranking_details = self.score_type.compute_score(
+                self.new_submission_result(
+                    {"a": "1.0", "b": "1.0", "c": "0.0"}))
+
+        self.assertEquals(score, 40.0)
+        self.assertEquals(json.loads(ranking_details), ["40", "0"])
+        testcases = json.loads(details)[1]["testcases"]
+        self.assertEquals(testcases[1], {
+            "idx": "d", "text": json.dumps(EVALUATION_SKIPPED_TEXT)})
+
+    def test_compute_score_missing(self):
+        """A subtask missing evaluations without a failure cannot be
+        scored.
+
+        """
+        self.assertRaises(
+            ValueError, self.score_type.compute_score,
+            self.new_submission_result(
+                {"a": "1.0", "b": "1.0", "c": "1.0"}))
+
+
+if __name__ == "__main__":
+    unittest.main()
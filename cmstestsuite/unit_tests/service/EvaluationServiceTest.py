@@ -0,0 +1,845 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the worker pool of the evaluation service.
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from mock import Mock, MagicMock
+
+import cms.service.EvaluationService
+from cms.db import File, Executable
+from cms.grading.Job import JobGroup, CompilationJob, EvaluationJob
+from cms.grading.Sandbox import Sandbox
+from cms.service.EvaluationService import EvaluationService, WorkerPool, \
+    JobQueue, JobQueueEntry, LaneJobQueue, LatencyHistogram, QueueJournal, \
+    CompilationCache, EvaluationMemo, CostModel
+from cms import ServiceCoord
+from cmscommon.datetime import make_datetime
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.service = Mock()
+        self.service.connect_to.side_effect = lambda coord, on_connect: Mock()
+        self.service.queue = MagicMock()
+        self.service.queue.__contains__.return_value = True
+        self.service.cost_model = CostModel()
+        self.pool = WorkerPool(self.service)
+        self.job = JobQueueEntry(EvaluationService.JOB_TYPE_EVALUATION, 1, 2)
+        self.side_data = (EvaluationService.JOB_PRIORITY_MEDIUM,
+                          datetime(2014, 1, 1))
+
+    # Testing the split of evaluations among workers.
+
+    def test_acquire_worker_split(self):
+        """An evaluation with many testcases is split among all the
+        idle workers.
+
+        """
+        self.add_workers(3)
+        TestWorkerPool.set_up_db(12)
+
+        self.pool.acquire_worker(self.job, self.side_data)
+
+        testcases = []
+        for worker in self.workers:
+            assert len(worker.execute_job_group.mock_calls) == 1
+            job_group_dict = \
+                worker.execute_job_group.call_args[1]["job_group_dict"]
+            assert len(job_group_dict["jobs"]) == 4
+            testcases += job_group_dict["jobs"].keys()
+        assert sorted(testcases) == sorted("%03d" % i for i in xrange(12))
+        assert self.pool.is_split(self.job)
+        assert self.job in self.pool
+
+    def test_acquire_worker_few_testcases(self):
+        """An evaluation with few testcases goes to a single worker.
+
+        """
+        self.add_workers(3)
+        TestWorkerPool.set_up_db(EvaluationService.MIN_TESTCASES_PER_CHUNK)
+
+        self.pool.acquire_worker(self.job, self.side_data)
+
+        assert sum(len(worker.execute_job_group.mock_calls)
+                   for worker in self.workers) == 1
+        assert not self.pool.is_split(self.job)
+
+    def test_acquire_worker_invalidated(self):
+        """A job removed or invalidated while it is loaded is not sent,
+        and the workers booked for it are idle again.
+
+        """
+        self.add_workers(3)
+        TestWorkerPool.set_up_db(12)
+        cms.service.EvaluationService.Dataset.get_from_id.side_effect = \
+            lambda *args: self.pool.ignore_job(self.job)
+
+        self.assertRaises(LookupError, self.pool.acquire_worker,
+                          self.job, self.side_data)
+        cms.service.EvaluationService.Dataset.get_from_id.side_effect = None
+        self.service.queue.__contains__.return_value = False
+        self.assertRaises(LookupError, self.pool.acquire_worker,
+                          self.job, self.side_data)
+
+        assert all(worker.execute_job_group.mock_calls == []
+                   for worker in self.workers)
+        assert self.job not in self.pool
+        assert len(self.pool._shards_by_job[WorkerPool.WORKER_INACTIVE]) == 3
+
+    def test_merge_chunks(self):
+        """The result is available only when all chunks arrived.
+
+        """
+        self.add_workers(2)
+        TestWorkerPool.set_up_db(8)
+        self.pool.acquire_worker(self.job, self.side_data)
+        chunks = [JobGroup.import_from_dict(
+            worker.execute_job_group.call_args[1]["job_group_dict"])
+            for worker in self.workers]
+        for chunk in chunks:
+            chunk.success = True
+
+        self.pool.release_worker(0)
+        assert self.pool.merge_chunk(self.job, 0, chunks[0]) is None
+        self.pool.release_worker(1)
+        job_group = self.pool.merge_chunk(self.job, 1, chunks[1])
+
+        assert job_group.success
+        assert len(job_group.jobs) == 8
+        assert not self.pool.is_split(self.job)
+        assert self.job not in self.pool
+
+    def test_abort_chunks(self):
+        """When a chunk fails, the others still running are ignored.
+
+        """
+        self.add_workers(3)
+        TestWorkerPool.set_up_db(12)
+        self.pool.acquire_worker(self.job, self.side_data)
+
+        self.pool.release_worker(0)
+        self.pool.abort_chunks(self.job)
+
+        assert self.workers[0].ignore_job.mock_calls == []
+        assert len(self.workers[1].ignore_job.mock_calls) == 1
+        assert len(self.workers[2].ignore_job.mock_calls) == 1
+        assert not self.pool.is_split(self.job)
+        assert self.job not in self.pool
+        assert self.pool.release_worker(1)
+        assert self.pool.release_worker(2)
+
+    def test_lost_chunk(self):
+        """When a chunk is lost, the job is returned once and the other
+        chunks are ignored.
+
+        """
+        self.add_workers(3)
+        TestWorkerPool.set_up_db(12)
+        self.pool.acquire_worker(self.job, self.side_data)
+
+        self.workers[0].connected = False
+        self.workers[1].connected = False
+        lost_jobs = self.pool.check_connections()
+
+        assert lost_jobs == [self.side_data + (self.job,)]
+        assert len(self.workers[2].ignore_job.mock_calls) == 1
+        assert self.job not in self.pool
+
+    # Testing the choice of the worker.
+
+    def test_acquire_worker_locality(self):
+        """Workers that already have the files of the dataset in their
+        cache are preferred.
+
+        """
+        self.add_workers(3)
+        TestWorkerPool.set_up_db(1)
+
+        for i in xrange(10):
+            shard = self.pool.acquire_worker(self.job, self.side_data)
+            self.pool.release_worker(shard)
+            other_job = JobQueueEntry(
+                EvaluationService.JOB_TYPE_EVALUATION, 10 + i, 2)
+            assert self.pool.acquire_worker(other_job,
+                                            self.side_data) == shard
+            self.pool.release_worker(shard)
+
+    def test_acquire_worker_slots(self):
+        """Each slot of a worker takes a job, through the same
+        connection.
+
+        """
+        self.pool = WorkerPool(self.service, 2)
+        self.add_workers(1)
+        TestWorkerPool.set_up_db(1)
+        other_job = JobQueueEntry(EvaluationService.JOB_TYPE_EVALUATION, 3, 2)
+
+        shards = [self.pool.acquire_worker(self.job, self.side_data),
+                  self.pool.acquire_worker(other_job, self.side_data)]
+
+        assert len(self.pool) == 2
+        assert sorted(shards) == [0, 1]
+        assert self.pool.acquire_worker(self.job, self.side_data) is None
+        worker = self.pool._worker[0]
+        assert worker is self.pool._worker[1]
+        assert sorted(call[1]["slot"]
+                      for call in worker.execute_job_group.call_args_list) \
+            == [0, 1]
+        self.pool.ignore_job(other_job)
+        assert worker.ignore_job.call_args[1]["slot"] == \
+            self.pool.find_worker(other_job)
+
+    def test_prefetch(self):
+        """The files of the next job are sent to a busy worker, which
+        is then preferred for the job.
+
+        """
+        self.add_workers(2)
+        TestWorkerPool.set_up_db(2)
+        other_job = JobQueueEntry(EvaluationService.JOB_TYPE_EVALUATION, 3, 5)
+        shard = self.pool.acquire_worker(self.job, self.side_data)
+
+        assert self.pool.prefetch(other_job) == shard
+        assert len(self.workers[shard].prefetch_files.mock_calls) == 1
+        self.pool.release_worker(shard)
+        assert self.pool.acquire_worker(other_job, self.side_data) == shard
+
+    # Testing the speculative execution of slow jobs.
+
+    def test_speculate(self):
+        """A job taking much longer than the previous ones is given
+        also to another worker, and the slower copy is ignored.
+
+        """
+        self.add_workers(2)
+        TestWorkerPool.set_up_db(1)
+        self.pool.release_worker(
+            self.pool.acquire_worker(self.job, self.side_data))
+
+        shard = self.pool.acquire_worker(self.job, self.side_data)
+        assert self.pool.find_stragglers() == []
+        self.pool._start_time[shard] -= timedelta(minutes=1)
+        assert self.pool.find_stragglers() == [self.job]
+        copy_shard = self.pool.speculate(self.job)
+
+        assert copy_shard == 1 - shard
+        assert self.pool.find_stragglers() == []
+        assert not self.pool.release_worker(copy_shard)
+        assert self.pool.drop_copies(self.job)
+        assert len(self.workers[shard].ignore_job.mock_calls) == 1
+        assert self.job not in self.pool
+        assert self.pool.release_worker(shard)
+
+    def test_speculate_per_dataset(self):
+        """Jobs are compared with the previous ones on the same
+        dataset, if there are any.
+
+        """
+        self.add_workers(2)
+        TestWorkerPool.set_up_db(1)
+        self.pool.release_worker(
+            self.pool.acquire_worker(self.job, self.side_data))
+        slow_job = JobQueueEntry(EvaluationService.JOB_TYPE_EVALUATION, 3, 5)
+        self.service.cost_model.record_job_time(slow_job, 120.0)
+
+        shard = self.pool.acquire_worker(slow_job, self.side_data)
+        self.pool._start_time[shard] -= timedelta(minutes=1)
+        assert self.pool.find_stragglers() == []
+        self.pool._start_time[shard] -= timedelta(minutes=10)
+        assert self.pool.find_stragglers() == [slow_job]
+
+    def test_speculate_finished(self):
+        """No copy is sent of a job that finishes while it is loaded.
+
+        """
+        self.add_workers(2)
+        TestWorkerPool.set_up_db(1)
+        shard = self.pool.acquire_worker(self.job, self.side_data)
+        cms.service.EvaluationService.Dataset.get_from_id.side_effect = \
+            lambda *args: self.pool.release_worker(shard)
+
+        self.assertRaises(LookupError, self.pool.speculate, self.job)
+
+        assert len(self.workers[1 - shard].execute_job_group.mock_calls) == 0
+        assert self.job not in self.pool
+        assert len(self.pool._shards_by_job[WorkerPool.WORKER_INACTIVE]) == 2
+
+    # Testing the detection of stuck workers.
+
+    def test_check_timeouts(self):
+        """A worker is stuck when it does not report progress for
+        longer than the time a single job may take, however long the
+        whole job group is taking.
+
+        """
+        self.add_workers(1)
+        TestWorkerPool.set_up_db(100, 1.0)
+        shard = self.pool.acquire_worker(self.job, self.side_data)
+
+        timeout = self.pool._job_timeout[shard]
+        assert timeout == \
+            timedelta(seconds=3) * EvaluationService.JOB_TIMEOUT_FACTOR \
+            + EvaluationService.JOB_TIMEOUT_MARGIN
+        self.pool._start_time[shard] -= timedelta(hours=1)
+        self.pool._last_progress[shard] -= timeout * 2 // 3
+        assert self.pool.check_timeouts() == []
+        self.pool._last_progress[shard] -= timeout * 2 // 3
+        self.pool.record_progress(shard, 50)
+        assert self.pool.check_timeouts() == []
+        # Reported again before starting the next job.
+        self.pool._last_progress[shard] -= timeout * 2 // 3
+        self.pool.record_progress(shard, 50)
+        assert self.pool.check_timeouts() == []
+
+        self.pool._last_progress[shard] -= timeout * 4 // 3
+        assert self.pool.check_timeouts() == [self.side_data + (self.job,)]
+        assert len(self.workers[0].quit.mock_calls) == 1
+
+    def test_check_timeouts_short(self):
+        """A worker stuck on a job with a short time limit is found
+        in seconds, not minutes.
+
+        """
+        self.add_workers(1)
+        TestWorkerPool.set_up_db(1, 1.0)
+        shard = self.pool.acquire_worker(self.job, self.side_data)
+
+        assert self.pool._job_timeout[shard] < timedelta(seconds=20)
+        self.pool._last_progress[shard] -= timedelta(seconds=20)
+        assert self.pool.check_timeouts() == [self.side_data + (self.job,)]
+
+    # Testing the lookup of jobs.
+
+    def test_find_worker(self):
+        """Workers are found by their job, and the index follows the
+        acquisitions and releases.
+
+        """
+        self.add_workers(2)
+        TestWorkerPool.set_up_db(1)
+
+        shard = self.pool.acquire_worker(self.job, self.side_data)
+
+        assert self.pool.find_worker(self.job) == shard
+        assert self.pool.find_worker(WorkerPool.WORKER_INACTIVE) == 1 - shard
+        self.pool.release_worker(shard)
+        self.assertRaises(LookupError, self.pool.find_worker, self.job)
+        self.assertRaises(LookupError, self.pool.ignore_job, self.job)
+        assert self.job not in self.pool
+        assert len(self.pool._shards_by_job[WorkerPool.WORKER_INACTIVE]) == 2
+
+    def add_workers(self, n):
+        self.workers = []
+        for shard in xrange(n):
+            self.pool.add_worker(ServiceCoord("Worker", shard))
+            self.workers.append(self.pool._worker[shard])
+
+    @staticmethod
+    def set_up_db(num_testcases, time_limit=None):
+        cms.service.EvaluationService.SessionGen = MagicMock()
+        cms.service.EvaluationService.Submission.get_from_id = Mock()
+        cms.service.EvaluationService.Dataset.get_from_id = Mock()
+        cms.service.EvaluationService.JobGroup.from_submission_evaluation = \
+            Mock(return_value=JobGroup(dict(
+                ("%03d" % i, EvaluationJob(time_limit=time_limit))
+                for i in xrange(num_testcases))))
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        # Only what dispatch_one_job uses.
+        self.service = EvaluationService.__new__(EvaluationService)
+        self.service.queue = LaneJobQueue([("live", 1.0)])
+        self.service.pool = Mock()
+        self.service.journal = Mock()
+        self.service.job_times = {}
+        self.service.memoized = {}
+        self.service.recompile = set()
+        self.service.compile_from_cache = Mock(return_value=False)
+        self.service.evaluate_from_memo = Mock(return_value=False)
+        self.service.forget_result = Mock()
+
+    def test_load_error(self):
+        """A job that cannot be loaded is dropped, and does not block
+        the ones behind it.
+
+        """
+        broken = JobQueueEntry(EvaluationService.JOB_TYPE_EVALUATION, 1, 2)
+        other = JobQueueEntry(EvaluationService.JOB_TYPE_EVALUATION, 2, 2)
+        for job in (broken, other):
+            self.service.queue.push(
+                job, EvaluationService.JOB_PRIORITY_MEDIUM,
+                datetime(2014, 1, 1), "live")
+        self.service.pool.acquire_worker.side_effect = [
+            AttributeError("'NoneType' object has no attribute 'task'"), 0]
+
+        assert self.service.dispatch_one_job()
+        assert broken not in self.service.queue
+        self.service.journal.done.assert_called_once_with(broken)
+
+        assert self.service.dispatch_one_job()
+        assert other not in self.service.queue
+        assert self.service.pool.acquire_worker.call_args[0][0] == other
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def test_fair(self):
+        """A burst of jobs of a user does not delay the jobs of the
+        other users with the same priority.
+
+        """
+        queue = JobQueue(fair=True)
+        for i in xrange(10):
+            queue.push(JobQueueEntry("evaluate", i, 1), 1,
+                       datetime(2014, 1, 1, 0, 0, i), 1)
+        queue.push(JobQueueEntry("evaluate", 10, 1), 1,
+                   datetime(2014, 1, 1, 0, 1), 2)
+        queue.push(JobQueueEntry("evaluate", 11, 1), 0,
+                   datetime(2014, 1, 1, 0, 2), 3)
+
+        popped = [queue.pop()[2].object_id for _ in xrange(4)]
+
+        assert popped == [11, 0, 10, 1]
+        assert queue.get_users_status() == {1: 8}
+
+    def test_not_fair(self):
+        """Without fairness, jobs are served by priority and time.
+
+        """
+        queue = JobQueue()
+        for i in xrange(10):
+            queue.push(JobQueueEntry("evaluate", i, 1), 1,
+                       datetime(2014, 1, 1, 0, 0, i), 1)
+        queue.push(JobQueueEntry("evaluate", 10, 1), 1,
+                   datetime(2014, 1, 1, 0, 1), 2)
+
+        popped = [queue.pop()[2].object_id for _ in xrange(11)]
+
+        assert popped == range(11)
+
+    def test_longest_first(self):
+        """In a longest first queue, jobs with the same priority are
+        served by decreasing cost.
+
+        """
+        queue = JobQueue(longest_first=True)
+        for i, cost in enumerate([1.0, 5.0, 3.0]):
+            queue.push(JobQueueEntry("evaluate", i, 1), 1,
+                       datetime(2014, 1, 1, 0, 0, i), cost=cost)
+        queue.push(JobQueueEntry("evaluate", 3, 1), 0,
+                   datetime(2014, 1, 1, 0, 1), cost=0.5)
+
+        assert queue.get_cost() == (9.5, 5.0)
+        popped = [queue.pop()[2].object_id for _ in xrange(4)]
+
+        assert popped == [3, 1, 2, 0]
+        assert queue.get_cost() == (0.0, 0.0)
+
+
+class TestCostModel(unittest.TestCase):
+
+    def test_estimate(self):
+        """Evaluations are estimated from the time limit, then from
+        the times of the task, then from the times of the user.
+
+        """
+        model = CostModel()
+        model._datasets[1] = (make_datetime(), 10, 20, 2.0)
+        job = JobQueueEntry(EvaluationService.JOB_TYPE_EVALUATION, 1, 1)
+
+        assert model.estimate(job, 5) == 40.0
+        model.record(10, 6, TestCostModel.evaluation([0.5, 1.5]))
+        assert model.estimate(job, 5) == 20.0
+        model.record(10, 5, TestCostModel.evaluation([0.1]))
+        assert abs(model.estimate(job, 5) - 2.0) < 1e-9
+        assert model.estimate(JobQueueEntry(
+            EvaluationService.JOB_TYPE_COMPILATION, 1, 1), 5) == \
+            CostModel.COMPILATION_COST
+
+    def test_missing_dataset(self):
+        """Datasets that do not exist get the default cost, and are
+        loaded again once forgotten.
+
+        """
+        cms.service.EvaluationService.SessionGen = MagicMock()
+        cms.service.EvaluationService.Dataset.get_from_id = Mock(
+            return_value=None)
+        model = CostModel()
+        model._datasets[1] = (make_datetime(), 10, 20, 2.0)
+        job = JobQueueEntry(EvaluationService.JOB_TYPE_EVALUATION, 1, 1)
+
+        assert model.estimate(job, 5) == 40.0
+        model.forget_dataset(1)
+        assert model.estimate(job, 5) == CostModel.DEFAULT_COST
+
+    @staticmethod
+    def evaluation(times):
+        return JobGroup(dict(
+            ("%03d" % i, EvaluationJob(
+                plus={"execution_wall_clock_time": time}))
+            for i, time in enumerate(times)), True)
+
+
+class TestLaneJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = LaneJobQueue([("live", 3.0), ("bulk", 1.0)])
+
+    def test_weighted_fair_queuing(self):
+        """When both lanes are full, they are served according to
+        their weights, regardless of priorities.
+
+        """
+        for i in xrange(40):
+            self.queue.push(JobQueueEntry("evaluate", i, 1),
+                            EvaluationService.JOB_PRIORITY_EXTRA_HIGH,
+                            datetime(2014, 1, 1), "bulk")
+            self.queue.push(JobQueueEntry("evaluate", i, 2),
+                            EvaluationService.JOB_PRIORITY_LOW,
+                            datetime(2014, 1, 1), "live")
+
+        popped = [self.queue.pop()[2].dataset_id for _ in xrange(40)]
+
+        assert popped.count(2) == 30
+        assert popped.count(1) == 10
+        assert self.queue.length() == 40
+        lanes = self.queue.get_lanes_status()
+        assert lanes["live"]["length"] == 10
+        assert lanes["bulk"]["length"] == 30
+
+    def test_idle_lane_no_credit(self):
+        """A lane that was empty does not accumulate credit and does
+        not starve the others when it is filled again.
+
+        """
+        for i in xrange(20):
+            self.queue.push(JobQueueEntry("evaluate", i, 1), 0, None, "bulk")
+        for _ in xrange(20):
+            self.queue.pop()
+        for i in xrange(20):
+            self.queue.push(JobQueueEntry("evaluate", i, 1), 0, None, "bulk")
+            self.queue.push(JobQueueEntry("evaluate", i, 2), 0, None, "live")
+
+        popped = [self.queue.pop()[2].dataset_id for _ in xrange(12)]
+
+        assert popped.count(1) == 2
+
+    def test_estimated_waits(self):
+        """The estimated wait of a lane takes into account the share of
+        the workers it gets.
+
+        """
+        for i in xrange(11):
+            self.queue.push(JobQueueEntry("evaluate", i, 1), 0, None, "bulk")
+
+        waits = self.queue.get_estimated_waits(2.0)
+
+        assert waits["bulk"] == {"length": 11, "estimated_wait": 6.0}
+        assert waits["live"] == {"length": 0, "estimated_wait": 2.0 / 3.0}
+
+    def test_remove(self):
+        """Jobs are removed from their lane.
+
+        """
+        job = JobQueueEntry("evaluate", 1, 1)
+        self.queue.push(job, 0, None, "bulk")
+        assert job in self.queue
+        self.queue.remove(job)
+        assert job not in self.queue
+        assert self.queue.empty()
+        self.assertRaises(LookupError, self.queue.top)
+
+    def test_remove_served(self):
+        """A job removed because it is served counts for its lane as
+        if it was popped.
+
+        """
+        for i in xrange(2):
+            self.queue.push(JobQueueEntry("evaluate", i, 1), 0, None, "bulk")
+            self.queue.push(JobQueueEntry("evaluate", i, 2), 0, None, "live")
+
+        self.queue.remove(JobQueueEntry("evaluate", 0, 1), served=True)
+        popped = [self.queue.pop()[2].dataset_id for _ in xrange(3)]
+
+        assert popped == [2, 2, 1]
+
+
+class TestLatencyHistogram(unittest.TestCase):
+
+    def test_add(self):
+        """Durations are counted in the right buckets.
+
+        """
+        histogram = LatencyHistogram()
+        for seconds in [0.005, 0.02, 0.03, 5.0, 5000.0]:
+            histogram.add(seconds)
+
+        status = histogram.get_status()
+
+        assert status["counts"] == [1, 2, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1]
+        assert status["max"] == 5000.0
+        assert abs(status["sum"] - 5005.055) < 1e-6
+
+
+class TestQueueJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_restore(self):
+        """The jobs not done survive a restart, also if the journal
+        was truncated by a crash.
+
+        """
+        journal = QueueJournal(self.path)
+        assert journal.load() == []
+        for i in xrange(3):
+            journal.push(JobQueueEntry("evaluate", i, 1), i,
+                         datetime(2014, 1, 1, 0, 0, i), "live", 10 + i)
+        journal.done(JobQueueEntry("evaluate", 1, 1))
+        with open(self.path, "ab") as journal_file:
+            journal_file.write('["push", "evaluate", 5')
+
+        entries = QueueJournal(self.path).load()
+
+        assert sorted(entries) == [
+            (JobQueueEntry("evaluate", 0, 1), 0,
+             datetime(2014, 1, 1, 0, 0, 0), "live", 10),
+            (JobQueueEntry("evaluate", 2, 1), 2,
+             datetime(2014, 1, 1, 0, 0, 2), "live", 12)]
+        with open(self.path, "rb") as journal_file:
+            assert len(journal_file.readlines()) == 2
+
+
+class TestCompilationCache(unittest.TestCase):
+
+    def test_fill(self):
+        """A compilation of the same sources reuses the previous result,
+        a compilation of different sources does not.
+
+        """
+        cache = CompilationCache(10)
+        compiled = TestCompilationCache.compilation("digest")
+        compiled.success = True
+        compiled.compilation_success = True
+        compiled.executables = {"foo": Executable("foo", "executable")}
+        compiled.text = ["OK"]
+        cache.add(JobGroup({"": compiled}, True))
+
+        same = JobGroup({"": TestCompilationCache.compilation("digest")})
+        other = JobGroup({"": TestCompilationCache.compilation("other")})
+
+        assert cache.fill(same)
+        assert same.success
+        assert same.jobs[""].compilation_success
+        assert same.jobs[""].executables["foo"].digest == "executable"
+        assert not cache.fill(other)
+        assert cache.get_status() == {"hits": 1, "misses": 1, "size": 1}
+
+    def test_timeout(self):
+        """Compilations that timed out are not stored.
+
+        """
+        cache = CompilationCache(10)
+        timed_out = TestCompilationCache.compilation("digest")
+        timed_out.success = True
+        timed_out.compilation_success = False
+        timed_out.plus = {"exit_status": Sandbox.EXIT_TIMEOUT}
+        cache.add(JobGroup({"": timed_out}, True))
+
+        assert cache.get_status()["size"] == 0
+
+    @staticmethod
+    def compilation(digest):
+        return CompilationJob(task_type="Batch",
+                              task_type_parameters=["alone", ["", ""],
+                                                    "diff"],
+                              language="c",
+                              files={"foo.%l": File("foo.%l", digest)})
+
+
+class TestEvaluationMemo(unittest.TestCase):
+
+    def test_fill(self):
+        """Only the testcases already evaluated with the same
+        executable are filled.
+
+        """
+        memo = EvaluationMemo(10)
+        evaluated = TestEvaluationMemo.evaluation("executable", "input0")
+        evaluated.success = True
+        evaluated.outcome = "1.0"
+        memo.add(JobGroup({"000": evaluated}, True))
+
+        job_group = JobGroup({
+            "000": TestEvaluationMemo.evaluation("executable", "input0"),
+            "001": TestEvaluationMemo.evaluation("executable", "input1")})
+        other = JobGroup({
+            "000": TestEvaluationMemo.evaluation("other", "input0")})
+
+        assert memo.fill(job_group).keys() == ["000"]
+        assert job_group.jobs["000"].outcome == "1.0"
+        assert not job_group.success
+        assert memo.fill(other) == {}
+        assert memo.get_status() == {"hits": 1, "misses": 2, "size": 1}
+
+    def test_timeout(self):
+        """Evaluations that timed out are not stored.
+
+        """
+        memo = EvaluationMemo(10)
+        timed_out = TestEvaluationMemo.evaluation("executable", "input0")
+        timed_out.success = True
+        timed_out.outcome = "0.0"
+        timed_out.plus = {"exit_status": Sandbox.EXIT_TIMEOUT}
+        memo.add(JobGroup({"000": timed_out}, True))
+
+        assert memo.get_status()["size"] == 0
+
+    @staticmethod
+    def evaluation(digest, input_digest):
+        return EvaluationJob(task_type="Batch",
+                             task_type_parameters="[]",
+                             language="c",
+                             executables={"foo": Executable("foo", digest)},
+                             input=input_digest,
+                             output="output",
+                             time_limit=1.0,
+                             memory_limit=256)
+
+
+class TestReuseEvaluations(unittest.TestCase):
+
+    def test_changed_testcases(self):
+        """Only the testcases that did not change since the other
+        dataset are filled.
+
+        """
+        dataset = TestReuseEvaluations.dataset(1.0)
+        submission_result = Mock()
+        submission_result.dataset = TestReuseEvaluations.dataset(1.0)
+        submission_result.executables = {"foo": Executable("foo", "exe")}
+        submission_result.evaluations = [
+            TestReuseEvaluations.evaluation("000", "input0", "1.0"),
+            TestReuseEvaluations.evaluation("001", "old_input1", "0.0")]
+        job_group = JobGroup({
+            "000": TestEvaluationMemo.evaluation("exe", "input0"),
+            "001": TestEvaluationMemo.evaluation("exe", "input1")})
+
+        filled = EvaluationService.reuse_evaluations(
+            job_group, dataset, submission_result)
+
+        assert filled.keys() == ["000"]
+        assert job_group.jobs["000"].outcome == "1.0"
+        assert job_group.jobs["000"].plus["execution_time"] == 0.5
+        assert not job_group.success
+
+        submission_result.dataset = TestReuseEvaluations.dataset(2.0)
+        job_group.jobs["000"].success = None
+        assert EvaluationService.reuse_evaluations(
+            job_group, dataset, submission_result) == {}
+
+    def test_timeout(self):
+        """Evaluations that timed out are not reused, as they are not
+        memoized.
+
+        """
+        dataset = TestReuseEvaluations.dataset(1.0)
+        submission_result = Mock()
+        submission_result.dataset = TestReuseEvaluations.dataset(1.0)
+        submission_result.executables = {"foo": Executable("foo", "exe")}
+        timed_out = TestReuseEvaluations.evaluation("000", "input0", "0.0")
+        timed_out.text = "[\"Execution timed out\"]"
+        submission_result.evaluations = [timed_out]
+        job_group = JobGroup({
+            "000": TestEvaluationMemo.evaluation("exe", "input0")})
+
+        assert EvaluationService.reuse_evaluations(
+            job_group, dataset, submission_result) == {}
+        assert not job_group.jobs["000"].success
+
+    @staticmethod
+    def dataset(time_limit):
+        dataset = Mock()
+        dataset.task_type = "Batch"
+        dataset.task_type_parameters = "[]"
+        dataset.time_limit = time_limit
+        dataset.memory_limit = 256
+        dataset.managers = {}
+        return dataset
+
+    @staticmethod
+    def evaluation(codename, input_digest, outcome):
+        evaluation = Mock()
+        evaluation.codename = codename
+        evaluation.testcase.input = input_digest
+        evaluation.testcase.output = "output"
+        evaluation.outcome = outcome
+        evaluation.text = "[\"Output is correct\"]"
+        evaluation.execution_time = 0.5
+        evaluation.execution_wall_clock_time = 0.6
+        evaluation.execution_memory = 1024
+        evaluation.evaluation_shard = 0
+        evaluation.evaluation_sandbox = "/tmp/sandbox"
+        return evaluation
+
+
+class TestJobGroup(unittest.TestCase):
+
+    def test_split_merge(self):
+        """Splitting and merging again gives back the same jobs.
+
+        """
+        jobs = dict(("%03d" % i, EvaluationJob()) for i in xrange(10))
+        job_group = JobGroup(jobs, True)
+
+        chunks = job_group.split(3)
+
+        assert [len(chunk.jobs) for chunk in chunks] == [3, 3, 4]
+        assert JobGroup.merge(chunks).jobs == jobs
+        assert len(job_group.split(20)) == 10
+
+    def test_plan(self):
+        """The jobs in the plan come first, and the plan is split
+        together with them.
+
+        """
+        jobs = dict(("%03d" % i, EvaluationJob()) for i in xrange(4))
+        job_group = JobGroup(jobs, plan=[["002", "001"], ["003", "000"]])
+
+        assert job_group.get_ordered_keys() == ["002", "001", "003", "000"]
+        assert [chunk.plan for chunk in job_group.split(2)] == \
+            [[["001"], ["000"]], [["002"], ["003"]]]
+
+
+if __name__ == "__main__":
+    unittest.main()
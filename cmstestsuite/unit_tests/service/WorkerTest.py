@@ -23,18 +23,21 @@
 
 import gevent
 import unittest
-from mock import Mock, call
+from mock import Mock, call, patch
 
 import cms.service.Worker
 from cms.grading import JobException
 from cms.grading.Job import EvaluationJob, JobGroup
+from cms.grading.Sandbox import IsolateSandbox
 from cms.service.Worker import Worker
 
 
 class TestWorker(unittest.TestCase):
 
     def setUp(self):
-        self.service = Worker(0)
+        # The jobs do not use isolate.
+        with patch.object(IsolateSandbox, "check_box_ids"):
+            self.service = Worker(0)
 
     # Testing execute_job_group.
 
@@ -105,7 +108,8 @@ class TestWorker(unittest.TestCase):
             calls_a, any_order=True)
         self.assertEquals(task_type_a.call_count, 3)
 
-        jobgroup_b, calls_b = TestWorker.new_jobgroup(3, prefix="b")
+        jobgroup_b, calls_b = TestWorker.new_jobgroup(
+            3, prefix="b", task_type="other_fake_task_type")
         task_type_b = FakeTaskType([True, True, True])
         cms.service.Worker.get_task_type = Mock(return_value=task_type_b)
 
@@ -116,6 +120,26 @@ class TestWorker(unittest.TestCase):
             calls_b, any_order=True)
         self.assertEquals(task_type_b.call_count, 3)
 
+    def test_execute_job_group_reuses_task_types(self):
+        """Executes two job groups with the same task types: the
+        instances created for the first are used by the second.
+
+        """
+        jobgroup_a, calls_a = TestWorker.new_jobgroup(3, prefix="a")
+        task_type = FakeTaskType([True] * 6)
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        JobGroup.import_from_dict(
+            self.service.execute_job_group(jobgroup_a.export_to_dict()))
+        jobgroup_b, unused_calls = TestWorker.new_jobgroup(3, prefix="b")
+        JobGroup.import_from_dict(
+            self.service.execute_job_group(jobgroup_b.export_to_dict()))
+
+        cms.service.Worker.get_task_type.assert_has_calls(
+            calls_a, any_order=True)
+        self.assertEquals(cms.service.Worker.get_task_type.call_count, 3)
+        self.assertEquals(task_type.call_count, 6)
+
     def test_execute_job_group_subsequent_locked(self):
         """Executes a job group with one long job, then another one
         that should fail because of the lock.
@@ -180,6 +204,54 @@ class TestWorker(unittest.TestCase):
             calls_b, any_order=True)
         self.assertEquals(task_type_b.call_count, 3)
 
+    def test_execute_job_group_plan(self):
+        """Executes a job group with a plan: after a job with outcome
+        0.0, the following ones in its list are skipped, and not
+        returned.
+
+        """
+        jobgroup, unused_calls = TestWorker.new_jobgroup(4)
+        jobgroup.plan = [["2", "0", "1"], ["3"]]
+        outcomes = {"0": "0.0", "1": "1.0", "2": "1.0", "3": "0.0"}
+
+        def execute_job(job, unused_file_cacher):
+            job.success = True
+            job.outcome = outcomes[job._key]
+        task_type = Mock()
+        task_type.execute_job.side_effect = execute_job
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        jobgroup = JobGroup.import_from_dict(
+            self.service.execute_job_group(jobgroup.export_to_dict()))
+
+        self.assertTrue(jobgroup.success)
+        self.assertEquals(task_type.execute_job.call_count, 3)
+        self.assertEquals(sorted(jobgroup.jobs.iterkeys()), ["0", "2", "3"])
+        self.assertEquals(jobgroup.jobs["3"].outcome, "0.0")
+
+    def test_execute_job_group_fetch_files(self):
+        """The files of a job missing from the cache are loaded
+        before executing it, reporting progress after each of them.
+
+        """
+        jobgroup, unused_calls = TestWorker.new_jobgroup(1)
+        jobgroup.jobs["0"].input = "input"
+        jobgroup.jobs["0"].output = "output"
+        task_type = FakeTaskType([True])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+        self.service.evaluation_service = Mock()
+        self.service.file_cacher.is_cached = Mock(
+            side_effect=lambda digest: digest == "output")
+        self.service.file_cacher.load = Mock()
+
+        self.service.execute_job_group(jobgroup.export_to_dict())
+
+        self.service.file_cacher.load.assert_called_once_with("input")
+        self.assertEquals(
+            self.service.evaluation_service.job_progress.mock_calls,
+            [call(shard=0, slot=0, done=0)] * 2
+            + [call(shard=0, slot=0, done=1)])
+
     # Testing ignore_job.
 
     def test_ignore_job(self):
@@ -206,13 +278,40 @@ class TestWorker(unittest.TestCase):
         self.assertEquals(cms.service.Worker.get_task_type.call_count, 1)
         self.assertEquals(task_type.call_count, 1)
 
+    # Testing the execution slots.
+
+    def test_execute_job_group_slots(self):
+        """Two job groups are executed at the same time in different
+        slots, while the same slot refuses a second one.
+
+        """
+        cms.service.Worker.config.worker_slots = 2
+        try:
+            self.service = Worker(0)
+        finally:
+            cms.service.Worker.config.worker_slots = 1
+        jobgroup, unused_calls = TestWorker.new_jobgroup(1)
+        task_type = FakeTaskType([0.01, 0.01, 0.01])
+        cms.service.Worker.get_task_type = Mock(return_value=task_type)
+
+        greenlets = [gevent.spawn(self.service.execute_job_group,
+                                  jobgroup.export_to_dict(), slot)
+                     for slot in [0, 1, 1]]
+        gevent.joinall(greenlets)
+
+        self.assertTrue(greenlets[0].successful())
+        self.assertTrue(greenlets[1].successful())
+        self.assertFalse(greenlets[2].successful())
+        self.assertEquals(task_type.call_count, 2)
+
     @staticmethod
-    def new_jobgroup(number_of_jobs, prefix=None):
+    def new_jobgroup(number_of_jobs, prefix=None, task_type=None):
         prefix = prefix if prefix is not None else ""
+        task_type = task_type if task_type is not None else "fake_task_type"
         jobgroup_dict = {}
         calls = []
         for i in xrange(number_of_jobs):
-            job_params = ("fake_task_type", "fake_parameters_%s" % i)
+            job_params = (task_type, "fake_parameters_%s" % i)
             job = EvaluationJob(*job_params, info=prefix + str(i))
             jobgroup_dict[str(i)] = job
             calls.append(call(*job_params))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+# Programming contest management system
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for the white diff comparator."""
+
+import io
+import random
+import unittest
+
+import cms.grading
+from cms.grading import white_diff, white_diff_canonicalize, WHITES
+
+
+def white_diff_by_lines(output, res):
+    """The straightforward line by line white diff, as a reference.
+
+    """
+    while True:
+        lout = output.readline()
+        lres = res.readline()
+        if lres == '' and lout == '':
+            return True
+        elif lres == '' or lout == '':
+            if lout.strip(WHITES) != '' or lres.strip(WHITES) != '':
+                return False
+        elif white_diff_canonicalize(lout) != white_diff_canonicalize(lres):
+            return False
+
+
+class TestWhiteDiff(unittest.TestCase):
+    """Test the function white_diff."""
+
+    def tearDown(self):
+        cms.grading.WHITE_DIFF_BLOCK_SIZE = 1024 * 1024
+
+    def assertWhiteDiff(self, output, res, expected):
+        """Check white_diff on two strings, with many block sizes.
+
+        """
+        for block_size in [1, 2, 3, 7, 1024 * 1024]:
+            cms.grading.WHITE_DIFF_BLOCK_SIZE = block_size
+            self.assertEqual(
+                white_diff(io.BytesIO(output), io.BytesIO(res)), expected,
+                "%r and %r with blocks of %d" % (output, res, block_size))
+
+    def test_equal(self):
+        """Identical files, or differing only by whitespaces.
+
+        """
+        self.assertWhiteDiff("", "", True)
+        self.assertWhiteDiff("1 2\n3\n", "1 2\n3\n", True)
+        self.assertWhiteDiff("1 2\n3\n", "  1\t 2 \r\n3", True)
+        self.assertWhiteDiff("1\n \n2", "1\n\n2\n\n \t\n", True)
+        self.assertWhiteDiff(" \n\n", "", True)
+
+    def test_different(self):
+        """Files differing in tokens or lines.
+
+        """
+        self.assertWhiteDiff("1 2\n", "1 3\n", False)
+        self.assertWhiteDiff("1 2\n", "1\n2\n", False)
+        self.assertWhiteDiff("12\n", "1 2\n", False)
+        self.assertWhiteDiff("1\n\n2\n", "1\n2\n", False)
+        self.assertWhiteDiff("\n1\n", "1\n", False)
+        self.assertWhiteDiff("1\n", "1\n2", False)
+        self.assertWhiteDiff("", "0", False)
+
+    def test_random(self):
+        """Random files agree with the line by line algorithm.
+
+        """
+        rand = random.Random(42)
+        for _ in xrange(500):
+            output = "".join(rand.choice("ab \t\r\n")
+                             for _ in xrange(rand.randint(0, 12)))
+            res = "".join(rand.choice([c, rand.choice("ab \t\r\n")])
+                          for c in output)
+            self.assertWhiteDiff(
+                output, res,
+                white_diff_by_lines(io.BytesIO(output), io.BytesIO(res)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,7 +7,7 @@
 /* Range of UIDs and GIDs reserved for use by the sandboxes. */
 #define CONFIG_ISOLATE_FIRST_UID 60000
 #define CONFIG_ISOLATE_FIRST_GID 60000
-#define CONFIG_ISOLATE_NUM_BOXES 100
+#define CONFIG_ISOLATE_NUM_BOXES 1000
 
 /* Root of the cgroup hierarchy. */
 #define CONFIG_ISOLATE_CGROUP_ROOT "/sys/fs/cgroup"
@@ -818,6 +818,15 @@ cg_enter(void)
       cg_write(CG_MEMORY, "?memory.memsw.limit_in_bytes", "%lld\n", (long long) cg_memory_limit << 10);
     }
 
+  /*
+   * The control group is created by --init, but a box may be used for
+   * many runs without initializing it again: reset the peak memory
+   * usage (as the CPU time below), so that cg-mem in the meta file is
+   * about this run only.
+   */
+  cg_write(CG_MEMORY, "?memory.max_usage_in_bytes", "0\n");
+  cg_write(CG_MEMORY, "?memory.memsw.max_usage_in_bytes", "0\n");
+
   if (cg_timing)
     cg_write(CG_CPUACCT, "cpuacct.usage", "0\n");
 }